@@ -50,7 +50,9 @@ class Routine:
                  verbose=True, we_finetuned=False,
                  we_finetune_path=None, num_epochs=10,
                  sentence_embedding=True, we=None,
-                 train_batch_size=16):
+                 train_batch_size=16, embedding_store_path=None, storage_dtype=None, embedding_backend='eager',
+                 embedding_backend_path=None, embedding_window=None, embedding_depth=None,
+                 embedding_attribute_scope=False):
         if device is None:
             device = 'cuda' if torch.cuda.is_available() else 'cpu'
         self.device = device
@@ -215,9 +217,16 @@ class Routine:
             else:
                 finetuned_path = os.path.join(self.project_path, 'dataset_files', 'finetuned_models', dataset_name)
             self.we = WordEmbedding(device=self.device, verbose=verbose, model_path=finetuned_path,
-                                    sentence_embedding=sentence_embedding)
+                                    sentence_embedding=sentence_embedding, store_path=embedding_store_path,
+                                    storage_dtype=storage_dtype, backend=embedding_backend,
+                                    backend_path=embedding_backend_path, window=embedding_window,
+                                    depth=embedding_depth, attribute_scope=embedding_attribute_scope)
         else:
-            self.we = WordEmbedding(device=self.device, verbose=verbose, sentence_embedding=sentence_embedding)
+            self.we = WordEmbedding(device=self.device, verbose=verbose, sentence_embedding=sentence_embedding,
+                                    store_path=embedding_store_path, storage_dtype=storage_dtype,
+                                    backend=embedding_backend, backend_path=embedding_backend_path,
+                                    window=embedding_window, depth=embedding_depth,
+                                    attribute_scope=embedding_attribute_scope)
 
     # def __del__(self):
     #     try:
@@ -235,7 +244,8 @@ class Routine:
     #     torch.cuda.empty_cache()
     #     return super(Routine, self).__del__()
 
-    def generate_df_embedding(self, chunk_size=100):
+    def generate_df_embedding(self, chunk_size=100, token_budget=None, n_workers=None, n_threads=None,
+                              pipeline=False, memory_budget=None):
         self.embeddings = {}
         if self.sentence_embedding:
             self.sentence_embedding_dict = {}
@@ -262,13 +272,18 @@ class Routine:
                 gc.collect()
                 torch.cuda.empty_cache()
                 if self.sentence_embedding:
-                    emb, words, sentence_emb = we.generate_embedding(df, chunk_size=chunk_size)
+                    emb, words, sentence_emb = we.generate_embedding(df, chunk_size=chunk_size,
+                                                                     token_budget=token_budget, n_workers=n_workers,
+                                                                     n_threads=n_threads, pipeline=pipeline,
+                                                                     memory_budget=memory_budget)
                     self.sentence_embedding_dict[name] = sentence_emb
                     tmp_path = os.path.join(self.model_files_path, 'sentence_emb_' + name + '.csv')
                     with open(tmp_path, 'wb') as file:
                         torch.save(sentence_emb, file)
                 else:
-                    emb, words = we.generate_embedding(df, chunk_size=chunk_size)
+                    emb, words = we.generate_embedding(df, chunk_size=chunk_size, token_budget=token_budget,
+                                                       n_workers=n_workers, n_threads=n_threads, pipeline=pipeline,
+                                                       memory_budget=memory_budget)
                 self.embeddings[name] = emb
                 self.words[name] = words
                 tmp_path = os.path.join(self.model_files_path, 'emb_' + name + '.csv')
@@ -282,7 +297,8 @@ class Routine:
                 [
                     768]), f'Sentence emb has shape: {self.sentence_embedding_dict["table_A"][0].shape}. It must be [768]!'
 
-    def get_processed_data(self, df, chunk_size=500, verbose=False):
+    def get_processed_data(self, df, chunk_size=500, verbose=False, token_budget=None, n_workers=None, n_threads=None,
+                           pipeline=False, memory_budget=None):
         we = self.we
         res = {}
         for side in ['left', 'right']:
@@ -293,16 +309,22 @@ class Routine:
             prefix = self.lp if side == 'left' else self.rp
             cols = [prefix + col for col in self.cols]
             tmp_df = df.loc[:, cols]
-            res[side + '_word_map'] = WordPairGenerator.map_word_to_attr(tmp_df, self.cols, prefix=prefix,
-                                                                         verbose=self.verbose)
+            # a record in many candidate pairs is embedded once
+            tmp_df, inverse = WordEmbedding.unique_records(tmp_df, df[prefix + 'id'] if prefix + 'id' in df else None)
+            word_map = WordPairGenerator.map_word_to_attr(tmp_df, self.cols, prefix=prefix, verbose=self.verbose)
             if self.sentence_embedding:
-                emb, words, sentence_emb = we.generate_embedding(tmp_df, chunk_size=chunk_size)
-                res[side + '_sentence_emb'] = sentence_emb
+                emb, words, sentence_emb = we.generate_embedding(tmp_df, chunk_size=chunk_size,
+                                                                 token_budget=token_budget, n_workers=n_workers,
+                                                                 n_threads=n_threads, pipeline=pipeline,
+                                                                 memory_budget=memory_budget)
+                res[side + '_sentence_emb'], = WordEmbedding.expand_records(inverse, sentence_emb)
             else:
-                emb, words = we.generate_embedding(tmp_df, chunk_size=chunk_size)
+                emb, words = we.generate_embedding(tmp_df, chunk_size=chunk_size, token_budget=token_budget,
+                                                   n_workers=n_workers, n_threads=n_threads, pipeline=pipeline,
+                                                   memory_budget=memory_budget)
 
-            res[side + '_emb'] = emb
-            res[side + '_words'] = words
+            res[side + '_word_map'], res[side + '_emb'], res[side + '_words'] = WordEmbedding.expand_records(
+                inverse, word_map, emb, words)
         return res
 
     def compute_word_pair(self, use_schema=True, **kwargs):
@@ -443,9 +465,9 @@ class Routine:
             # optimizer = optim.SGD(net.parameters(), lr=0.0001, momentum=.9)
             # best_model, score_history, last_model = train_model(net,dataloaders_dict, criterion, optimizer,nn.MSELoss().to(device), num_epochs=150, device=device)
 
-            out = net(valid_dataset.X.to(device))
+            out = valid_dataset.predict(net, device)
             print(f'best_valid --> mean:{out.mean():.4f}  std: {out.std():.4f}')
-            out = last_model(valid_dataset.X.to(device))
+            out = valid_dataset.predict(last_model, device)
             print(f'last_model --> mean:{out.mean():.4f}  std: {out.std():.4f}')
             print('Save...')
             torch.save(best_model.state_dict(), tmp_path)
@@ -499,7 +521,7 @@ class Routine:
             data_loader.__init__(word_pairs, emb_pairs, sentence_emb_pairs)
             word_pair_corrected = data_loader.word_pairs_corrected
             with torch.no_grad():
-                word_pair_corrected['pred'] = model(data_loader.X.to(self.device)).cpu().detach().numpy()
+                word_pair_corrected['pred'] = data_loader.predict(model, self.device).numpy()
         return word_pair_corrected
 
     def extract_features(self, word_pair, **kwargs):
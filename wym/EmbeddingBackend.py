@@ -0,0 +1,107 @@
+import copy
+import os
+
+import numpy as np
+import torch
+from torch import nn
+
+
+class LayerMean(nn.Module):
+    """BertModel returning the mean of the hidden states layers[0]..layers[1] - 1, the graph that is exported."""
+
+    def __init__(self, model, layers=(2, 12)):
+        super().__init__()
+        self.model = model
+        self.layers = layers
+
+    def forward(self, input_ids, attention_mask, token_type_ids):
+        hidden_states = self.model(input_ids, attention_mask, token_type_ids, output_hidden_states=True,
+                                   return_dict=False)[2]
+        first, last = self.layers
+        return sum(hidden_states[first:last]) / (last - first)
+
+
+class EmbeddingBackend:
+    """Token embeddings of WordEmbedding computed by an exported graph instead of the eager BertModel.
+
+    kind is 'torchscript' (a torch.jit archive) or 'onnx' (an ONNX Runtime model, needs the onnxruntime
+    package). Both are made by export from an eager model, by default with the weights of the linear layers
+    dynamically quantized to int8, and run on CPU. kind 'student' is a StudentEmbedder saved by
+    StudentEmbedder.distill.
+    """
+    kinds = ['torchscript', 'onnx', 'student']
+    input_names = ['input_ids', 'attention_mask', 'token_type_ids']
+
+    def __init__(self, kind: str, path: str):
+        assert kind in EmbeddingBackend.kinds, f'backend must be one of {EmbeddingBackend.kinds}, not {kind}'
+        self.kind = kind
+        self.path = path
+        if kind == 'torchscript':
+            self.module = torch.jit.load(path, map_location='cpu').eval()
+        elif kind == 'student':
+            from .StudentEmbedder import StudentEmbedder
+            self.module = StudentEmbedder.load(path)
+        else:
+            self.session = EmbeddingBackend.onnxruntime().InferenceSession(path, providers=['CPUExecutionProvider'])
+
+    def __getstate__(self):
+        # the graph is loaded again from path, e.g. by the workers of the sharded embedding
+        return {'kind': self.kind, 'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['kind'], state['path'])
+
+    @staticmethod
+    def onnxruntime():
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise ImportError('the onnx backend needs onnxruntime: pip install onnxruntime') from e
+        return onnxruntime
+
+    def __call__(self, input_ids: torch.Tensor, attention_mask: torch.Tensor,
+                 token_type_ids: torch.Tensor) -> torch.Tensor:
+        if self.kind != 'onnx':
+            with torch.no_grad():
+                return self.module(input_ids, attention_mask, token_type_ids)
+        inputs = {name: x.cpu().numpy().astype(np.int64) for name, x in
+                  zip(EmbeddingBackend.input_names, [input_ids, attention_mask, token_type_ids])}
+        return torch.from_numpy(self.session.run(None, inputs)[0])
+
+    @staticmethod
+    def export(model, path: str, kind: str = 'torchscript', layers=(2, 12), quantize: bool = True, example=None):
+        """Export the layer mean of an eager BertModel to path.
+
+        example is the (input_ids, attention_mask, token_type_ids) batch to trace with, a short dummy batch by
+        default.
+        """
+        assert kind in ['torchscript', 'onnx'], f'export to torchscript or onnx, not {kind}'
+        # the layers after the last averaged hidden state are left out of the graph
+        model = copy.deepcopy(model).cpu()
+        model.encoder.layer = model.encoder.layer[:layers[1] - 1]
+        module = LayerMean(model, layers).eval()
+        if example is None:
+            input_ids = torch.randint(model.config.vocab_size, [2, 8])
+            attention_mask = torch.ones_like(input_ids)
+            # with padding, so that the masking is traced as well
+            attention_mask[1, 5:] = 0
+            example = (input_ids, attention_mask, torch.zeros_like(input_ids))
+        if kind == 'torchscript':
+            if quantize:
+                module = torch.ao.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8)
+            with torch.no_grad():
+                traced = torch.jit.trace(module, example, check_trace=False, strict=False)
+            torch.jit.save(traced, path)
+            return path
+        float_path = path + '.float.onnx' if quantize else path
+        dynamic_axes = {name: {0: 'batch', 1: 'tokens'} for name in EmbeddingBackend.input_names}
+        with torch.no_grad():
+            torch.onnx.export(module, example, float_path, input_names=EmbeddingBackend.input_names,
+                              output_names=['token_embeddings'],
+                              dynamic_axes={**dynamic_axes, 'token_embeddings': {0: 'batch', 1: 'tokens'}})
+        if quantize:
+            EmbeddingBackend.onnxruntime()
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+            quantize_dynamic(float_path, path, weight_type=QuantType.QInt8)
+            os.remove(float_path)
+        return path
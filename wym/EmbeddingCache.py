@@ -0,0 +1,68 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import torch
+
+from .RaggedEmbeddings import RaggedEmbeddings
+
+
+class EmbeddingCache:
+    """LRU cache of the embeddings of records, keyed by a hash of their normalized text.
+
+    A value is whatever WordEmbedding keeps for a record (word embeddings, words and optionally the sentence
+    embedding). The least recently used records are evicted once the cached values take more than max_bytes.
+    It can be shared by threads.
+    """
+
+    def __init__(self, max_bytes: int = 2 ** 30):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def key(sentence: str) -> bytes:
+        # the tokenizer is uncased and splits on whitespace
+        return hashlib.sha1(' '.join(sentence.lower().split()).encode('utf-8')).digest()
+
+    @staticmethod
+    def size(value) -> int:
+        return sum(x.element_size() * x.nelement() if isinstance(x, torch.Tensor) else
+                   x.nbytes if isinstance(x, RaggedEmbeddings) else sum(len(word) for word in x) for x in value)
+
+    def get(self, sentence: str):
+        key = EmbeddingCache.key(sentence)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, sentence: str, value):
+        key = EmbeddingCache.key(sentence)
+        size = EmbeddingCache.size(value)
+        with self.lock:
+            if key in self.entries or size > self.max_bytes:
+                return
+            self.entries[key] = (value, size)
+            self.n_bytes += size
+            while self.n_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.n_bytes -= evicted_size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.n_bytes = 0
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'records': len(self), 'bytes': self.n_bytes}
@@ -0,0 +1,92 @@
+from typing import List
+
+import numpy as np
+import torch
+
+from .RaggedEmbeddings import RaggedEmbeddings
+from .SimilarityEngine import SimilarityEngine
+
+
+class EmbeddingPairs:
+    """Embedding pairs of the decision units stored as indices into per-side word embedding tables.
+
+    Row 0 of both tables is the zero embedding used for [UNP], the words of every record follow. index[i] holds
+    the left and right rows of the i-th pair, so each word embedding is stored once however many pairs it is in.
+    Indexing returns the materialized pairs, like the [n_pairs, 2, size] tensor it replaces.
+
+    The tables may be in a storage dtype (see RaggedEmbeddings.astype), with the row scales of int8 tables in
+    left_scale and right_scale. The pairs are always returned in float32.
+    """
+
+    def __init__(self, left_emb: torch.Tensor, right_emb: torch.Tensor, index: torch.Tensor,
+                 left_scale: torch.Tensor = None, right_scale: torch.Tensor = None):
+        self.left_emb = left_emb
+        self.right_emb = right_emb
+        self.index = index
+        self.left_scale = left_scale
+        self.right_scale = right_scale
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    @property
+    def shape(self):
+        return torch.Size([len(self), 2, self.left_emb.shape[1]])
+
+    def __getitem__(self, item) -> torch.Tensor:
+        index = self.index[item]
+        pairs = []
+        for table, scale, side_index in [(self.left_emb, self.left_scale, index[..., 0]),
+                                         (self.right_emb, self.right_scale, index[..., 1])]:
+            emb = table[side_index].float()
+            pairs.append(emb * scale[side_index].unsqueeze(-1) if scale is not None else emb)
+        return torch.stack(pairs, -2)
+
+    @staticmethod
+    def offsets(emb_list: List[torch.Tensor]) -> np.ndarray:
+        """Table row of the first word of every record."""
+        if isinstance(emb_list, RaggedEmbeddings):
+            return 1 + emb_list.starts - emb_list.offsets[0]
+        lengths = [SimilarityEngine.n_words(emb) for emb in emb_list]
+        return np.concatenate([[1], 1 + np.cumsum(lengths)[:-1]]).astype(np.int64)
+
+    @staticmethod
+    def table(emb_list: List[torch.Tensor], size: int = 768) -> torch.Tensor:
+        """Word embeddings of a list of records stacked after the zero row."""
+        if isinstance(emb_list, RaggedEmbeddings):
+            values = emb_list.values.cpu()
+            return torch.cat([torch.zeros(1, size, dtype=values.dtype), values])
+        return torch.cat([torch.zeros(1, size)] + [emb.detach().cpu().reshape([-1, size]) for emb in emb_list if
+                                                    SimilarityEngine.n_words(emb) > 0])
+
+    @staticmethod
+    def scale_table(emb_list) -> torch.Tensor:
+        """Row scales of the table of an int8 RaggedEmbeddings, None for the other storage dtypes."""
+        if isinstance(emb_list, RaggedEmbeddings) and emb_list.scale is not None:
+            return torch.cat([torch.ones(1), emb_list.scales.cpu()])
+        return None
+
+    @staticmethod
+    def from_pairs(pairs: torch.Tensor, storage_dtype: str = None) -> 'EmbeddingPairs':
+        """[n_pairs, 2, size] embedding pairs stored as storage_dtype, every pair keeps its own rows."""
+        n_pairs, _, size = pairs.shape
+        sides = [RaggedEmbeddings(pairs[:, k], np.array([0, n_pairs])).astype(storage_dtype) for k in range(2)]
+        tables = [torch.cat([torch.zeros(1, size, dtype=side.data.dtype), side.data]) for side in sides]
+        scales = [torch.cat([torch.ones(1), side.scale]) if side.scale is not None else None for side in sides]
+        index = torch.arange(1, n_pairs + 1).unsqueeze(1).repeat(1, 2)
+        return EmbeddingPairs(tables[0], tables[1], index, *scales)
+
+    @staticmethod
+    def pos_to_index(pos_pair: np.ndarray, left_offset: int, right_offset: int) -> np.ndarray:
+        # -1 ([UNP]) goes to the zero row
+        index = pos_pair + np.array([left_offset, right_offset])
+        index[pos_pair == -1] = 0
+        return index
+
+    def batches(self, batch_size: int = 65536):
+        for start in range(0, len(self), batch_size):
+            yield slice(start, start + batch_size)
+
+    def cos_sim(self, batch_size: int = 65536) -> torch.Tensor:
+        return torch.cat([torch.cosine_similarity(pairs[:, 0, :], pairs[:, 1, :]) for pairs in
+                          (self[batch] for batch in self.batches(batch_size))])
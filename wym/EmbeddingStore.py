@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+import torch
+
+try:
+    import fcntl
+except ImportError:
+    # no file locks on Windows, a single process should write to a store there
+    fcntl = None
+
+from .EmbeddingCache import EmbeddingCache
+
+
+class EmbeddingStore:
+    """Append-only on-disk store of record embeddings, keyed by the record text like EmbeddingCache.
+
+    Every embedding model gets its own directory under path holding
+    - embeddings.f32: the float32 rows of all the records, read through a memory map,
+    - index.jsonl: one line per record with its key, first row, words and whether a sentence embedding row follows
+      the word rows.
+    Rows are written before their index line, so readers only ever see complete records and any number of them can
+    share a store. Writers hold an exclusive lock on index.jsonl while they append a record, so several processes can
+    write to the same store, and the threads of a process can share the EmbeddingStore.
+    """
+
+    def __init__(self, path: str, model_id: str, size: int = 768):
+        self.path = os.path.join(path, hashlib.sha1(model_id.encode('utf-8')).hexdigest())
+        self.size = size
+        os.makedirs(self.path, exist_ok=True)
+        meta_path = os.path.join(self.path, 'meta.json')
+        if not os.path.exists(meta_path):
+            with open(meta_path, 'w') as file:
+                json.dump({'model_id': model_id, 'size': size}, file)
+        self.data_path = os.path.join(self.path, 'embeddings.f32')
+        self.index_path = os.path.join(self.path, 'index.jsonl')
+        for file_path in [self.data_path, self.index_path]:
+            open(file_path, 'ab').close()
+        self.index = {}
+        self.index_pos = 0
+        self.n_rows = 0
+        self.data = None
+        self.lock = threading.RLock()
+        self.refresh()
+
+    def __len__(self):
+        return len(self.index)
+
+    def refresh(self):
+        """Read the records added to the index since the last call."""
+        with self.lock, open(self.index_path, 'rb') as file:
+            file.seek(self.index_pos)
+            for line in file:
+                if not line.endswith(b'\n'):
+                    # a writer is still appending it
+                    break
+                self.index_pos += len(line)
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the end of a line left by a crashed writer
+                    continue
+                self.index[entry['key']] = entry
+                self.n_rows = max(self.n_rows, entry['row'] + len(entry['words']) + entry['sentence'])
+
+    def rows(self, start: int, stop: int) -> np.ndarray:
+        if stop == start:
+            return np.zeros([0, self.size], dtype=np.float32)
+        if self.data is None or self.data.shape[0] < stop:
+            self.data = np.memmap(self.data_path, dtype=np.float32, mode='r', shape=(self.n_rows, self.size))
+        return np.array(self.data[start:stop])
+
+    def get(self, sentence: str):
+        with self.lock:
+            entry = self.index.get(EmbeddingCache.key(sentence).hex())
+            if entry is None:
+                return None
+            n_words = len(entry['words'])
+            rows = torch.from_numpy(self.rows(entry['row'], entry['row'] + n_words + entry['sentence']))
+        record = (rows[:n_words], entry['words'])
+        return record + (rows[n_words],) if entry['sentence'] else record
+
+    def put(self, sentence: str, record):
+        key = EmbeddingCache.key(sentence).hex()
+        if key in self.index:
+            return
+        rows = [record[0].reshape([-1, self.size])]
+        if len(record) > 2 and record[2] is not None:
+            rows.append(record[2].reshape([1, self.size]))
+        with self.lock, open(self.index_path, 'a+b') as index_file:
+            # the lock is released when index_file is closed, after the index line is flushed
+            if fcntl is not None:
+                fcntl.flock(index_file, fcntl.LOCK_EX)
+            # another process may have stored the record meanwhile
+            self.refresh()
+            if key in self.index:
+                return
+            with open(self.data_path, 'ab') as file:
+                # a crashed writer may have left part of a row after the last indexed record
+                padding = -file.tell() % (4 * self.size)
+                file.write(bytes(padding))
+                row = file.tell() // (4 * self.size)
+                file.write(torch.cat(rows).to(torch.float32).numpy().tobytes())
+            entry = {'key': key, 'row': int(row), 'words': list(record[1]), 'sentence': int(len(rows) > 1)}
+            line = (json.dumps(entry) + '\n').encode('utf-8')
+            if index_file.seek(0, os.SEEK_END) > 0:
+                index_file.seek(-1, os.SEEK_END)
+                line = line if index_file.read(1) == b'\n' else b'\n' + line
+            index_file.write(line)
+            self.index[key] = entry
+            self.n_rows = max(self.n_rows, entry['row'] + len(entry['words']) + entry['sentence'])
@@ -10,6 +10,8 @@ import torch.optim as optim
 from sklearn.preprocessing import StandardScaler
 from torch.utils.data import Dataset, DataLoader
 
+from .EmbeddingPairs import EmbeddingPairs
+
 
 class TanhScaler(StandardScaler):
     def __init__(self, scale_factor=1.):
@@ -21,6 +23,35 @@ class TanhScaler(StandardScaler):
         return 0.5 * (np.tanh(self.scale_factor * tmp) + 1)
 
 
+class PairFeatures:
+    """NetAccoppiate inputs built when indexed instead of stored for every pair.
+
+    Used when the word or the sentence embedding pairs are an EmbeddingPairs, indexing gathers the embeddings of
+    the selected pairs only.
+    """
+
+    def __init__(self, embedding_pairs, sentence_embedding_pairs=None):
+        self.embedding_pairs = embedding_pairs
+        self.sentence_embedding_pairs = sentence_embedding_pairs
+
+    def __len__(self):
+        return len(self.embedding_pairs)
+
+    def batches(self, batch_size=65536):
+        for start in range(0, len(self), batch_size):
+            yield slice(start, start + batch_size)
+
+    def pair_features(self, item):
+        pairs = self.embedding_pairs[item]
+        return pairs.mean(-2).cpu(), torch.abs(pairs[..., 0, :] - pairs[..., 1, :]).cpu()
+
+    def __getitem__(self, item):
+        X = list(self.pair_features(item))
+        if self.sentence_embedding_pairs is not None:
+            X.append(self.sentence_embedding_pairs[item].mean(-2).cpu())
+        return torch.cat(X, -1)
+
+
 class DatasetAccoppiate(Dataset):
     def __init__(self, word_pairs, embedding_pairs, sentence_embedding_pairs=None):
         X = self.preprocess(embedding_pairs, sentence_embedding_pairs=sentence_embedding_pairs)
@@ -30,6 +61,15 @@ class DatasetAccoppiate(Dataset):
         self.y = self.preprocess_label(word_pairs, embedding_pairs)
 
     def preprocess(self, embedding_pairs, sentence_embedding_pairs=None):
+        if isinstance(embedding_pairs, EmbeddingPairs) or isinstance(sentence_embedding_pairs, EmbeddingPairs):
+            X = PairFeatures(embedding_pairs, sentence_embedding_pairs)
+            if hasattr(self, 'tanh_scaler_mean') == False:
+                self.tanh_scaler_mean, self.tanh_scaler_diff = TanhScaler(), TanhScaler()
+                for batch in X.batches():
+                    mean_vec, abs_diff_vec = X.pair_features(batch)
+                    self.tanh_scaler_mean.partial_fit(mean_vec)
+                    self.tanh_scaler_diff.partial_fit(abs_diff_vec)
+            return X
         mean_vec = embedding_pairs.mean(1)
         abs_diff_vec = torch.abs(embedding_pairs[:, 0, :] - embedding_pairs[:, 1, :])
         if hasattr(self, 'tanh_scaler_mean') == False:
@@ -49,8 +89,11 @@ class DatasetAccoppiate(Dataset):
 
     def preprocess_label(self, word_pairs, embedding_pairs, min_sim_pair=.7, max_sim_unpair=.5):
         tmp_word_pairs = word_pairs.copy()
-        tmp_word_pairs['cos_sim'] = torch.cosine_similarity(embedding_pairs[:, 0, :].cpu(),
-                                                            embedding_pairs[:, 1, :].cpu())
+        if isinstance(embedding_pairs, EmbeddingPairs):
+            tmp_word_pairs['cos_sim'] = embedding_pairs.cos_sim()
+        else:
+            tmp_word_pairs['cos_sim'] = torch.cosine_similarity(embedding_pairs[:, 0, :].cpu(),
+                                                                embedding_pairs[:, 1, :].cpu())
         tmp_word_pairs['label_corrected'] = tmp_word_pairs['label'].astype(float)
         tmp_word_pairs.loc[
             (tmp_word_pairs.cos_sim >= min_sim_pair) & (tmp_word_pairs.label == 0), 'label_corrected'] = .5
@@ -79,6 +122,11 @@ class DatasetAccoppiate(Dataset):
     def __getitem__(self, item: int):
         return self.X[item], self.y[item]
 
+    def predict(self, model, device, batch_size=65536):
+        with torch.no_grad():
+            return torch.cat([model(self.X[start:start + batch_size].to(device)).cpu() for start in
+                              range(0, len(self.X), batch_size)])
+
 
 class NetAccoppiate(nn.Module):
     def __init__(self, sentence_embedding=False, size=768):
@@ -132,9 +180,9 @@ def train_save_net(model_files_path, reset_networks, data_loader, words_pairs_di
         # optimizer = optim.SGD(net.parameters(), lr=0.0001, momentum=.9)
         # model, score_history, last_model = train_model(net,dataloaders_dict, criterion, optimizer,nn.MSELoss().to(device), num_epochs=150, device=device)
 
-        out = net(valid_dataset.X.to(device))
+        out = valid_dataset.predict(net, device)
         print(f'best_valid --> mean:{out.mean():.4f}  std: {out.std():.4f}')
-        out = last_model(valid_dataset.X.to(device))
+        out = valid_dataset.predict(last_model, device)
         print(f'last_model --> mean:{out.mean():.4f}  std: {out.std():.4f}')
         print('Save...')
         torch.save(model.state_dict(), tmp_path)
@@ -0,0 +1,159 @@
+from typing import List
+
+import numpy as np
+import torch
+
+
+class RaggedEmbeddings:
+    """Word embeddings of a list of records packed in one [n_words, size] tensor.
+
+    The words of record i are the rows offsets[i]:offsets[i + 1] of data. Indexing with an int returns a view of
+    the record ([0, size] for records without words), a slice returns a RaggedEmbeddings sharing the same data
+    and any other index gathers the records in a new one. It replaces the object arrays of one tensor per record,
+    iterating over it gives the same tensors.
+
+    data can be kept in a storage dtype (see astype): float16, bfloat16 or int8 with one float32 scale per row.
+    Records are handed out in float32, the conversion happens when a record is read.
+
+    With index the offsets delimit blocks of rows and record i is the block index[i], so records repeated by take
+    share their rows.
+    """
+    storage_dtypes = {'float32': torch.float32, 'float16': torch.float16, 'bfloat16': torch.bfloat16,
+                      'int8': torch.int8}
+
+    def __init__(self, data: torch.Tensor, offsets: np.ndarray, scale: torch.Tensor = None, index: np.ndarray = None):
+        self.data = data
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.scale = scale
+        self.index = np.asarray(index, dtype=np.int64) if index is not None else None
+
+    def __len__(self):
+        return len(self.offsets) - 1 if self.index is None else len(self.index)
+
+    @property
+    def size(self) -> int:
+        return self.data.shape[1]
+
+    @property
+    def storage_dtype(self) -> str:
+        """Name of the storage dtype of data in storage_dtypes."""
+        return next(name for name, dtype in self.storage_dtypes.items() if dtype == self.data.dtype)
+
+    @property
+    def blocks(self) -> np.ndarray:
+        """Block of the rows of every record."""
+        return np.arange(len(self.offsets) - 1) if self.index is None else self.index
+
+    @property
+    def starts(self) -> np.ndarray:
+        """First row of every record."""
+        return self.offsets[:-1][self.blocks]
+
+    @property
+    def n_words(self) -> np.ndarray:
+        return np.diff(self.offsets)[self.blocks]
+
+    @property
+    def values(self) -> torch.Tensor:
+        """Rows of the blocks, in order, in the storage dtype: the rows of the records when there is no index."""
+        return self.data[self.offsets[0]:self.offsets[-1]]
+
+    @property
+    def scales(self) -> torch.Tensor:
+        """Scales of the rows of the records for int8 storage, None otherwise."""
+        return self.scale[self.offsets[0]:self.offsets[-1]] if self.scale is not None else None
+
+    @property
+    def nbytes(self) -> int:
+        values = self.values
+        return values.element_size() * values.nelement() + (4 * values.shape[0] if self.scale is not None else 0)
+
+    def rows(self, start: int, stop: int) -> torch.Tensor:
+        """Rows start:stop in float32, a view when the storage dtype is float32."""
+        rows = self.data[start:stop].float()
+        return rows * self.scale[start:stop, None] if self.scale is not None else rows
+
+    def __iter__(self):
+        for start, n_words in zip(self.starts, self.n_words):
+            yield self.rows(start, start + n_words)
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            item = item + len(self) if item < 0 else item
+            block = item if self.index is None else self.index[item]
+            return self.rows(self.offsets[block], self.offsets[block + 1])
+        if isinstance(item, slice):
+            start, stop, step = item.indices(len(self))
+            if step == 1 and self.index is None:
+                return RaggedEmbeddings(self.data, self.offsets[start:max(start, stop) + 1], self.scale)
+            if step == 1:
+                return RaggedEmbeddings(self.data, self.offsets, self.scale, self.index[start:stop])
+            item = np.arange(start, stop, step)
+        positions = np.arange(len(self))[item]
+        n_words = self.n_words[positions]
+        rows = np.repeat(self.starts[positions] - np.concatenate([[0], np.cumsum(n_words)[:-1]]), n_words) + \
+               np.arange(n_words.sum())
+        rows = torch.from_numpy(rows)
+        return RaggedEmbeddings(self.data[rows], np.concatenate([[0], np.cumsum(n_words)]),
+                                self.scale[rows] if self.scale is not None else None)
+
+    def take(self, positions: np.ndarray) -> 'RaggedEmbeddings':
+        """The records at positions, in a RaggedEmbeddings sharing the rows of this one (no copy): a record taken
+        several times references the same rows."""
+        return RaggedEmbeddings(self.data, self.offsets, self.scale, self.blocks[positions])
+
+    def __getstate__(self):
+        # only the rows of the blocks are pickled, not the rest of a shared buffer
+        scales = self.scales
+        return {'data': self.values.clone(), 'offsets': self.offsets - self.offsets[0],
+                'scale': scales.clone() if scales is not None else None, 'index': self.index}
+
+    def __setstate__(self, state):
+        # containers pickled before the storage dtypes have no scale, the ones pickled before take no index
+        self.__dict__.update({'scale': None, 'index': None, **state})
+
+    def to(self, *args, **kwargs):
+        return RaggedEmbeddings(self.data.to(*args, **kwargs), self.offsets,
+                                self.scale.to(*args, **kwargs) if self.scale is not None else None, self.index)
+
+    def astype(self, storage_dtype: str = None) -> 'RaggedEmbeddings':
+        """The records stored as storage_dtype, one of storage_dtypes (None is float32).
+
+        int8 rows are scaled by their largest absolute value, the error of every element is at most half a step
+        of 1/127 of it.
+        """
+        storage_dtype = storage_dtype if storage_dtype is not None else 'float32'
+        values = self.rows(self.offsets[0], self.offsets[-1])
+        offsets = self.offsets - self.offsets[0]
+        if storage_dtype == 'int8':
+            scale = values.abs().amax(1) / 127 if values.shape[0] > 0 else torch.zeros(0)
+            scale = torch.where(scale > 0, scale, torch.ones_like(scale))
+            return RaggedEmbeddings(torch.round(values / scale[:, None]).to(torch.int8), offsets, scale, self.index)
+        return RaggedEmbeddings(values.to(RaggedEmbeddings.storage_dtypes[storage_dtype]), offsets, index=self.index)
+
+    @staticmethod
+    def from_list(emb_list: List[torch.Tensor], size: int = None) -> 'RaggedEmbeddings':
+        """Pack a list of per-record tensors, the 1-d placeholders of empty records count as records without words."""
+        emb_list = [emb.detach().cpu() for emb in emb_list]
+        non_empty = [emb for emb in emb_list if emb.dim() == 2]
+        size = size if size is not None else (non_empty[0].shape[1] if len(non_empty) > 0 else 768)
+        n_words = [emb.shape[0] if emb.dim() == 2 else 0 for emb in emb_list]
+        data = torch.cat(non_empty) if len(non_empty) > 0 else torch.zeros(0, size)
+        return RaggedEmbeddings(data.float(), np.concatenate([[0], np.cumsum(n_words)]))
+
+    @staticmethod
+    def concatenate(ragged_list: List['RaggedEmbeddings']) -> 'RaggedEmbeddings':
+        """Records of all the containers, which must share their storage dtype. The blocks are concatenated, the
+        records sharing rows keep sharing them."""
+        scale = torch.cat([x.scales for x in ragged_list]) if ragged_list[0].scale is not None else None
+        data = torch.cat([x.values for x in ragged_list])
+        if all(x.index is None for x in ragged_list):
+            n_words = np.concatenate([x.n_words for x in ragged_list])
+            return RaggedEmbeddings(data, np.concatenate([[0], np.cumsum(n_words)]), scale)
+        # first row and first block of every container in the concatenation
+        n_rows = np.cumsum([0] + [x.offsets[-1] - x.offsets[0] for x in ragged_list])
+        n_blocks = np.cumsum([0] + [len(x.offsets) - 1 for x in ragged_list])
+        offsets = np.concatenate([x.offsets[:-1] - x.offsets[0] + n_rows[k] for k, x in enumerate(ragged_list)] +
+                                 [n_rows[-1:]])
+        index = np.concatenate([x.blocks + n_blocks[k] for k, x in enumerate(ragged_list)])
+        return RaggedEmbeddings(data, offsets, scale, index)
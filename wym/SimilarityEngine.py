@@ -0,0 +1,61 @@
+from typing import List, Tuple
+
+import torch
+
+
+class SimilarityEngine:
+    """Cosine similarity between the words of left and right records.
+
+    The word embeddings of every record are L2-normalized once and the whole words1 x words2 similarity
+    matrix of each record pair is obtained with a single batched matmul. The blocks needed by the pairing
+    passes (per attribute, cross attribute, duplicate) are then sliced out of it instead of being recomputed.
+    """
+
+    def __init__(self, left_emb: List[torch.Tensor], right_emb: List[torch.Tensor], eps: float = 1e-6,
+                 device: str = 'cpu'):
+        self.eps = eps
+        size = SimilarityEngine.emb_size(list(left_emb) + list(right_emb))
+        left, self.left_mask = SimilarityEngine.pad(left_emb, size=size, device=device)
+        right, self.right_mask = SimilarityEngine.pad(right_emb, size=size, device=device)
+        self.left_len = self.left_mask.sum(1).tolist()
+        self.right_len = self.right_mask.sum(1).tolist()
+        left = SimilarityEngine.normalize(left, eps)
+        right = SimilarityEngine.normalize(right, eps)
+        # padded positions are zero vectors, so their similarity is already 0
+        self.sim = torch.bmm(left, right.transpose(1, 2))
+
+    def __len__(self):
+        return self.sim.shape[0]
+
+    def __getitem__(self, item: int) -> torch.Tensor:
+        return self.sim[item, :self.left_len[item], :self.right_len[item]]
+
+    @staticmethod
+    def n_words(emb: torch.Tensor) -> int:
+        # empty records are stored as 1-d placeholders
+        return emb.shape[0] if emb is not None and emb.dim() == 2 else 0
+
+    @staticmethod
+    def normalize(emb: torch.Tensor, eps: float = 1e-6) -> torch.Tensor:
+        # same denominator as torch.nn.CosineSimilarity: max(||x||, eps)
+        return emb / emb.norm(dim=-1, keepdim=True).clamp(min=eps)
+
+    @staticmethod
+    def emb_size(emb_list: List[torch.Tensor]) -> int:
+        return next((emb.shape[1] for emb in emb_list if SimilarityEngine.n_words(emb) > 0), 1)
+
+    @staticmethod
+    def pad(emb_list: List[torch.Tensor], size: int = None, device: str = 'cpu') -> Tuple[torch.Tensor, torch.Tensor]:
+        lengths = [SimilarityEngine.n_words(emb) for emb in emb_list]
+        size = size if size is not None else SimilarityEngine.emb_size(emb_list)
+        padded = torch.zeros(len(emb_list), max(lengths + [1]), size, device=device)
+        mask = torch.zeros(len(emb_list), padded.shape[1], dtype=torch.bool, device=device)
+        for i, (emb, n) in enumerate(zip(emb_list, lengths)):
+            if n > 0:
+                padded[i, :n] = emb.to(device)
+                mask[i, :n] = True
+        return padded, mask
+
+    @staticmethod
+    def cos_sim(emb1: torch.Tensor, emb2: torch.Tensor, eps: float = 1e-6) -> torch.Tensor:
+        return SimilarityEngine.normalize(emb1, eps) @ SimilarityEngine.normalize(emb2, eps).T
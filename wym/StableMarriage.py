@@ -1,5 +1,7 @@
 from collections import deque
 
+import numpy as np
+
 
 def pref_to_rank(pref):
     return {
@@ -41,3 +43,114 @@ def gale_shapley(*, A, B, A_pref, B_pref):
                 pair[b] = a
     #
     return [(a, b) for b, a in pair.items()]
+
+
+def preference_ranks(sim_mat):
+    """Preferences of the rows and ranks given by the columns, both as integer arrays.
+
+    sim_mat -- array[n_a, n_b], higher is preferred.
+
+    Output: A_pref[a] lists the columns by decreasing preference, B_rank[b, a] is the position of a in the
+    preference list of b.
+    """
+    A_pref = np.argsort(-sim_mat)
+    B_pref = np.argsort(-sim_mat.T)
+    B_rank = np.empty(B_pref.shape, dtype=np.intp)
+    B_rank[np.arange(B_pref.shape[0])[:, None], B_pref] = np.arange(B_pref.shape[1])
+    return A_pref, B_rank
+
+
+def gale_shapley_array(A_pref, B_rank):
+    """Gale-Shapley on integer preference arrays, A proposes. len(A) must not exceed len(B).
+
+    A_pref -- array[n_a, n_b] of B indexes sorted by preference.
+    B_rank -- array[n_b, n_a] of ranks.
+
+    Output: array[n_a, 2] of (a, b) pairs.
+    """
+    n_a, n_b = A_pref.shape
+    next_choice = np.zeros(n_a, dtype=np.intp)
+    pair = np.full(n_b, -1, dtype=np.intp)
+    remaining_A = list(range(n_a))
+    while len(remaining_A) > 0:
+        a = remaining_A.pop()
+        b = A_pref[a, next_choice[a]]
+        next_choice[a] += 1
+        a0 = pair[b]
+        if a0 == -1:
+            pair[b] = a
+        elif B_rank[b, a] < B_rank[b, a0]:
+            pair[b] = a
+            remaining_A.append(a0)
+        else:
+            remaining_A.append(a)
+    matched_b = np.nonzero(pair >= 0)[0]
+    return np.stack([pair[matched_b], matched_b], 1)
+
+
+def stable_matching(sim_mat):
+    """Stable matching between the rows and the columns of a similarity matrix.
+
+    The smaller side proposes, as in WordPairGenerator.stable_marriage, so the matching is the same.
+
+    Output: array[min(n_rows, n_cols), 2] of (row, col) pairs.
+    """
+    sim_mat = np.asarray(sim_mat)
+    if sim_mat.shape[0] > sim_mat.shape[1]:
+        return gale_shapley_array(*preference_ranks(sim_mat.T))[:, [1, 0]]
+    return gale_shapley_array(*preference_ranks(sim_mat))
+
+
+def stable_matching_batch(sim_mats):
+    """stable_matching of many small problems solved together.
+
+    Problems are padded to a common size and all the free proposers of all the problems propose in the same
+    round (McVitie-Wilson), which gives the same proposer-optimal matching of the sequential algorithm.
+
+    sim_mats -- list of array[n_rows, n_cols].
+
+    Output: list of array[k, 2] of (row, col) pairs, one for each problem.
+    """
+    problems = [np.asarray(sim_mat) for sim_mat in sim_mats]
+    transposed = [sim_mat.shape[0] > sim_mat.shape[1] for sim_mat in problems]
+    problems = [sim_mat.T if t else sim_mat for sim_mat, t in zip(problems, transposed)]
+    n_problems = len(problems)
+    if n_problems == 0:
+        return []
+    n_a = np.array([x.shape[0] for x in problems], dtype=np.intp)
+    n_b = np.array([x.shape[1] for x in problems], dtype=np.intp)
+    max_a, max_b = max(n_a.max(), 1), max(n_b.max(), 1)
+    A_pref = np.zeros([n_problems, max_a, max_b], dtype=np.intp)
+    B_rank = np.full([n_problems, max_b, max_a], max_a, dtype=np.intp)
+    for p, sim_mat in enumerate(problems):
+        if sim_mat.size > 0:
+            # preferences are computed on the unpadded matrix to keep the same tie breaking
+            A_pref[p, :n_a[p], :n_b[p]], B_rank[p, :n_b[p], :n_a[p]] = preference_ranks(sim_mat)
+
+    next_choice = np.zeros([n_problems, max_a], dtype=np.intp)
+    engaged = np.full([n_problems, max_a], -1, dtype=np.intp)
+    pair = np.full([n_problems, max_b], -1, dtype=np.intp)
+    proposer = np.arange(max_a)[None, :] < n_a[:, None]
+    while True:
+        p, a = np.nonzero(proposer & (engaged == -1) & (next_choice < n_b[:, None]))
+        if len(p) == 0:
+            break
+        b = A_pref[p, a, next_choice[p, a]]
+        next_choice[p, a] += 1
+        rank = B_rank[p, b, a]
+        a0 = pair[p, b]
+        a0_rank = np.where(a0 >= 0, B_rank[p, b, np.maximum(a0, 0)], max_a + 1)
+        best_rank = np.full(n_problems * max_b, max_a + 1, dtype=np.intp)
+        np.minimum.at(best_rank, p * max_b + b, rank)
+        win = (rank == best_rank[p * max_b + b]) & (rank < a0_rank)
+        p, a, b, a0 = p[win], a[win], b[win], a0[win]
+        engaged[p[a0 >= 0], a0[a0 >= 0]] = -1
+        pair[p, b] = a
+        engaged[p, a] = b
+
+    res = []
+    for p in range(n_problems):
+        matched_b = np.nonzero(pair[p, :n_b[p]] >= 0)[0]
+        tmp_pairs = np.stack([pair[p, matched_b], matched_b], 1)
+        res.append(tmp_pairs[:, [1, 0]] if transposed[p] else tmp_pairs)
+    return res
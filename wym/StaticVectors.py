@@ -0,0 +1,101 @@
+import json
+import os
+from typing import List
+
+import numpy as np
+import torch
+
+
+class StaticVectors:
+    """Word to row table over a matrix of static word vectors, e.g. the ones of a gensim FastText model.
+
+    The matrix can be memory mapped from a directory written by save, so the processes using the same vectors share
+    the pages of one file instead of each holding a copy. Words out of the vocabulary are computed by oov (e.g. from
+    the character n-grams of FastText) the first time they are seen and appended to an in-process table. With oov_path
+    (a gensim KeyedVectors file, memory mapped too) oov is not pickled, the copies load it from oov_path again.
+    """
+
+    def __init__(self, vectors: np.ndarray, vocab: dict, oov=None, path: str = None, oov_path: str = None):
+        self.vectors = vectors
+        self.index = dict(vocab)
+        self.n_static = vectors.shape[0]
+        self.size = vectors.shape[1]
+        self.oov = oov
+        self.path = path
+        self.oov_path = oov_path
+        self.extra = np.zeros([0, self.size], dtype=np.float32)
+        self.n_extra = 0
+
+    def __getstate__(self):
+        # a memory mapped matrix is mapped again from path instead of being copied, and oov (usually a method of a
+        # whole model) is loaded again from oov_path when there is one
+        state = self.__dict__.copy()
+        if self.oov_path is not None:
+            state['oov'] = None
+        if self.path is not None:
+            state['vectors'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.vectors is None:
+            self.vectors = np.load(os.path.join(self.path, 'vectors.npy'), mmap_mode='r')
+
+    @staticmethod
+    def from_keyed_vectors(model) -> 'StaticVectors':
+        """Table over the vectors of a gensim KeyedVectors, the other words are looked up in the model."""
+        return StaticVectors(model.vectors, model.key_to_index, oov=model.__getitem__)
+
+    def save(self, path: str):
+        """Write the vocabulary vectors as vectors.npy and the words as vocab.json, see load."""
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'vectors.npy'), np.asarray(self.vectors, dtype=np.float32))
+        with open(os.path.join(path, 'vocab.json'), 'w') as file:
+            json.dump({word: row for word, row in self.index.items() if row < self.n_static}, file)
+
+    @staticmethod
+    def load(path: str, oov=None, oov_path: str = None) -> 'StaticVectors':
+        with open(os.path.join(path, 'vocab.json')) as file:
+            vocab = json.load(file)
+        return StaticVectors(np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r'), vocab, oov=oov, path=path,
+                             oov_path=oov_path)
+
+    @staticmethod
+    def load_oov(oov_path: str):
+        """Vectors of any word from the gensim KeyedVectors saved at oov_path, its arrays memory mapped."""
+        try:
+            from gensim.models import KeyedVectors
+        except ImportError as e:
+            raise ImportError('oov_path needs gensim: pip install gensim') from e
+        return KeyedVectors.load(oov_path, mmap='r').__getitem__
+
+    def add(self, words: List[str]):
+        """Compute the vectors of the words out of the vocabulary with oov and append them to the table."""
+        if self.oov is None and self.oov_path is not None:
+            self.oov = StaticVectors.load_oov(self.oov_path)
+        if self.oov is None:
+            raise KeyError(f'words not in the vocabulary: {words[:5]}')
+        vectors = np.asarray(self.oov(words), dtype=np.float32).reshape([len(words), self.size])
+        if self.n_extra + len(words) > self.extra.shape[0]:
+            extra = np.zeros([max(self.n_extra + len(words), 2 * self.extra.shape[0]), self.size], dtype=np.float32)
+            extra[:self.n_extra] = self.extra[:self.n_extra]
+            self.extra = extra
+        self.extra[self.n_extra:self.n_extra + len(words)] = vectors
+        for word in words:
+            self.index[word] = self.n_static + self.n_extra
+            self.n_extra += 1
+
+    def rows(self, words: List[str]) -> np.ndarray:
+        missing = [word for word in dict.fromkeys(words) if word not in self.index]
+        if len(missing) > 0:
+            self.add(missing)
+        return np.fromiter((self.index[word] for word in words), dtype=np.int64, count=len(words))
+
+    def lookup(self, words: List[str]) -> torch.Tensor:
+        """[len(words), size] float32 vectors of the words, gathered with one indexing of each table."""
+        rows = self.rows(words)
+        out = np.empty([len(rows), self.size], dtype=np.float32)
+        static = rows < self.n_static
+        out[static] = self.vectors[rows[static]]
+        out[~static] = self.extra[rows[~static] - self.n_static]
+        return torch.from_numpy(out)
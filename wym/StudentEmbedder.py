@@ -0,0 +1,118 @@
+import json
+import os
+from typing import List
+
+import numpy as np
+import pandas as pd
+import torch
+from torch import nn
+from tqdm.autonotebook import tqdm
+from transformers import BertConfig, BertModel
+
+from .WordEmbedding import WordEmbedding
+
+
+class StudentEmbedder(nn.Module):
+    """Small BERT encoder trained to reproduce the token embeddings of a WordEmbedding, its teacher.
+
+    The last hidden state is projected to the size of the teacher, so the student is a drop-in replacement for the
+    layer mean of the teacher: load it with WordEmbedding(backend='student', backend_path=path). It uses the
+    tokenizer of the teacher.
+    """
+
+    def __init__(self, config: BertConfig, output_size: int = 768):
+        super().__init__()
+        self.config = config
+        self.output_size = output_size
+        self.encoder = BertModel(config, add_pooling_layer=False)
+        self.projection = nn.Linear(config.hidden_size, output_size)
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor,
+                token_type_ids: torch.Tensor) -> torch.Tensor:
+        hidden_state = self.encoder(input_ids, attention_mask, token_type_ids, return_dict=False)[0]
+        return self.projection(hidden_state)
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        self.config.save_pretrained(path)
+        with open(os.path.join(path, 'student.json'), 'w') as file:
+            json.dump({'output_size': self.output_size}, file)
+        torch.save(self.state_dict(), os.path.join(path, 'student.pt'))
+
+    @staticmethod
+    def load(path: str, device='cpu') -> 'StudentEmbedder':
+        with open(os.path.join(path, 'student.json')) as file:
+            output_size = json.load(file)['output_size']
+        student = StudentEmbedder(BertConfig.from_pretrained(path), output_size)
+        student.load_state_dict(torch.load(os.path.join(path, 'student.pt'), map_location=device))
+        return student.to(device).eval()
+
+    @staticmethod
+    def from_teacher(teacher: WordEmbedding, num_layers: int = 4, hidden_size: int = 384) -> 'StudentEmbedder':
+        """Student with the vocabulary of the teacher, its token and position embeddings initialized with the top
+        hidden_size principal components of the ones of the teacher and the projection mapping them back."""
+        teacher_config = teacher.model.config
+        config = BertConfig(vocab_size=teacher_config.vocab_size, hidden_size=hidden_size,
+                            num_hidden_layers=num_layers, num_attention_heads=max(1, hidden_size // 64),
+                            intermediate_size=4 * hidden_size,
+                            max_position_embeddings=teacher_config.max_position_embeddings,
+                            type_vocab_size=teacher_config.type_vocab_size)
+        student = StudentEmbedder(config, teacher_config.hidden_size)
+        embeddings = teacher.model.embeddings
+        with torch.no_grad():
+            word_embeddings = embeddings.word_embeddings.weight.detach().cpu()
+            # a small vocabulary has fewer components, the other dimensions keep their random initialization
+            n_components = min(hidden_size, *word_embeddings.shape)
+            _, _, components = torch.pca_lowrank(word_embeddings, q=n_components)
+            student.encoder.embeddings.word_embeddings.weight[:, :n_components] = word_embeddings @ components
+            student.encoder.embeddings.position_embeddings.weight[:, :n_components] = \
+                embeddings.position_embeddings.weight.detach().cpu() @ components
+            student.projection.weight.zero_()
+            student.projection.weight[:, :n_components] = components
+            student.projection.bias.zero_()
+        return student
+
+    @staticmethod
+    def distill(teacher: WordEmbedding, dfs: List[pd.DataFrame], path: str = None, num_layers: int = 4,
+                hidden_size: int = 384, epochs: int = 3, batch_size: int = 32, lr: float = 1e-4,
+                max_length: int = 128, verbose: bool = True, seed: int = 0) -> 'StudentEmbedder':
+        """Train a student on CPU on the records of dfs (tables with one record per row, as given to
+        WordEmbedding.generate_embedding) and save it to path.
+
+        The loss is the mean squared error plus the cosine distance between the token embeddings of the student and
+        the ones of the teacher, over the tokens that are not padding. Records are cut at max_length tokens.
+        """
+        assert teacher.model is not None, 'the teacher must be an eager WordEmbedding'
+        rng = np.random.RandomState(seed)
+        torch.manual_seed(seed)
+        sentences = pd.concat([df[np.setdiff1d(df.columns, ['id'])].apply(WordEmbedding.get_words_to_embed, 1)
+                               for df in dfs])
+        sentences = np.unique([sentence.lower() for sentence in sentences if isinstance(sentence, str)])
+        student = StudentEmbedder.from_teacher(teacher, num_layers, hidden_size).train()
+        optimizer = torch.optim.AdamW(student.parameters(), lr=lr)
+        student.losses = []
+        for epoch in range(epochs):
+            order = rng.permutation(len(sentences))
+            batches = [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+            epoch_loss = 0
+            for batch in tqdm(batches, desc=f'Distillation epoch {epoch}') if verbose else batches:
+                tokens = teacher.tokenizer([sentence.split() for sentence in sentences[batch]],
+                                           is_split_into_words=True, padding=True, truncation=True,
+                                           max_length=max_length, return_tensors='pt')
+                target = teacher.get_token_embeddings(tokens).cpu()
+                output = student(tokens['input_ids'], tokens['attention_mask'], tokens['token_type_ids'])
+                mask = tokens['attention_mask'].bool()
+                output, target = output[mask], target[mask]
+                loss = nn.functional.mse_loss(output, target) + \
+                       (1 - nn.functional.cosine_similarity(output, target, dim=-1)).mean()
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+                epoch_loss += loss.item() * len(batch)
+            student.losses.append(epoch_loss / len(sentences))
+            if verbose:
+                print(f'epoch {epoch}: loss {student.losses[-1]:.4f}')
+        student = student.eval()
+        if path is not None:
+            student.save(path)
+        return student
@@ -1,13 +1,52 @@
+import atexit
 import gc
+import os
+import pickle
+import threading
+import weakref
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import get_context
 from typing import Tuple, Union, List
 
 import numpy as np
 import pandas as pd
 import torch
 from tqdm.autonotebook import tqdm
-from transformers import BertModel, BertTokenizer
+from transformers import BertConfig, BertModel, BertTokenizerFast
 import copy
 
+from .EmbeddingBackend import EmbeddingBackend
+from .EmbeddingCache import EmbeddingCache
+from .EmbeddingStore import EmbeddingStore
+from .RaggedEmbeddings import RaggedEmbeddings
+
+
+class EarlyExit(Exception):
+    """Raised once the last averaged hidden state is computed, the later layers are not run."""
+
+
+_worker_we = None
+# WordEmbeddings holding a worker pool, see get_worker_pool
+_worker_pool_owners = weakref.WeakSet()
+
+
+@atexit.register
+def close_worker_pools():
+    for we in list(_worker_pool_owners):
+        we.close_worker_pool()
+
+
+def init_embedding_worker(we_state: bytes, n_threads: int):
+    global _worker_we
+    torch.set_num_threads(n_threads)
+    _worker_we = pickle.loads(we_state)
+
+
+def embedding_worker(task):
+    shard, sentences = task
+    return shard, _worker_we.embed_backoff(sentences)
+
 
 def check_memory():
     print('GPU memory: %.1f MB' % (torch.cuda.memory_allocated() // 1024 ** 2))
@@ -15,69 +54,236 @@ def check_memory():
 
 class WordEmbedding():
 
-    def __init__(self, device='auto', verbose=False, model_path='bert-base-uncased', sentence_embedding=False):
+    def __init__(self, device='auto', verbose=False, model_path='bert-base-uncased', sentence_embedding=False,
+                 layers=(2, 12), cache_bytes=0, store_path=None, model_id=None, storage_dtype=None, backend='eager',
+                 backend_path=None, window=None, window_overlap=None, depth=None, attribute_scope=False,
+                 tokenizer_path='bert-base-uncased'):
         self.sentence_embedding = sentence_embedding
-        self.model = BertModel.from_pretrained(model_path, output_hidden_states=True)  # , from_flax=True
+        # with depth the encoder stops after layer depth and the hidden states from layers[0] on are averaged
+        self.layers = layers if depth is None else (min(layers[0], depth), depth + 1)
+        # records of more than window tokens are embedded in windows overlapping by window_overlap tokens
+        self.window = window
+        self.window_overlap = window_overlap if window_overlap is not None or window is None else window // 4
+        # dtype of the word embeddings at rest, one of RaggedEmbeddings.storage_dtypes (None is float32)
+        self.storage_dtype = storage_dtype
+        # every attribute value embedded on its own, the values repeat so they are cached (256 MiB by default)
+        self.attribute_scope = attribute_scope
+        if attribute_scope and cache_bytes == 0:
+            cache_bytes = 2 ** 28
+        # embeddings of the records already seen, off by default
+        self.cache = EmbeddingCache(cache_bytes) if cache_bytes > 0 else None
         # Set the device to GPU (cuda) if available, otherwise stick with CPU
         if device == 'auto':
             self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
         else:
             self.device = device
-        self.model = self.model.to(self.device)
-        self.model = self.model.eval()
-        self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+        if backend == 'eager':
+            self.model = BertModel.from_pretrained(model_path, output_hidden_states=True)  # , from_flax=True
+            self.model = self.model.to(self.device)
+            self.model = self.model.eval()
+            self.size = self.model.config.hidden_size
+            self.backend = None
+        else:
+            # graph exported with EmbeddingBackend.export (see export) or distilled student, it replaces the layer mean
+            self.model = None
+            self.device = 'cpu'
+            self.backend = EmbeddingBackend(backend, backend_path)
+            self.size = self.backend.module.output_size if backend == 'student' else BertConfig.from_pretrained(
+                model_path).hidden_size
+        self.tokenizer = BertTokenizerFast.from_pretrained(tokenizer_path)
+        self.tokenizer_lock = threading.Lock()
         self.verbose = verbose
+        # embeddings kept on disk across runs, model_id tells apart the embeddings of different models
+        if model_id is None:
+            model_id = f'{model_path}:layers{self.layers[0]}-{self.layers[1]}' + (':sentence' if sentence_embedding else '') + \
+                       (f':{backend}:{backend_path}' if backend != 'eager' else '') + \
+                       (f':window{self.window}-{self.window_overlap}' if window is not None else '')
+        self.model_id = model_id
+        self.store = EmbeddingStore(store_path, model_id, self.size) if store_path else None
+        # processes of the sharded embedding, see get_worker_pool
+        self.worker_pool = None
+        self.worker_pool_args = None
+
+    def __getstate__(self):
+        # copy sent to the workers of the sharded embedding, the cache and the store stay in the main process
+        state = self.__dict__.copy()
+        state.update(cache=None, store=None, worker_pool=None, worker_pool_args=None, tokenizer_lock=None)
+        if self.store is not None:
+            # the rows come back in float32, the store of the main process keeps them as computed
+            state['storage_dtype'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.tokenizer_lock = threading.Lock()
 
     def get_word_embeddings(self, sentences: List[float]):
-        tokens = self.tokenizer(sentences, padding=True, return_tensors='pt')
-        detected_tokens = [self.tokenizer.convert_ids_to_tokens(x) for x in tokens['input_ids']]
-        token_emb = self.get_token_embeddings(tokens)
-        word_token_maps, words_lists = [], []
-        for x, sentence in zip(detected_tokens, sentences):
-            tmp_map, tmp_words = WordEmbedding.map_token_to_word(x, sentence)
-            word_token_maps.append(tmp_map)
-            words_lists.append(tmp_words)
-        word_embeddings = []
-
-        for i, map in enumerate(word_token_maps):
-            aggregated_emb = [torch.mean(token_emb[i, map[word_pos]], 0) for word_pos, word in
-                              enumerate(words_lists[i])]
-            word_embeddings.append(torch.stack(aggregated_emb))
+        word_token_maps, words_lists, tokens, windows = self.tokenize(sentences)
+        return self.pool_tokens(self.get_token_embeddings(tokens), word_token_maps, words_lists, windows)
+
+    def pool_tokens(self, token_emb: torch.Tensor, word_token_maps: list, words_lists: list, windows: list = None):
+        word_embeddings = WordEmbedding.pool_words(token_emb, word_token_maps, words_lists)
+        sentence_embeddings = torch.mean(token_emb, 1) if self.sentence_embedding else None
+        if windows is not None:
+            word_embeddings, words_lists, sentence_embeddings = WordEmbedding.stitch_windows(
+                windows, word_embeddings, sentence_embeddings)
 
         if self.sentence_embedding:
-            sentence_embeddings = torch.mean(token_emb, 1)
             return word_embeddings, words_lists, sentence_embeddings
         return word_embeddings, words_lists
 
+    def export(self, path: str, backend: str = 'torchscript', quantize: bool = True) -> str:
+        """Export the token embeddings of the eager model for WordEmbedding(backend=backend, backend_path=path)."""
+        return EmbeddingBackend.export(self.model, path, kind=backend, layers=self.layers, quantize=quantize)
+
     def get_token_embeddings(self, token_list):
-        with torch.no_grad():
-            # check_memory()
-            # # model = copy.deepcopy(self.model)
-            # try:
-            #     outputs = self.model(token_list['input_ids'].to(self.device),
-            #                      token_list['attention_mask'].to(self.device),
-            #                      token_list['token_type_ids'].to(self.device))
-            #     check_memory()
-            # except Exception as e:
-            #     check_memory()
-            #     raise e
-            outputs = self.model(token_list['input_ids'].to(self.device),
-                                 token_list['attention_mask'].to(self.device),
-                                 token_list['token_type_ids'].to(self.device))
-            # Evaluating the model will return a different number of objects based on
-            # how it's  configured in the `from_pretrained` call earlier. In this case,
-            # becase we set `output_hidden_states = True`, the third item will be the
-            # hidden states from all layers. See the documentation for more details:
-            # https://huggingface.co/transformers/model_doc/bert.html#bertmodel
-            hidden_states = outputs[2]
-            # outputs.detach()
-
-        token_embeddings = torch.stack(hidden_states, dim=0)
-        # token_embeddings = torch.squeeze(token_embeddings, dim=1)
-        token_embeddings = token_embeddings.permute(0, 1, 2, 3)  # layers, sentences, words, weights
-        token_vecs_sum = torch.mean(token_embeddings[2:12], 0)  # I chose to use the mean instead of sum
-
-        return token_vecs_sum
+        """Mean of the hidden states layers[0]..layers[1] - 1, hidden state 0 being the output of the embeddings.
+
+        The wanted hidden states are added up by forward hooks as the model produces them, so the stack of all the
+        hidden states is never built, and the forward pass stops after the last one.
+        """
+        if self.backend is not None:
+            return self.backend(*[token_list[name] for name in EmbeddingBackend.input_names])
+        first, last = self.layers
+        modules = ([self.model.embeddings] + list(self.model.encoder.layer))[first:last]
+        layer_sum = []
+
+        def add_layer(module, input, output):
+            output = output[0] if isinstance(output, tuple) else output
+            if len(layer_sum) == 0:
+                layer_sum.append(output.clone())
+            else:
+                layer_sum[0] += output
+            if module is modules[-1]:
+                raise EarlyExit
+
+        handles = [module.register_forward_hook(add_layer) for module in modules]
+        try:
+            with torch.no_grad():
+                self.model(token_list['input_ids'].to(self.device),
+                           token_list['attention_mask'].to(self.device),
+                           token_list['token_type_ids'].to(self.device), output_hidden_states=False)
+        except EarlyExit:
+            pass
+        finally:
+            for handle in handles:
+                handle.remove()
+        return layer_sum[0] / len(modules)
+
+    @staticmethod
+    def pool_words(token_emb: torch.Tensor, word_token_maps: List[dict], words_lists: List[list]) -> List[torch.Tensor]:
+        """Mean of the token embeddings of every word, as one segment-mean over the tokens of the whole batch."""
+        n_words = [len(words) for words in words_lists]
+        token_lists = [word_token_maps[i][word_pos] for i in range(len(words_lists)) for word_pos in range(n_words[i])]
+        lengths = [len(tokens) for tokens in token_lists]
+        device = token_emb.device
+        # flat (sentence, token) index of every token and the word it is pooled into
+        sentence_idx = torch.from_numpy(np.repeat(np.repeat(np.arange(len(n_words)), n_words), lengths)).to(device)
+        token_idx = torch.tensor(list(chain.from_iterable(token_lists)), dtype=torch.long, device=device)
+        word_idx = torch.from_numpy(np.repeat(np.arange(len(lengths)), lengths)).to(device)
+        word_emb = torch.zeros(len(lengths), token_emb.shape[-1], dtype=token_emb.dtype, device=device)
+        word_emb.index_add_(0, word_idx, token_emb[sentence_idx, token_idx])
+        # a word left without tokens (cut by truncation) gets zeros instead of NaN
+        word_emb /= torch.tensor(lengths, dtype=token_emb.dtype, device=device).clamp(min=1).unsqueeze(1)
+        return list(torch.split(word_emb, n_words))
+
+    def tokenize(self, sentences: List[str]):
+        """Tokenize the sentences split on whitespace, the fast tokenizer tells the word of every token.
+
+        With window the sentences longer than window tokens are cut in windows (see window_words), which are
+        tokenized as sentences of their own. windows lists the words of every sentence and its windows as (position
+        in the batch, first word) pairs, it is None without window.
+        The words the tokenizer reduces to no token, e.g. zero width spaces and other format characters, are
+        tokenized as [UNK].
+        """
+        words_lists = [sentence.lower().split() for sentence in sentences]
+        windows = None
+        if self.window is not None:
+            word_ids = self.tokenize_words(words_lists, add_special_tokens=False)
+            windows, pieces = [], []
+            for i, words in enumerate(words_lists):
+                counts = np.bincount(word_ids.word_ids(i), minlength=len(words)) if len(words) > 0 else []
+                # the words without tokens count as the [UNK] they are tokenized as
+                counts = np.maximum(counts, 1)
+                spans = WordEmbedding.window_words(counts, self.window - 2, self.window_overlap)
+                windows.append((words + ['[SEP]'], [(len(pieces) + k, start) for k, (start, _) in enumerate(spans)]))
+                pieces += [words[start:end] for start, end in spans]
+            words_lists = pieces
+        # a single word longer than the window is truncated
+        tokens = self.tokenize_words(words_lists, padding=True, truncation=self.window is not None,
+                                     max_length=self.window, return_tensors='pt')
+        word_token_maps = [WordEmbedding.map_word_ids(tokens.word_ids(i), len(words)) for i, words in
+                           enumerate(words_lists)]
+        if any(len(word_map[pos]) == 0 for word_map, words in zip(word_token_maps, words_lists)
+               for pos in range(len(words))):
+            inputs = [[word if len(word_map[pos]) > 0 else '[UNK]' for pos, word in enumerate(words)]
+                      for word_map, words in zip(word_token_maps, words_lists)]
+            tokens = self.tokenize_words(inputs, padding=True, truncation=self.window is not None,
+                                         max_length=self.window, return_tensors='pt')
+            word_token_maps = [WordEmbedding.map_word_ids(tokens.word_ids(i), len(words)) for i, words in
+                               enumerate(words_lists)]
+        words_lists = [words + ['[SEP]'] for words in words_lists]
+        return word_token_maps, words_lists, tokens, windows
+
+    def tokenize_words(self, words_lists: List[List[str]], **kwargs):
+        """The tokenizer on lists of words, one thread at a time: the fast tokenizer cannot be used by two threads at
+        once ("Already borrowed"), which embed_pipelined does when a batch runs out of memory."""
+        with self.tokenizer_lock:
+            return self.tokenizer(words_lists, is_split_into_words=True, **kwargs)
+
+    @staticmethod
+    def window_words(token_counts, max_tokens: int, overlap: int) -> List[Tuple[int, int]]:
+        """Spans of words of at most max_tokens tokens covering the words of a sentence, the next span starts back
+        by up to overlap tokens. token_counts is the number of tokens of every word."""
+        n_words = len(token_counts)
+        spans, start = [], 0
+        while True:
+            end, n_tokens = start, 0
+            while end < n_words and n_tokens + token_counts[end] <= max_tokens:
+                n_tokens += token_counts[end]
+                end += 1
+            end = max(end, min(start + 1, n_words))
+            spans.append((start, end))
+            if end >= n_words:
+                return spans
+            # the overlap leaves room for the first new word
+            next_start, n_tokens = end, 0
+            while next_start - 1 > start and n_tokens + token_counts[next_start - 1] <= min(
+                    overlap, max_tokens - token_counts[end]):
+                next_start -= 1
+                n_tokens += token_counts[next_start]
+            start = next_start
+
+    @staticmethod
+    def stitch_windows(windows: list, word_embeddings: List[torch.Tensor], sentence_embeddings: torch.Tensor = None):
+        """Word embeddings, words and sentence embeddings of the sentences from the ones of their windows, the words
+        in more windows and [SEP] get the mean of their embeddings."""
+        stitched, stitched_sentences = [], []
+        for words, pieces in windows:
+            emb = torch.zeros(len(words), word_embeddings[0].shape[1], dtype=word_embeddings[0].dtype,
+                              device=word_embeddings[0].device)
+            counts = torch.zeros(len(words), dtype=emb.dtype, device=emb.device)
+            for piece, start in pieces:
+                n_words = word_embeddings[piece].shape[0] - 1
+                emb[start:start + n_words] += word_embeddings[piece][:n_words]
+                counts[start:start + n_words] += 1
+                emb[-1] += word_embeddings[piece][-1]
+                counts[-1] += 1
+            stitched.append(emb / counts.unsqueeze(1))
+            if sentence_embeddings is not None:
+                stitched_sentences.append(sentence_embeddings[[piece for piece, _ in pieces]].mean(0))
+        return stitched, [words for words, _ in windows], \
+            torch.stack(stitched_sentences) if sentence_embeddings is not None else None
+
+    @staticmethod
+    def map_word_ids(word_ids: List[int], n_words: int) -> dict:
+        """Tokens of every word from the word_ids of a sentence, the [SEP] token is the word after the last one."""
+        words_map = {x: [] for x in range(n_words + 1)}
+        for token_pos, word_pos in enumerate(word_ids):
+            if word_pos is not None:
+                words_map[word_pos].append(token_pos)
+        words_map[n_words] = [word_ids.index(None, 1)]
+        return words_map
 
     @staticmethod
     def map_token_to_word(detected_tokens, sentence=None):
@@ -130,74 +336,366 @@ class WordEmbedding():
         else:
             return None
 
-    def get_embedding_df(self, df: pd.DataFrame) -> Union[Tuple[np.array, list], Tuple[np.array, list, np.array]]:
+    @property
+    def sentence_dtype(self) -> torch.dtype:
+        # the sentence embeddings have no int8 scales, they are kept in float16 instead
+        return torch.float16 if self.storage_dtype == 'int8' else RaggedEmbeddings.storage_dtypes[
+            self.storage_dtype if self.storage_dtype is not None else 'float32']
+
+    def make_record(self, emb: RaggedEmbeddings, words: list, sentence_emb: torch.Tensor = None) -> tuple:
+        """Embeddings of one record in the storage dtype: a RaggedEmbeddings of the record, its words and its sentence
+        embedding when they are on."""
+        if emb.data.dtype != RaggedEmbeddings.storage_dtypes[self.storage_dtype or 'float32']:
+            emb = emb.astype(self.storage_dtype)
+        if self.sentence_embedding:
+            return emb, words, sentence_emb.to(self.sentence_dtype)
+        return emb, words
+
+    def lookup(self, sentence: str):
+        """Embeddings of a record found in the cache or in the store, None if it has to be embedded."""
+        record = self.cache.get(sentence) if self.cache is not None else None
+        if record is None and self.store is not None:
+            record = self.store.get(sentence)
+            if record is not None:
+                record = self.make_record(RaggedEmbeddings.from_list([record[0]], self.size), *record[1:])
+                if self.cache is not None:
+                    self.cache.put(sentence, record)
+        return record
+
+    def embed_sentences(self, sentences: List[str]) -> Tuple[RaggedEmbeddings, list, torch.Tensor]:
+        """Word embeddings in the storage dtype, words up to [SEP] and sentence embeddings (None when they are off) of
+        the sentences."""
+        return self.pack_word_embeddings(self.get_word_embeddings(sentences))
+
+    def pack_word_embeddings(self, res: tuple) -> Tuple[RaggedEmbeddings, list, torch.Tensor]:
+        """The output of get_word_embeddings as returned by embed_sentences, in float32 with a store (finish_records
+        casts the rows once they are stored)."""
+        last_index = [words.index('[SEP]') for words in res[1]]
+        emb = RaggedEmbeddings.from_list([emb[:last].cpu() for emb, last in zip(res[0], last_index)], self.size)
+        if self.store is None:
+            emb = emb.astype(self.storage_dtype)
+        words = [words[:last] for words, last in zip(res[1], last_index)]
+        return emb, words, res[2].cpu() if self.sentence_embedding else None
+
+    @staticmethod
+    def is_out_of_memory(e: BaseException) -> bool:
+        return isinstance(e, (MemoryError, torch.cuda.OutOfMemoryError)) or "can't allocate memory" in str(e)
+
+    def embed_backoff(self, sentences: List[str]) -> Tuple[RaggedEmbeddings, list, torch.Tensor]:
+        """embed_sentences, the sentences are split in halves and embedded again when the memory runs out."""
+        try:
+            return self.embed_sentences(sentences)
+        except (RuntimeError, MemoryError) as e:
+            if len(sentences) == 1 or not WordEmbedding.is_out_of_memory(e):
+                raise
+        return self.embed_halves(sentences)
+
+    def embed_halves(self, sentences: List[str]) -> Tuple[RaggedEmbeddings, list, torch.Tensor]:
+        """embed_backoff of each half of the sentences, after running out of memory on all of them."""
+        gc.collect()
+        torch.cuda.empty_cache()
+        if self.verbose:
+            print(f'Out of memory embedding {len(sentences)} records, retrying in halves')
+        half = len(sentences) // 2
+        parts = [self.embed_backoff(sentences[:half]), self.embed_backoff(sentences[half:])]
+        return RaggedEmbeddings.concatenate([part[0] for part in parts]), parts[0][1] + parts[1][1], \
+            torch.cat([part[2] for part in parts]) if self.sentence_embedding else None
+
+    def get_worker_pool(self, n_workers: int, n_threads: int = None):
+        """Pool of n_workers spawned processes, each with its own copy of this WordEmbedding and n_threads torch
+        threads (the cores split evenly by default).
+
+        The pool is kept for the next calls with the same arguments, the copies are made when it is created. It is
+        closed by close_worker_pool, or at exit.
+        """
+        n_threads = n_threads if n_threads is not None else max(1, (os.cpu_count() or 1) // n_workers)
+        if self.worker_pool_args != (n_workers, n_threads):
+            self.close_worker_pool()
+            # spawned workers, forking after torch has started its thread pools can deadlock
+            self.worker_pool = get_context('spawn').Pool(n_workers, initializer=init_embedding_worker,
+                                                         initargs=(pickle.dumps(self), n_threads))
+            self.worker_pool_args = (n_workers, n_threads)
+            _worker_pool_owners.add(self)
+        return self.worker_pool
+
+    def close_worker_pool(self):
+        if self.worker_pool is not None:
+            self.worker_pool.close()
+            self.worker_pool.join()
+        self.worker_pool = None
+        self.worker_pool_args = None
+        _worker_pool_owners.discard(self)
+
+    def embed_sharded(self, sentences: List[str], n_workers: int, n_threads: int = None, chunk_size: int = 500,
+                      token_budget: int = None,
+                      memory_budget: int = None) -> Tuple[RaggedEmbeddings, list, torch.Tensor]:
+        """embed_backoff on the processes of get_worker_pool.
+
+        The sentences are sorted by token length and cut in shards of token_budget padded tokens (or memory_budget
+        bytes, see generate_embedding), or of chunk_size sentences without a budget. The workers take the shards from
+        a queue, the longest first, and the results are put back in the order of the sentences.
+        """
+        lengths = self.sentence_lengths(np.array(sentences, dtype=object))
+        if memory_budget is not None:
+            shards = WordEmbedding.length_batches(lengths, memory_budget, self.activation_bytes)
+        elif token_budget is not None:
+            shards = WordEmbedding.length_batches(lengths, token_budget)
+        else:
+            order = np.argsort(lengths, kind='stable')
+            shards = [order[start:start + chunk_size] for start in range(0, len(order), chunk_size)]
+        tasks = [(shard, [sentences[i] for i in shards[shard]]) for shard in reversed(range(len(shards)))]
+        results = [None] * len(shards)
+        to_cycle = self.get_worker_pool(n_workers, n_threads).imap_unordered(embedding_worker, tasks)
+        if self.verbose:
+            to_cycle = tqdm(to_cycle, total=len(tasks))
+        for shard, res in to_cycle:
+            results[shard] = res
+        # position in the shards of every sentence
+        inverse = np.argsort(np.concatenate(shards), kind='stable')
+        emb = RaggedEmbeddings.concatenate([res[0] for res in results])[inverse]
+        words = list(chain.from_iterable(res[1] for res in results))
+        sentence_emb = torch.cat([res[2] for res in results])[torch.from_numpy(inverse)] \
+            if self.sentence_embedding else None
+        return emb, [words[i] for i in inverse], sentence_emb
+
+    def plan_records(self, df: pd.DataFrame) -> Tuple[list, dict, int]:
+        """Records of df found in the cache or the store (empty ones for missing sentences, None for the others), the
+        sentences to embed, mapped to their positions, and the number of records making a row of df.
+
+        The same text is embedded once when the cache or the store is on. With attribute_scope the records are the
+        values of the attributes of every row, in the order of get_words_to_embed.
+        """
         columns = np.setdiff1d(df.columns, ['id'])
         #df = df.replace('None', np.nan).replace('nan', np.nan)
-        sentences = df[columns].apply(WordEmbedding.get_words_to_embed, 1)
-        not_None_sentences = [x for x in sentences if x is not None]
-        # display(not_None_sentences)
-        if len(not_None_sentences) > 0:
-            if self.sentence_embedding:
-                tmp_emb_all, tmp_words, tmp_sentences = self.get_word_embeddings(not_None_sentences)
-            else:
-                tmp_emb_all, tmp_words = self.get_word_embeddings(not_None_sentences)
-        # display(tmp_words)
-        emb_all, words, sentences_emb = [], [], []
-        index = 0
-        for i in sentences:
-            if i is None:
-                emb_all.append(torch.tensor([0]).to('cpu'))
-                if self.sentence_embedding:
-                    sentences_emb.append(torch.tensor([0]).to('cpu'))
-                words.append(['[SEP]'])
-            else:
-                emb_all.append(tmp_emb_all[index].to('cpu'))
-                words.append(tmp_words[index])
-                if self.sentence_embedding:
-                    sentences_emb.append(tmp_sentences[index].to('cpu'))
-                index += 1
-
-        words_cut = []
-        emb_cut = []
-        for i, word_list in enumerate(words):
-            last_index = word_list.index('[SEP]')
-            words_cut.append(word_list[:last_index])
-            emb_cut.append(emb_all[i][:last_index].cpu())
-            # assert len(word_list[:last_index])> 0
-        emb_all = np.array(emb_cut, dtype=object)
+        if self.attribute_scope:
+            values = df[columns].values.ravel()
+            sentences = [' '.join(str(value).split()) if pd.notna(value) else None for value in values]
+            sentences = [sentence if sentence else None for sentence in sentences]
+        else:
+            sentences = df[columns].apply(WordEmbedding.get_words_to_embed, 1)
+        if self.store is not None:
+            self.store.refresh()
+        records = [None] * len(sentences)
+        to_embed = {}
+        for i, sentence in enumerate(sentences):
+            if not isinstance(sentence, str):
+                records[i] = self.make_record(RaggedEmbeddings.from_list([torch.zeros(0, self.size)], self.size), [],
+                                              torch.zeros(self.size))
+                continue
+            records[i] = self.lookup(sentence)
+            if records[i] is not None:
+                continue
+            key = i if self.cache is None and self.store is None else EmbeddingCache.key(sentence)
+            to_embed.setdefault(key, (sentence, []))[1].append(i)
+        return records, to_embed, len(columns) if self.attribute_scope else 1
 
+    def finish_records(self, records: list, to_embed: dict, embedded: tuple = None, group: int = 1) -> Union[
+        Tuple[RaggedEmbeddings, list], Tuple[RaggedEmbeddings, list, torch.Tensor]]:
+        """Fill the records of plan_records with the output of embed_sentences for to_embed, cache and store them and
+        pack the records, joining every group of consecutive ones (see group_records)."""
+        if len(to_embed) > 0:
+            new_emb, new_words, new_sentence_emb = embedded
+            if self.store is not None:
+                # the store keeps the float32 rows, whatever the storage dtype of this run
+                for index, (sentence, _) in enumerate(to_embed.values()):
+                    self.store.put(sentence, (new_emb[index], new_words[index],
+                                              new_sentence_emb[index] if self.sentence_embedding else None))
+                new_emb = new_emb.astype(self.storage_dtype)
+            for index, (sentence, positions) in enumerate(to_embed.values()):
+                sentence_emb = new_sentence_emb[index] if self.sentence_embedding else None
+                record = self.make_record(new_emb[index:index + 1], new_words[index], sentence_emb)
+                if self.cache is not None:
+                    # a copy, the cache must not keep the whole batch alive
+                    self.cache.put(sentence, (new_emb[[index]],) + record[1:])
+                for i in positions:
+                    records[i] = record
+
+        emb_all = RaggedEmbeddings.concatenate([record[0] for record in records])
+        words_cut = [record[1] for record in records]
+        sentences_emb = torch.stack([record[2] for record in records]) if self.sentence_embedding else None
+        if group > 1:
+            emb_all, words_cut, sentences_emb = WordEmbedding.group_records(emb_all, words_cut, sentences_emb, group)
         if self.sentence_embedding:
-            sentences_emb = np.array(sentences_emb, dtype=object)
             return emb_all, words_cut, sentences_emb
         else:
             return emb_all, words_cut
 
-    def generate_embedding(self, df: pd.DataFrame, chunk_size: int = 500) -> Union[
-        Tuple[list, list, list], Tuple[list, list]]:
+    @staticmethod
+    def group_records(emb: RaggedEmbeddings, words: list, sentence_emb: torch.Tensor = None, group: int = 1):
+        """Join every group of consecutive records in one: their words in order and the mean sentence embedding of the
+        ones with words (zeros for none)."""
+        # the rows of consecutive records are contiguous, only the offsets change
+        grouped_emb = RaggedEmbeddings(emb.data, emb.offsets[::group], emb.scale)
+        grouped_words = [list(chain.from_iterable(words[start:start + group])) for start in range(0, len(words), group)]
+        if sentence_emb is not None:
+            mask = torch.from_numpy(emb.n_words > 0).reshape([-1, group, 1])
+            sentences = sentence_emb.float().reshape([-1, group, sentence_emb.shape[-1]])
+            sentence_emb = ((sentences * mask).sum(1) / mask.sum(1).clamp(min=1)).to(sentence_emb.dtype)
+        return grouped_emb, grouped_words, sentence_emb
+
+    def get_embedding_df(self, df: pd.DataFrame, n_workers: int = None, **shard_args) -> Union[
+        Tuple[RaggedEmbeddings, list], Tuple[RaggedEmbeddings, list, torch.Tensor]]:
+        """Embeddings of the records of df, with n_workers > 1 the ones not in the cache or the store are embedded by
+        embed_sharded with shard_args."""
+        records, to_embed, group = self.plan_records(df)
+        not_None_sentences = [sentence for sentence, _ in to_embed.values()]
+        embedded = None
+        if len(not_None_sentences) > 0:
+            if n_workers is not None and n_workers > 1:
+                embedded = self.embed_sharded(not_None_sentences, n_workers, **shard_args)
+            else:
+                embedded = self.embed_backoff(not_None_sentences)
+        return self.finish_records(records, to_embed, embedded, group)
+
+    def embed_pipelined(self, df: pd.DataFrame, batches: List[np.ndarray]) -> list:
+        """get_embedding_df of every batch of rows of df, with the model running batch k on the calling thread while
+        a thread looks up and tokenizes batch k + 1 and another one pools and stores batch k - 1."""
+
+        def prepare(batch):
+            records, to_embed, group = self.plan_records(df.iloc[batch])
+            sentences = [sentence for sentence, _ in to_embed.values()]
+            return records, to_embed, group, self.tokenize(sentences) if len(sentences) > 0 else None
+
+        def finish(records, to_embed, group, tokenized, token_emb, embedded=None):
+            if embedded is None and tokenized is not None:
+                embedded = self.pack_word_embeddings(self.pool_tokens(token_emb, tokenized[0], tokenized[1],
+                                                                      tokenized[3]))
+            return self.finish_records(records, to_embed, embedded, group)
+
+        results = []
+        with ThreadPoolExecutor(1) as prepare_pool, ThreadPoolExecutor(1) as finish_pool:
+            prepared = prepare_pool.submit(prepare, batches[0])
+            for k in tqdm(range(len(batches))) if self.verbose else range(len(batches)):
+                records, to_embed, group, tokenized = prepared.result()
+                if k + 1 < len(batches):
+                    prepared = prepare_pool.submit(prepare, batches[k + 1])
+                token_emb, embedded = None, None
+                try:
+                    token_emb = self.get_token_embeddings(tokenized[2]) if tokenized is not None else None
+                except (RuntimeError, MemoryError) as e:
+                    if len(to_embed) == 1 or not WordEmbedding.is_out_of_memory(e):
+                        raise
+                    embedded = self.embed_halves([sentence for sentence, _ in to_embed.values()])
+                if k > 0:
+                    # at most one batch of token embeddings waits to be pooled
+                    results[k - 1].result()
+                results.append(finish_pool.submit(finish, records, to_embed, group, tokenized, token_emb, embedded))
+            return [result.result() for result in results]
+
+    @staticmethod
+    def unique_records(df: pd.DataFrame, ids=None) -> Tuple[pd.DataFrame, np.ndarray]:
+        """Rows of df with distinct ids (distinct content when ids is None or has missing values), in order of first
+        appearance, and the position among them of every row of df."""
+        keys = np.asarray(ids) if ids is not None and not pd.isna(ids).any() else \
+            pd.util.hash_pandas_object(df, index=False).values
+        inverse = pd.factorize(keys)[0]
+        return df.iloc[np.unique(inverse, return_index=True)[1]], inverse
+
+    @staticmethod
+    def expand_records(inverse: np.ndarray, *outputs) -> tuple:
+        """Outputs computed on the rows of unique_records, one record per row of df again without copies: the
+        duplicates share the rows of a RaggedEmbeddings (see RaggedEmbeddings.take), the items of lists and the rows
+        of tensors, which become lists of row views."""
+        if np.array_equal(inverse, np.arange(len(inverse))):
+            return outputs
+        return tuple(output.take(inverse) if isinstance(output, RaggedEmbeddings) else
+                     [output[i] for i in inverse] for output in outputs)
+
+    def token_lengths(self, df: pd.DataFrame) -> np.ndarray:
+        """Number of tokens of every record, as get_embedding_df tokenizes it."""
+        return self.sentence_lengths(df[np.setdiff1d(df.columns, ['id'])].apply(WordEmbedding.get_words_to_embed,
+                                                                                  1).values)
+
+    def sentence_lengths(self, sentences: np.ndarray) -> np.ndarray:
+        """Number of tokens of every sentence, 0 for the missing ones. With window the longer sentences count as
+        one window, whatever their number of windows."""
+        lengths = np.zeros(len(sentences), dtype=int)
+        not_none_mask = np.array([isinstance(x, str) for x in sentences], dtype=bool)
+        if not_none_mask.any():
+            tokens = self.tokenize_words([x.lower().split() for x in sentences[not_none_mask]])
+            lengths[not_none_mask] = [len(x) for x in tokens['input_ids']]
+        if self.window is not None:
+            lengths = np.minimum(lengths, self.window)
+        return lengths
+
+    def activation_bytes(self, n_records: int, length: int) -> int:
+        """Rough peak memory of a forward pass on n_records padded to length tokens: about 13 float32 vectors of
+        size per token in a layer (projections, feed-forward, residuals and the running layer sum) and the scores
+        and probabilities of its size // 64 attention heads."""
+        return 4 * n_records * length * (13 * self.size + 2 * max(1, self.size // 64) * length)
+
+    @staticmethod
+    def length_batches(lengths: np.ndarray, token_budget: int, batch_cost=None) -> List[np.ndarray]:
+        """Positions of the records sorted by length, cut so that every padded batch fits in token_budget tokens.
+
+        batch_cost(n_records, length) replaces the number of padded tokens of a batch, e.g. with activation_bytes
+        and a budget in bytes. A record over the budget gets a batch of its own.
+        """
+        batch_cost = batch_cost if batch_cost is not None else (lambda n_records, length: n_records * length)
+        order = np.argsort(lengths, kind='stable')
+        batches, start = [], 0
+        for end in range(1, len(order) + 1):
+            if end - start > 1 and batch_cost(end - start, lengths[order[end - 1]]) > token_budget:
+                batches.append(order[start:end - 1])
+                start = end - 1
+        if start < len(order):
+            batches.append(order[start:])
+        return batches
+
+    def generate_embedding(self, df: pd.DataFrame, chunk_size: int = 500, token_budget: int = None,
+                           n_workers: int = None, n_threads: int = None, pipeline: bool = False,
+                           memory_budget: int = None) -> Union[
+        Tuple[RaggedEmbeddings, list, torch.Tensor], Tuple[RaggedEmbeddings, list]]:
+        """Embed the records in chunks of chunk_size rows in input order.
+
+        With token_budget the records are batched by token length instead, each batch holding at most
+        token_budget tokens once padded, and the output is put back in input order. memory_budget does the same
+        with batches whose estimated activation memory (see activation_bytes) fits in memory_budget bytes.
+        Batches that run out of memory anyway are split in halves and retried.
+        With n_workers > 1 the records are embedded on CPU by n_workers processes of n_threads threads each, in
+        length sorted shards (see embed_sharded).
+        With pipeline the lookups, tokenization and pooling of the batches run on threads next to the model, see
+        embed_pipelined.
+        """
+        if n_workers is not None and n_workers > 1 and df.shape[0] > 0:
+            assert self.device == 'cpu', 'the sharded embedding runs on CPU'
+            return self.get_embedding_df(df, n_workers=n_workers, n_threads=n_threads, chunk_size=chunk_size,
+                                         token_budget=token_budget, memory_budget=memory_budget)
         emb_list, words_list, sent_emb_list = [], [], []
-        n_chunk = np.ceil(df.shape[0] / chunk_size).astype(int)
+        if memory_budget is not None:
+            batches = WordEmbedding.length_batches(self.token_lengths(df), memory_budget, self.activation_bytes)
+        elif token_budget is None:
+            batches = [np.arange(start, min(start + chunk_size, df.shape[0])) for start in
+                       range(0, df.shape[0], chunk_size)]
+        else:
+            batches = WordEmbedding.length_batches(self.token_lengths(df), token_budget)
         torch.cuda.empty_cache()
         if self.verbose:
             print('Computing embedding')
-            to_cycle = tqdm(range(n_chunk))
+        if pipeline and len(batches) > 0:
+            outputs = self.embed_pipelined(df, batches)
         else:
-            to_cycle = range(n_chunk)
-        for chunk in to_cycle:
-            # assert False
+            outputs = []
+            for batch in tqdm(batches) if self.verbose else batches:
+                outputs.append(self.get_embedding_df(df.iloc[batch]))
+                gc.collect()
+                torch.cuda.empty_cache()
+        for output in outputs:
+            emb_list.append(output[0])
+            words_list += output[1]
             if self.sentence_embedding:
-                emb, words, sent_emb = self.get_embedding_df(df.iloc[chunk * chunk_size:(chunk + 1) * chunk_size])
-                sent_emb_list.append(sent_emb)
-            else:
-                emb, words = self.get_embedding_df(df.iloc[chunk * chunk_size:(chunk + 1) * chunk_size])
-            emb_list.append(emb)
-            words_list += words
-
-            gc.collect()
-            torch.cuda.empty_cache()
+                sent_emb_list.append(output[2])
         if len(emb_list) > 0:
-            emb_list = np.concatenate(emb_list)
+            emb_list = RaggedEmbeddings.concatenate(emb_list)
             if self.sentence_embedding:
-                sent_emb_list = np.concatenate(sent_emb_list)
+                sent_emb_list = torch.cat(sent_emb_list)
+            if token_budget is not None or memory_budget is not None:
+                # position in the output of every input record
+                inverse = np.argsort(np.concatenate(batches), kind='stable')
+                emb_list = emb_list[inverse]
+                words_list = [words_list[i] for i in inverse]
+                if self.sentence_embedding:
+                    sent_emb_list = sent_emb_list[torch.from_numpy(inverse)]
         if self.sentence_embedding:
             return emb_list, words_list, sent_emb_list
         else:
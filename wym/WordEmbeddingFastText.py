@@ -1,16 +1,27 @@
 import gc
+from itertools import chain
+
 import numpy as np
 import torch
 from tqdm.autonotebook import tqdm
 from transformers import BertModel, BertTokenizer
 
+from .StaticVectors import StaticVectors
+
 
 class WordEmbeddingFastText():
 
     def __init__(self, model, device='auto', verbose=False, model_path='bert-base-uncased',
-                 sentence_embedding=False):
+                 sentence_embedding=False, vectors_path=None, oov_path=None):
         self.sentence_embedding = sentence_embedding
         self.model = model
+        # word to row table of the vectors, memory mapped from vectors_path when given (see StaticVectors.save), the
+        # words out of the vocabulary come from model or from the model saved at oov_path
+        if vectors_path is not None:
+            self.vectors = StaticVectors.load(vectors_path, oov=model.__getitem__ if model is not None else None,
+                                              oov_path=oov_path)
+        else:
+            self.vectors = StaticVectors.from_keyed_vectors(model)
         # Set the device to GPU (cuda) if available, otherwise stick with CPU
         if device == 'auto':
             self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -18,31 +29,25 @@ class WordEmbeddingFastText():
             self.device = device
         self.verbose = verbose
 
+    def __getstate__(self):
+        # the model is only needed by the vectors, which pickle it with oov unless they load it from oov_path
+        state = self.__dict__.copy()
+        state['model'] = None
+        return state
+
     def get_word_embeddings(self, sentences):
-        phrase_list = []
-        tokens = []
-        for phrase in sentences:
-            words = phrase.split()
-            phrase_list.append(words)
-            for word in words:
-                tokens.append(word)
-        token_emb = self.get_token_embeddings(tokens)
-
-        word_embeddings = []
-        s = 0
-        for i, phrase in enumerate(phrase_list):
-            end = s + len(phrase)
-            tmp_list=[]
-            for x in token_emb[s:end]:
-                tmp_list.append(torch.tensor(x))
-            word_embeddings.append(torch.stack(tmp_list))
-            s = end
+        phrase_list = [phrase.split() for phrase in sentences]
+        tokens = list(chain.from_iterable(phrase_list))
+        # every distinct word of the batch is looked up once
+        unique = {}
+        inverse = np.fromiter((unique.setdefault(token, len(unique)) for token in tokens), dtype=np.int64,
+                              count=len(tokens))
+        token_emb = self.get_token_embeddings(list(unique))[torch.from_numpy(inverse)]
+        word_embeddings = list(torch.split(token_emb, [len(phrase) for phrase in phrase_list]))
         return word_embeddings, phrase_list
 
     def get_token_embeddings(self, token_list):
-
-        token_vecs = self.model[token_list]
-        return token_vecs
+        return self.vectors.lookup(token_list)
 
     @staticmethod
     def get_words_to_embed(x):
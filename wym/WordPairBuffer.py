@@ -0,0 +1,79 @@
+from typing import Dict
+
+import numpy as np
+import torch
+
+
+class WordPairBuffer:
+    """Columnar output of the word pairing.
+
+    Every column is a NumPy buffer that grows geometrically in place, the pairing results of the records are
+    copied in once and get() trims the buffers to their final size. String columns are stored with dtype object,
+    embedding columns (torch tensors) keep their trailing shape and are handed back as tensors.
+    """
+    growth = 1.5
+
+    def __init__(self, capacity: int = 1024):
+        self.capacity = capacity
+        self.n = 0
+        self.buffers: Dict[str, np.ndarray] = {}
+        self.tensor_keys = set()
+
+    def __len__(self):
+        return self.n
+
+    @staticmethod
+    def to_numpy(value) -> np.ndarray:
+        if isinstance(value, torch.Tensor):
+            return value.detach().cpu().numpy()
+        value = np.asarray(value)
+        return value.astype(object) if value.dtype.kind in 'USO' else value
+
+    def reserve(self, n: int):
+        if n <= self.capacity:
+            return
+        while self.capacity < n:
+            self.capacity = int(self.capacity * WordPairBuffer.growth) + 1
+        for buffer in self.buffers.values():
+            # realloc, no other reference to the buffers is ever handed out before get()
+            buffer.resize((self.capacity,) + buffer.shape[1:], refcheck=False)
+
+    def append(self, **columns):
+        """Append the pairs of one record. Scalar values are repeated for every pair.
+
+        A record without pairs still adds its columns, so they are returned (empty) when no record has pairs.
+        """
+        self.tensor_keys.update(key for key, value in columns.items() if isinstance(value, torch.Tensor))
+        n = next(len(value) for value in columns.values() if np.ndim(value) > 0)
+        self.reserve(self.n + n)
+        for key, value in columns.items():
+            value = WordPairBuffer.to_numpy(value)
+            buffer = self.buffers.get(key)
+            if buffer is None:
+                buffer = np.zeros((self.capacity,) + value.shape[1:], dtype=value.dtype)
+                self.buffers[key] = buffer
+            if n == 0:
+                continue
+            if np.result_type(buffer.dtype, value.dtype) != buffer.dtype:
+                buffer = buffer.astype(np.result_type(buffer.dtype, value.dtype))
+                self.buffers[key] = buffer
+            buffer[self.n:self.n + n] = value
+        self.n += n
+
+    def shrink(self):
+        for buffer in self.buffers.values():
+            buffer.resize((self.n,) + buffer.shape[1:], refcheck=False)
+        self.capacity = self.n
+
+    def get(self, key: str):
+        """Trimmed column, shares memory with the buffer: do not append after get()."""
+        if key not in self.buffers:
+            return torch.tensor([]) if key in self.tensor_keys else np.array([])
+        if self.capacity != self.n:
+            self.shrink()
+        buffer = self.buffers[key]
+        return torch.from_numpy(buffer) if key in self.tensor_keys else buffer
+
+    def get_all(self, keys=None):
+        keys = keys if keys is not None else [key for key in self.buffers.keys() if key not in self.tensor_keys]
+        return {key: self.get(key) for key in keys}
@@ -1,6 +1,8 @@
+import atexit
 import gc
-from copy import deepcopy
-from multiprocessing import Pool
+import pickle
+from copy import copy, deepcopy
+from multiprocessing import Pool, get_context
 
 import numpy as np
 import pandas as pd
@@ -8,7 +10,11 @@ import torch
 from tqdm.autonotebook import tqdm
 from typing import List
 
-from .StableMarriage import gale_shapley
+from .EmbeddingPairs import EmbeddingPairs
+from .RaggedEmbeddings import RaggedEmbeddings
+from .SimilarityEngine import SimilarityEngine
+from .WordPairBuffer import WordPairBuffer
+from .StableMarriage import gale_shapley, stable_matching
 from nltk.metrics.distance import jaro_winkler_similarity
 
 class EMFeatures:
@@ -29,6 +35,123 @@ def parallelize_dataframe(param_list, func=None, n_cores=4):
     return df
 
 
+_pools = {}
+
+
+def get_pool(n_proc):
+    # Persistent pool shared by every generator with the same n_proc. Spawned workers, forking after torch has
+    # started its thread pools can deadlock.
+    if n_proc not in _pools:
+        _pools[n_proc] = get_context('spawn').Pool(n_proc, initializer=init_pairing_worker)
+    return _pools[n_proc]
+
+
+@atexit.register
+def close_pools():
+    for pool in _pools.values():
+        pool.close()
+        pool.join()
+    _pools.clear()
+
+
+def init_pairing_worker():
+    torch.set_num_threads(1)
+
+
+def pairing_worker(task):
+    word_pair_generator, df, data_dict = task
+    word_pair_generator = pickle.loads(word_pair_generator)
+    # blocks of previous calls are released, the ones of this call stay mapped for the next chunks
+    shared_names = [value.name for value in data_dict.values() if isinstance(value, SharedEmbeddings)]
+    SharedEmbeddings.detach_all(keep=shared_names)
+    for key, value in data_dict.items():
+        if isinstance(value, SharedEmbeddings):
+            data_dict[key] = value.attach()
+    buffer = word_pair_generator.pair_records(df, data_dict)
+    buffer.shrink()
+    return buffer
+
+
+class SharedEmbeddings:
+    """Embeddings of a list of records packed in one shared memory block, in their storage dtype.
+
+    Only the block name and the record offsets (and index, see RaggedEmbeddings.take) are pickled, the workers map
+    the block and get a RaggedEmbeddings of zero-copy views of the records.
+    """
+    _attached = {}
+
+    def __init__(self, emb_list, size=768):
+        if not isinstance(emb_list, RaggedEmbeddings):
+            emb_list = RaggedEmbeddings.from_list(emb_list, size)
+        self.offsets = emb_list.offsets - emb_list.offsets[0]
+        self.index = emb_list.index
+        self.shape = (int(self.offsets[-1]), size)
+        self.dtype = emb_list.data.dtype
+        self.has_scale = emb_list.scale is not None
+        self.shm = SharedEmbeddings.shared_memory().SharedMemory(create=True, size=max(emb_list.nbytes, 1))
+        self.name = self.shm.name
+        data, scale = self.views(self.shm.buf)
+        data.copy_(emb_list.values.detach().cpu())
+        if scale is not None:
+            scale.copy_(emb_list.scales.cpu())
+        del data, scale
+
+    @staticmethod
+    def shared_memory():
+        # imported here, multiprocessing.shared_memory needs python 3.8 and only the parallel pairing uses it
+        try:
+            from multiprocessing import shared_memory
+        except ImportError as e:
+            raise ImportError('the parallel word pairing (n_proc > 1) needs python >= 3.8') from e
+        return shared_memory
+
+    def __getstate__(self):
+        return {'name': self.name, 'shape': self.shape, 'offsets': self.offsets, 'index': self.index,
+                'dtype': self.dtype, 'has_scale': self.has_scale}
+
+    def views(self, buf):
+        """Rows and int8 scales in the block, the float32 scales come first."""
+        n_scale = self.shape[0] if self.has_scale else 0
+        scale = torch.from_numpy(np.ndarray((n_scale,), dtype=np.float32, buffer=buf)) if self.has_scale else None
+        # numpy has no bfloat16, the rows are mapped as integers of the same width
+        itemsize = torch.empty(0, dtype=self.dtype).element_size()
+        data = np.ndarray(self.shape, dtype=np.dtype(f'i{itemsize}'), buffer=buf, offset=4 * n_scale)
+        return torch.from_numpy(data).view(self.dtype), scale
+
+    def get_chunk(self, chunk):
+        tmp = copy(self)
+        if self.index is None:
+            tmp.offsets = self.offsets[chunk.start:chunk.stop + 1]
+        else:
+            tmp.index = self.index[chunk]
+        return tmp
+
+    def attach(self):
+        if self.name not in SharedEmbeddings._attached:
+            try:
+                shm = SharedEmbeddings.shared_memory().SharedMemory(name=self.name, track=False)
+            except TypeError:
+                # python < 3.13: spawned workers share the resource tracker of the main process, which unlinks
+                shm = SharedEmbeddings.shared_memory().SharedMemory(name=self.name)
+            SharedEmbeddings._attached[self.name] = shm
+        shm = SharedEmbeddings._attached[self.name]
+        data, scale = self.views(shm.buf)
+        return RaggedEmbeddings(data, self.offsets, scale, self.index)
+
+    @staticmethod
+    def detach_all(keep=()):
+        gc.collect()
+        for name in [name for name in SharedEmbeddings._attached.keys() if name not in keep]:
+            try:
+                SharedEmbeddings._attached.pop(name).close()
+            except BufferError:
+                pass
+
+    def release(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
 class WordPairGenerator(EMFeatures):
     word_pair_empty = {'left_word': [], 'right_word': [], 'cos_sim': [], 'left_attribute': [],
                        'right_attribute': []}
@@ -38,7 +161,7 @@ class WordPairGenerator(EMFeatures):
 
     def __init__(self, words=None, embeddings=None, words_divided=None, use_schema=True, sentence_embedding_dict=None,
                  unpair_threshold=None, cross_attr_threshold=None, duplicate_threshold=None,
-                 verbose=False, size=768,
+                 verbose=False, size=768, sim_batch_size=64, chunk_size=1000, index_pairs=False,
                  **kwargs):
         super().__init__(**kwargs)
         self.words = words
@@ -51,17 +174,24 @@ class WordPairGenerator(EMFeatures):
         self.duplicate_threshold = duplicate_threshold if duplicate_threshold is not None else WordPairGenerator.duplicate_threshold
         self.words_divided = words_divided
         self.verbose = verbose
+        self.sim_batch_size = sim_batch_size
+        self.chunk_size = chunk_size
+        # emb_pairs as an EmbeddingPairs (word embedding tables + indices) instead of a [n_pairs, 2, size] tensor
+        self.index_pairs = index_pairs
 
     def get_word_pairs(self, df, data_dict):
-        word_dict_list = []
-        embedding_list = []
-        if self.sentence_embedding_dict:
-            sentence_embedding_list = []
-            sent_emb_l, sent_emb_r = data_dict['left_sentence_emb'], data_dict['right_sentence_emb']
-        else:
-            sent_emb_l, sent_emb_r = [None] * df.shape[0], [None] * df.shape[0]
+        if self.n_proc > 1 and df.shape[0] > self.chunk_size:
+            return self.get_word_pairs_parallel(df, data_dict)
+        buffer = self.pair_records(df, data_dict)
+        return self.get_pairs(buffer, data_dict['left_emb'], data_dict['right_emb'],
+                              *[data_dict.get(side + '_sentence_emb') for side in ['left', 'right']])
+
+    def pair_records(self, df, data_dict):
+        buffer = WordPairBuffer()
         if 'id' not in df.columns:
             df['id'] = df.index
+        ids, labels = WordPairGenerator.get_id_label(df, default_label=0)
+        offsets = zip(*[EmbeddingPairs.offsets(data_dict[side + '_emb']) for side in ['left', 'right']])
         if self.verbose:
             print('Generating word_pairs')
             to_cycle = tqdm(range(df.shape[0]))
@@ -70,133 +200,140 @@ class WordPairGenerator(EMFeatures):
 
         gc.collect()
         torch.cuda.empty_cache()
-        for i, words1, emb1, left_words_map, sent1, words2, emb2, right_words_map, sent2 in zip(
-                to_cycle,
-                data_dict['left_words'], data_dict['left_emb'], data_dict['left_word_map'], sent_emb_l,
-                data_dict['right_words'], data_dict['right_emb'], data_dict['right_word_map'], sent_emb_r):
+        for i, el_id, label, offset, words1, emb1, left_words_map, words2, emb2, right_words_map in zip(
+                to_cycle, ids, labels, offsets,
+                data_dict['left_words'], data_dict['left_emb'], data_dict['left_word_map'],
+                data_dict['right_words'], data_dict['right_emb'], data_dict['right_word_map']):
             if i % 1000 == 0:
                 gc.collect()
                 torch.cuda.empty_cache()
-            el = df.iloc[[i]]
-
-            tmp_res = self.pairing_core_logic(el, emb1, emb2, words1, words2, left_words_map, right_words_map, sent1,
-                                              sent2)
-
-            # display(tmp_res)
-            if self.sentence_embedding_dict:
-                tmp_word, tmp_emb, tmp_sent_emb = tmp_res
-                sentence_embedding_list.append(tmp_sent_emb)
-            else:
-                tmp_word, tmp_emb = tmp_res
-
-            n_pairs = len(tmp_word['left_word'])
-            if 'label' in el.columns:
-                tmp_word['label'] = [el.label.values[0]] * n_pairs
-            else:
-                tmp_word['label'] = [0] * n_pairs
-            tmp_word['id'] = [el.id.values[0]] * n_pairs
-            word_dict_list.append(tmp_word)
-            embedding_list.append(tmp_emb)
-
-        keys = word_dict_list[0].keys()
-        ret_dict = {key: np.concatenate([x[key] for x in word_dict_list]) for key in keys}
-        # display(ret_dict)
+            if i % self.sim_batch_size == 0:
+                batch = slice(i, i + self.sim_batch_size)
+                sim_engine = SimilarityEngine(data_dict['left_emb'][batch], data_dict['right_emb'][batch])
+
+            tmp_res = self.pairing_core_logic(emb1=emb1, emb2=emb2, words1=words1, words2=words2,
+                                              left_words_map=left_words_map, right_words_map=right_words_map,
+                                              sim_mat=sim_engine[i % self.sim_batch_size],
+                                              return_pos=self.index_pairs)
+            self.append_pairs(buffer, tmp_res, label, el_id, offset, records=(i, i))
+
+        return buffer
+
+    def append_pairs(self, buffer, tmp_res, label, el_id, offset=None, records=None):
+        tmp_word, tmp_emb = tmp_res
+        if self.index_pairs:
+            emb_columns = {'emb_index': torch.from_numpy(EmbeddingPairs.pos_to_index(tmp_emb, *offset))}
+        else:
+            emb_columns = {'emb': tmp_emb}
         if self.sentence_embedding_dict is not None:
-            return ret_dict, torch.cat(embedding_list), torch.cat(sentence_embedding_list)
+            # rows of the left and right records in the sentence embeddings, repeated for every pair
+            emb_columns.update(left_record=torch.tensor(records[0]), right_record=torch.tensor(records[1]))
+        buffer.append(**tmp_word, label=label, id=el_id, **emb_columns)
+
+    def get_pairs(self, buffer, left_emb, right_emb, left_sent_emb=None, right_sent_emb=None):
+        size = self.zero_emb.shape[1]
+        if self.index_pairs:
+            emb_pairs = EmbeddingPairs(EmbeddingPairs.table(left_emb, size), EmbeddingPairs.table(right_emb, size),
+                                       buffer.get('emb_index'), EmbeddingPairs.scale_table(left_emb),
+                                       EmbeddingPairs.scale_table(right_emb))
         else:
-            return ret_dict, torch.cat(embedding_list)
-
-    # def get_word_pairs_parallel(self, df, data_dict):
-    #     word_dict_list = []
-    #     embedding_list = []
-    #     if self.sentence_embedding_dict:
-    #         sentence_embedding_list = []
-    #         sent_emb_l, sent_emb_r = data_dict['left_sentence_emb'], data_dict['right_sentence_emb']
-    #     else:
-    #         sent_emb_l, sent_emb_r = [None] * df.shape[0], [None] * df.shape[0]
-    #     if 'id' not in df.columns:
-    #         df['id'] = df.index
-    #     if self.verbose:
-    #         print('generating word_pairs')
-    #         to_cycle = range(df.shape[0])
-    #     else:
-    #         to_cycle = range(df.shape[0])
-    #
-    #     def do(i, words1, emb1, left_words_map, sent1, words2, emb2, right_words_map, sent2, df):
-    #         el = df.iloc[[i]]
-    #         return self.pairing_core_logic(el, emb1, emb2, words1, words2, left_words_map, right_words_map, sent1,
-    #                                           sent2)
-    #
-    #     res_list = parallelize_dataframe(zip(
-    #             to_cycle,
-    #             data_dict['left_words'], data_dict['left_emb'], data_dict['left_word_map'], sent_emb_l,
-    #             data_dict['right_words'], data_dict['right_emb'], data_dict['right_word_map'], sent_emb_r), partial(do,df=df) )
-    #
-    #     for i, tmp_res in enumerate(res_list):
-    #         el = df.iloc[[i]]
-    #         if self.sentence_embedding_dict:
-    #             tmp_word, tmp_emb, tmp_sent_emb = tmp_res
-    #             sentence_embedding_list.append(tmp_sent_emb)
-    #         else:
-    #             tmp_word, tmp_emb = tmp_res
-    #
-    #         n_pairs = len(tmp_word['left_word'])
-    #         if 'label' in el.columns:
-    #             tmp_word['label'] = [el.label.values[0]] * n_pairs
-    #         else:
-    #             tmp_word['label'] = [1] * n_pairs
-    #         tmp_word['id'] = [el.id.values[0]] * n_pairs
-    #         word_dict_list.append(tmp_word)
-    #         embedding_list.append(tmp_emb)
-    #
-    #     keys = word_dict_list[0].keys()
-    #     ret_dict = {key: np.concatenate([x[key] for x in word_dict_list]) for key in keys}
-    #
-    #     if self.sentence_embedding_dict is not None:
-    #         return ret_dict, torch.cat(embedding_list), torch.cat(sentence_embedding_list)
-    #     else:
-    #         return ret_dict, torch.cat(embedding_list)
+            emb_pairs = buffer.get('emb')
+            if isinstance(left_emb, RaggedEmbeddings) and left_emb.storage_dtype != 'float32':
+                # the dense pairs are kept in the storage dtype of the records too
+                emb_pairs = EmbeddingPairs.from_pairs(emb_pairs, left_emb.storage_dtype)
+        if self.sentence_embedding_dict is not None:
+            # one sentence embedding per record, the pairs reference it (row 0 of the tables is the zero row)
+            sent_index = torch.stack([buffer.get('left_record'), buffer.get('right_record')], 1) + 1
+            sent_tables = [torch.cat([self.zero_emb.to(sent_emb.dtype), sent_emb.cpu()]) if
+                           isinstance(sent_emb, torch.Tensor) else
+                           EmbeddingPairs.table([x.reshape([1, -1]) for x in sent_emb], size) for sent_emb in
+                           [left_sent_emb, right_sent_emb]]
+            return buffer.get_all(), emb_pairs, EmbeddingPairs(*sent_tables, sent_index)
+        else:
+            return buffer.get_all(), emb_pairs
+
+    def get_word_pairs_parallel(self, df, data_dict, chunk_size=None):
+        """get_word_pairs on the persistent pool of n_proc workers.
+
+        The embeddings are shared with the workers through shared memory, each worker pairs a chunk of records
+        and the chunk results are merged back in the original order.
+        """
+        chunk_size = chunk_size if chunk_size is not None else self.chunk_size
+        if 'id' not in df.columns:
+            df['id'] = df.index
+        record_cols = ['id', 'label'] if 'label' in df.columns else ['id']
+        keys = ['words', 'word_map']
+        shared = {}
+        try:
+            for side in ['left', 'right']:
+                shared[side + '_emb'] = SharedEmbeddings(data_dict[side + '_emb'], size=self.zero_emb.shape[1])
+            worker_generator = copy(self)
+            worker_generator.n_proc = 1
+            worker_generator.verbose = False
+            worker_generator.words, worker_generator.embeddings, worker_generator.words_divided = None, None, None
+            worker_generator.sentence_embedding_dict = True if self.sentence_embedding_dict else None
+            # plain pickle: the torch reductions registered on the multiprocessing pickler share tensors by fd
+            worker_generator = pickle.dumps(worker_generator)
+            tasks = []
+            for start in range(0, df.shape[0], chunk_size):
+                chunk = slice(start, start + chunk_size)
+                chunk_data = {side + '_' + key: data_dict[side + '_' + key][chunk] for side in ['left', 'right'] for
+                              key in keys}
+                chunk_data.update({key: value.get_chunk(chunk) for key, value in shared.items()})
+                tasks.append((worker_generator, df[record_cols].iloc[chunk], chunk_data))
+
+            pool = get_pool(self.n_proc)
+            to_cycle = pool.imap(pairing_worker, tasks)
+            if self.verbose:
+                print('Generating word_pairs')
+                to_cycle = tqdm(to_cycle, total=len(tasks))
+            res_list = list(to_cycle)
+        finally:
+            for value in shared.values():
+                value.release()
+
+        buffer = WordPairBuffer(capacity=sum(len(x) for x in res_list))
+        # the worker tables started at the chunk, except the ones of records sharing blocks (the whole table)
+        shift = np.stack([EmbeddingPairs.offsets(emb) - 1 if not isinstance(emb, RaggedEmbeddings) or emb.index is None
+                          else np.zeros(len(emb), dtype=np.int64) for emb in [data_dict['left_emb'],
+                                                                              data_dict['right_emb']]], 1)
+        for start in range(0, df.shape[0], chunk_size):
+            # chunk results are freed as soon as they are copied in
+            res = res_list.pop(0)
+            columns = {key: res.get(key) for key in res.buffers.keys()}
+            if 'emb_index' in columns:
+                # the zero row is shared
+                index = columns['emb_index']
+                columns['emb_index'] = torch.where(index > 0, index + torch.from_numpy(shift[start]), index)
+            for key in ['left_record', 'right_record']:
+                if key in columns:
+                    columns[key] = columns[key] + start
+            buffer.append(**columns)
+        return self.get_pairs(buffer, data_dict['left_emb'], data_dict['right_emb'],
+                              *[data_dict.get(side + '_sentence_emb') for side in ['left', 'right']])
 
     def process_df(self, df):
-        word_dict_list = []
-        embedding_list = []
-        if self.sentence_embedding_dict is not None:
-            sentence_embedding_list = []
+        buffer = WordPairBuffer()
+        ids, labels = df['id'].values, df['label'].values
+        left_ids, right_ids = df['left_id'].values, df['right_id'].values
+        left_offsets, right_offsets = [EmbeddingPairs.offsets(self.embeddings[name]) for name in ['table_A', 'table_B']]
         to_cycle = tqdm(range(df.shape[0])) if self.verbose == True else range(df.shape[0])
         for i in to_cycle:
             if i % 2000 == 0:
                 gc.collect()
                 torch.cuda.empty_cache()
-            el = df.iloc[[i]]
-            tmp_res = self.pairing_core_logic(el)
+            tmp_res = self.pairing_core_logic(left_ids[i], right_ids[i], return_pos=self.index_pairs)
+            self.append_pairs(buffer, tmp_res, labels[i], ids[i],
+                              offset=(left_offsets[left_ids[i]], right_offsets[right_ids[i]]),
+                              records=(left_ids[i], right_ids[i]))
 
-            if self.sentence_embedding_dict is not None:
-                tmp_word, tmp_emb, tmp_sent_emb = tmp_res
-                sentence_embedding_list.append(tmp_sent_emb)
-            else:
-                tmp_word, tmp_emb = tmp_res
-            n_pairs = len(tmp_word['left_word'])
-            tmp_word['label'] = [el.label.values[0]] * n_pairs
-            tmp_word['id'] = [el.id.values[0]] * n_pairs
-            word_dict_list.append(tmp_word)
-            embedding_list.append(tmp_emb)
-
-        keys = word_dict_list[0].keys()
-        ret_dict = {key: np.concatenate([x[key] for x in word_dict_list]) for key in keys}
-        # assert 2 in  ret_dict['id']
-        if self.sentence_embedding_dict is not None:
-            assert torch.cat(sentence_embedding_list).shape[0] == torch.cat(embedding_list).shape[
-                0]  # TODO remove assert
-            return ret_dict, torch.cat(embedding_list), torch.cat(sentence_embedding_list)
-        else:
-            return ret_dict, torch.cat(embedding_list)
+        sent_emb = [self.sentence_embedding_dict[name] for name in ['table_A', 'table_B']] if \
+            self.sentence_embedding_dict is not None else [None, None]
+        return self.get_pairs(buffer, self.embeddings['table_A'], self.embeddings['table_B'], *sent_emb)
 
     @staticmethod
     def cos_sim_set(emb1, emb2):
-        cos = torch.nn.CosineSimilarity(eps=1e-6)
-        rep1 = emb1.shape[0]
-        rep2 = emb2.shape[0]
-        return cos(emb1.repeat_interleave(rep2, 0), emb2.repeat(rep1, 1)).reshape([rep1, -1])
+        return SimilarityEngine.cos_sim(emb1, emb2, eps=1e-6)
 
     @staticmethod
     def stable_marriage(a, b, a_pref, b_pref):
@@ -248,11 +385,9 @@ class WordPairGenerator(EMFeatures):
         if len(row_unpaired) > 0 and len(col_unpaired) > 0:
             # Not stable pair under the threshold. constraint to 1 pair per word
 
-            remaining_sim = sim_mat[row_unpaired][:, col_unpaired]
-            row_preferences = np.array(col_unpaired[np.argsort(-remaining_sim)]).reshape(-1, len(col_unpaired))
-            col_preferences = np.array(row_unpaired[np.argsort(-remaining_sim.T)]).reshape(-1, len(row_unpaired))
-            new_pairs = WordPairGenerator.stable_marriage(row_unpaired, col_unpaired, row_preferences,
-                                                          col_preferences)
+            remaining_sim = np.asarray(sim_mat[row_unpaired][:, col_unpaired])
+            new_pairs = stable_matching(remaining_sim)
+            new_pairs = np.stack([row_unpaired[new_pairs[:, 0]], col_unpaired[new_pairs[:, 1]]], 1)
             pairs = np.concatenate([pairs, new_pairs])
         pairs = np.unique(pairs, axis=0)
         row_unpaired, col_unpaired = WordPairGenerator.get_not_paired(pairs, row_el, col_el)
@@ -302,10 +437,12 @@ class WordPairGenerator(EMFeatures):
                     el_words[prefix + col] = str(record[col].values[0]).split()
         return el_words
 
-    def generate_pairs(self, words_l, words_r, emb_l, emb_r, return_pairs=False, unpair_threshold=None,
-                       duplicate_threshold=None):
+    def generate_pairs(self, words_l, words_r, emb_l=None, emb_r=None, return_pairs=False, unpair_threshold=None,
+                       duplicate_threshold=None, sim_mat=None):
+        # without embeddings only the pairs are computed, sim_mat is then required when both sides have words
         unpair_threshold = unpair_threshold if unpair_threshold is not None else self.unpair_threshold
         duplicate_threshold = duplicate_threshold if duplicate_threshold is not None else self.duplicate_threshold
+        with_emb = emb_l is not None and emb_r is not None
 
         if len(words_r) == 0 and len(words_l) == 0:
             pairs, sim, ret_emb = [], [], []
@@ -314,42 +451,65 @@ class WordPairGenerator(EMFeatures):
             if len(words_l) == 0:
                 pairs = np.array([[-1, x] for x in range(len(words_r))])
                 sim = np.array([0] * len(words_r))
-                emb_l = self.zero_emb.to(self.device)
+                emb_l = self.zero_emb.to(self.device) if with_emb else None
             elif len(words_r) == 0:
                 pairs = np.array([[x, -1] for x in range(len(words_l))])
                 sim = np.array([0] * len(words_l))
-                emb_r = self.zero_emb.to(self.device)
+                emb_r = self.zero_emb.to(self.device) if with_emb else None
             else:
-                sim_mat = WordPairGenerator.cos_sim_set(emb_l.cpu(), emb_r.cpu())
+                if sim_mat is None:
+                    sim_mat = WordPairGenerator.cos_sim_set(emb_l.cpu(), emb_r.cpu())
                 pairs, sim = WordPairGenerator.most_similar_pairs(sim_mat.cpu(),
                                                                   duplicate_threshold=duplicate_threshold,
                                                                   unpair_threshold=unpair_threshold)
             words_l, words_r = np.concatenate([words_l, ['[UNP]']]), np.concatenate([words_r, ['[UNP]']])
-            emb_l = torch.cat([emb_l.to(self.device), self.zero_emb.to(self.device)], 0).to(self.device)
-            emb_r = torch.cat([emb_r.to(self.device), self.zero_emb.to(self.device)], 0).to(self.device)
             # print(f'wl: {words_l} \nwr:{words_r} \n {emb_l.shape} -- {emb_r.shape} \n {pairs},{sim}')
 
             word_pair = {'left_word': words_l[pairs[:, 0]].reshape([-1]),
                          'right_word': words_r[pairs[:, 1]].reshape([-1]),
                          'cos_sim': sim}
-            ret_emb = torch.stack([emb_l[pairs[:, 0]], emb_r[pairs[:, 1]]]).permute(1, 0, 2)
+            ret_emb = None
+            if with_emb:
+                emb_l = torch.cat([emb_l.to(self.device), self.zero_emb.to(self.device)], 0).to(self.device)
+                emb_r = torch.cat([emb_r.to(self.device), self.zero_emb.to(self.device)], 0).to(self.device)
+                ret_emb = torch.stack([emb_l[pairs[:, 0]], emb_r[pairs[:, 1]]]).permute(1, 0, 2)
         if return_pairs:
             return word_pair, ret_emb, pairs
         else:
             return word_pair, ret_emb
 
-    def pairing_core_logic(self, el, emb1=None, emb2=None, words1=None, words2=None, left_words_map=None,
-                           right_words_map=None, sent_emb_1=None, sent_emb_2=None):
+    @staticmethod
+    def abs_pos(pairs, left_pos, right_pos):
+        """Positions of the paired words in words1 and words2, -1 stays -1 ([UNP])."""
+        left_pos = np.append(np.asarray(left_pos, dtype=int), -1)
+        right_pos = np.append(np.asarray(right_pos, dtype=int), -1)
+        return np.stack([left_pos[pairs[:, 0]], right_pos[pairs[:, 1]]], 1)
+
+    def pos_to_emb(self, emb1, emb2, pos_pair):
+        # the zero embedding is appended last, so -1 ([UNP]) selects it
+        emb1 = emb1.cpu() if SimilarityEngine.n_words(emb1) > 0 else self.zero_emb[:0]
+        emb2 = emb2.cpu() if SimilarityEngine.n_words(emb2) > 0 else self.zero_emb[:0]
+        emb1, emb2 = torch.cat([emb1, self.zero_emb]), torch.cat([emb2, self.zero_emb])
+        pos_pair = torch.from_numpy(pos_pair)
+        return torch.stack([emb1[pos_pair[:, 0]], emb2[pos_pair[:, 1]]], 1)
+
+    def pairing_core_logic(self, left_id=None, right_id=None, emb1=None, emb2=None, words1=None, words2=None,
+                           left_words_map=None, right_words_map=None, sim_mat=None, return_pos=False):
+        """Word pairs of one record.
+
+        Every pair is tracked by the positions of its words in words1 and words2 (-1 for [UNP]). The embedding
+        pairs are gathered from them at the end, with return_pos=True the positions are returned instead.
+        """
         if emb1 is None or emb2 is None or words1 is None or words2 is None:
-            emb1 = self.embeddings['table_A'][el.left_id.values[0]]
-            emb2 = self.embeddings['table_B'][el.right_id.values[0]]
-            if self.sentence_embedding_dict is not None:
-                sent_emb_1 = self.sentence_embedding_dict['table_A'][el.left_id.values[0]]
-                sent_emb_2 = self.sentence_embedding_dict['table_B'][el.right_id.values[0]]
-            words1 = self.words['table_A'][el.left_id.values[0]]
-            words2 = self.words['table_B'][el.right_id.values[0]]
-            left_words_map = self.words_divided['table_A'][el.left_id.values[0]]
-            right_words_map = self.words_divided['table_B'][el.right_id.values[0]]
+            emb1 = self.embeddings['table_A'][left_id]
+            emb2 = self.embeddings['table_B'][right_id]
+            words1 = self.words['table_A'][left_id]
+            words2 = self.words['table_B'][right_id]
+            left_words_map = self.words_divided['table_A'][left_id]
+            right_words_map = self.words_divided['table_B'][right_id]
+        # every similarity block below is sliced from the whole words1 x words2 matrix
+        if sim_mat is None and len(words1) > 0 and len(words2) > 0:
+            sim_mat = SimilarityEngine.cos_sim(emb1.cpu(), emb2.cpu())
 
         if self.use_schema:
             # assert len(words1) == np.sum([len(x) for x in left_words.values() if x != ['']]), [words1, left_words]
@@ -358,34 +518,34 @@ class WordPairGenerator(EMFeatures):
 
             unpaired_words = deepcopy(WordPairGenerator.word_pair_empty)
             unpaired_words.update(left_pos=[], right_pos=[])
-            unpaired_emb = {'left': [], 'right': []}
-            word_pair = deepcopy(WordPairGenerator.word_pair_empty)
-            emb_pair = []
+            # pieces of every column, concatenated once at the end of the record
+            word_pair = {key: [] for key in WordPairGenerator.word_pair_empty.keys()}
+            pos_pair = []
             start_pos = {'left': 0, 'right': 0}
             tmp_words = {}
-            tmp_emb = {}
+            tmp_idx = {}
             for col in left_words_map.keys():
                 turn_start = deepcopy(start_pos)
                 for side in ['left', 'right']:
                     start = start_pos[side]
-                    words_list, word_map, emb, sent_emb = (
-                        words1, left_words_map, emb1, sent_emb_1) if side == 'left' else (
-                        words2, right_words_map, emb2, sent_emb_2)
+                    words_list, word_map = (words1, left_words_map) if side == 'left' else (words2, right_words_map)
                     indexes = [words_list[start:].index(x) for x in word_map[col]]
                     if len(indexes) > 0:
                         indexes = np.array(indexes) + start
                         tmp_words[side] = np.array(words_list)[indexes]
-                        tmp_emb[side] = emb[indexes]
+                        tmp_idx[side] = indexes
                         start_pos[side] += len(word_map[col])
                     else:
                         tmp_words[side] = []
-                        tmp_emb[side] = self.zero_emb
+                        tmp_idx[side] = []
                 # assert len(tmp_words['left'])>0 or len(tmp_words['right'])
-                tmp_word_pairs, tmp_emb_pairs, pairs = self.generate_pairs(tmp_words['left'], tmp_words['right'],
-                                                                           tmp_emb['left'], tmp_emb['right'],
-                                                                           return_pairs=True,
-                                                                           duplicate_threshold=1.1)
-                if len(tmp_emb_pairs) > 0:
+                attr_sim = sim_mat[tmp_idx['left']][:, tmp_idx['right']] if len(tmp_idx['left']) > 0 and len(
+                    tmp_idx['right']) > 0 else None
+                tmp_word_pairs, _, pairs = self.generate_pairs(tmp_words['left'], tmp_words['right'],
+                                                               return_pairs=True,
+                                                               duplicate_threshold=1.1,
+                                                               sim_mat=attr_sim)
+                if len(pairs) > 0:
                     paired_idx = []
                     for i, (l, r) in enumerate(pairs):
                         if l == -1 and r != -1:
@@ -396,57 +556,55 @@ class WordPairGenerator(EMFeatures):
                             unpaired_words['left_attribute'].append(col)
                         else:
                             paired_idx.append(i)
-                    emb_pair.append(tmp_emb_pairs[paired_idx].cpu())
+                    pos_pair.append(WordPairGenerator.abs_pos(pairs[paired_idx], tmp_idx['left'], tmp_idx['right']))
                     for key in tmp_word_pairs.keys():
-                        word_pair[key] = np.concatenate([word_pair[key], np.array(tmp_word_pairs[key])[paired_idx]])
+                        word_pair[key].append(np.array(tmp_word_pairs[key])[paired_idx])
                     for attr_key in ['left_attribute', 'right_attribute']:
-                        word_pair[attr_key] = np.concatenate([word_pair[attr_key], [col] * len(paired_idx)])
-
-            emb_pair = torch.cat(emb_pair) if len(emb_pair) > 0 else torch.tensor([])
+                        word_pair[attr_key].append([col] * len(paired_idx))
 
             # Pair remaining UNPAIRED words crossing the attribute schema
 
-            l_emb_unp = emb1[unpaired_words['left' + '_pos']] if len(
-                unpaired_words['left' + '_pos']) > 0 else self.zero_emb
-            r_emb_unp = emb2[unpaired_words['right' + '_pos']] if len(
-                unpaired_words['right' + '_pos']) > 0 else self.zero_emb
             words_l, words_r = np.array(words1)[unpaired_words['left_pos']], np.array(words2)[
                 unpaired_words['right_pos']]
             unpaired_words['left_word'] = words_l
             unpaired_words['right_word'] = words_r
-            unpaired_emb['left'] = l_emb_unp
-            unpaired_emb['right'] = r_emb_unp
-            if len(l_emb_unp) > 0 and len(r_emb_unp) > 0:
-                tmp_word_pairs, tmp_emb_pairs, pairs = self.generate_pairs(words_l, words_r, l_emb_unp, r_emb_unp,
-                                                                           return_pairs=True,
-                                                                           unpair_threshold=self.cross_attr_threshold,
-                                                                           duplicate_threshold=1.1)
-                new_unpaired_words = deepcopy(WordPairGenerator.word_pair_empty)
-                new_unpaired_words.update(left_pos=[], right_pos=[])
-                if len(tmp_emb_pairs) > 0:
-                    paired_idx = []
-                    for i, (l, r) in enumerate(pairs):
-                        if l == -1 and r != -1:
-                            new_unpaired_words['right_pos'].append(r)
-                            new_unpaired_words['right_attribute'].append(unpaired_words['right_attribute'][r])
-                        elif l != -1 and r == -1:
-                            new_unpaired_words['left_pos'].append(l)
-                            new_unpaired_words['left_attribute'].append(unpaired_words['left_attribute'][l])
-                        else:
-                            paired_idx.append(i)
-                    emb_pair = torch.cat([emb_pair, tmp_emb_pairs[paired_idx].cpu()])
-                    for key in tmp_word_pairs.keys():
-                        word_pair[key] = np.concatenate([word_pair[key], np.array(tmp_word_pairs[key])[paired_idx]])
-                    for side in ['left', 'right']:
-                        paired_elements = pairs[paired_idx][:, 0 if side == 'left' else 1]
-                        tmp_attr = np.array(unpaired_words[side + '_attribute'])[paired_elements]
-                        word_pair[side + '_attribute'] = np.concatenate([word_pair[side + '_attribute'], tmp_attr])
-
+            # absolute positions (in words1 and words2) of the words still unpaired
+            unpaired_abs_pos = {side: np.array(unpaired_words[side + '_pos'], dtype=int) for side in ['left', 'right']}
+            cross_sim = sim_mat[unpaired_abs_pos['left']][:, unpaired_abs_pos['right']] if len(
+                words_l) > 0 and len(words_r) > 0 else None
+            tmp_word_pairs, _, pairs = self.generate_pairs(words_l, words_r,
+                                                           return_pairs=True,
+                                                           unpair_threshold=self.cross_attr_threshold,
+                                                           duplicate_threshold=1.1,
+                                                           sim_mat=cross_sim)
+            new_unpaired_words = deepcopy(WordPairGenerator.word_pair_empty)
+            new_unpaired_words.update(left_pos=[], right_pos=[])
+            if len(pairs) > 0:
+                paired_idx = []
+                for i, (l, r) in enumerate(pairs):
+                    if l == -1 and r != -1:
+                        new_unpaired_words['right_pos'].append(r)
+                        new_unpaired_words['right_attribute'].append(unpaired_words['right_attribute'][r])
+                    elif l != -1 and r == -1:
+                        new_unpaired_words['left_pos'].append(l)
+                        new_unpaired_words['left_attribute'].append(unpaired_words['left_attribute'][l])
+                    else:
+                        paired_idx.append(i)
+                pos_pair.append(WordPairGenerator.abs_pos(pairs[paired_idx], unpaired_abs_pos['left'],
+                                                          unpaired_abs_pos['right']))
+                for key in tmp_word_pairs.keys():
+                    word_pair[key].append(np.array(tmp_word_pairs[key])[paired_idx])
                 for side in ['left', 'right']:
-                    new_unpaired_words[side + '_word'] = unpaired_words[side + '_word'][
-                        new_unpaired_words[side + '_pos']]
-                    unpaired_emb[side] = unpaired_emb[side][new_unpaired_words[side + '_pos']]
-                unpaired_words = new_unpaired_words
+                    paired_elements = pairs[paired_idx][:, 0 if side == 'left' else 1]
+                    tmp_attr = np.array(unpaired_words[side + '_attribute'])[paired_elements]
+                    word_pair[side + '_attribute'].append(tmp_attr)
+
+            for side in ['left', 'right']:
+                new_unpaired_words[side + '_word'] = unpaired_words[side + '_word'][
+                    new_unpaired_words[side + '_pos']]
+                unpaired_abs_pos[side] = unpaired_abs_pos[side][np.array(new_unpaired_words[side + '_pos'],
+                                                                         dtype=int)]
+            unpaired_words = new_unpaired_words
 
             # Pair remaining UNPAIRED words with all opposite words (including already paired)
             # This generates duplication
@@ -456,49 +614,55 @@ class WordPairGenerator(EMFeatures):
             for all_side, unp_side in zip(['left', 'right'], ['right', 'left']):
                 words_map = right_words_map if all_side == 'right' else left_words_map
                 pos_to_attr_map = WordPairGenerator.get_attr_map(words_map)
-                emb_unp = unpaired_emb[unp_side] if len(
-                    unpaired_words[unp_side + '_word']) > 0 else self.zero_emb
+                dup_sim = None
+                if len(unpaired_abs_pos[unp_side]) > 0 and len(words1) > 0 and len(words2) > 0:
+                    dup_sim = sim_mat[unpaired_abs_pos['left']] if unp_side == 'left' else sim_mat[:, unpaired_abs_pos[
+                        'right']]
                 if all_side == 'right':
-                    tmp_word_pairs, tmp_emb, pairs = self.generate_pairs(unpaired_words[unp_side + '_word'], words2,
-                                                                         emb_unp, emb2, return_pairs=True,
-                                                                         unpair_threshold=self.duplicate_threshold,
-                                                                         duplicate_threshold=1.1)
+                    tmp_word_pairs, _, pairs = self.generate_pairs(unpaired_words[unp_side + '_word'], words2,
+                                                                   return_pairs=True,
+                                                                   unpair_threshold=self.duplicate_threshold,
+                                                                   duplicate_threshold=1.1, sim_mat=dup_sim)
+                    left_pos, right_pos = unpaired_abs_pos['left'], np.arange(len(words2))
                 elif all_side == 'left':
-                    tmp_word_pairs, tmp_emb, pairs = self.generate_pairs(words1, unpaired_words[unp_side + '_word'],
-                                                                         emb1, emb_unp, return_pairs=True,
-                                                                         unpair_threshold=self.duplicate_threshold,
-                                                                         duplicate_threshold=1.1)
+                    tmp_word_pairs, _, pairs = self.generate_pairs(words1, unpaired_words[unp_side + '_word'],
+                                                                   return_pairs=True,
+                                                                   unpair_threshold=self.duplicate_threshold,
+                                                                   duplicate_threshold=1.1, sim_mat=dup_sim)
+                    left_pos, right_pos = np.arange(len(words1)), unpaired_abs_pos['right']
                 side_mask = np.array(tmp_word_pairs[unp_side + '_word']) != '[UNP]'
                 for key in tmp_word_pairs.keys():
-                    # display('first',word_pair[key],'and ', np.array(tmp_word_pairs[key])[side_mask])
-                    word_pair[key] = np.concatenate(
-                        [word_pair[key], np.array(tmp_word_pairs[key])[side_mask].flatten()])
-                    # display(word_pair[key], '***',np.concatenate([word_pair[key], np.array(tmp_word_pairs[key])[side_mask]]))
+                    word_pair[key].append(np.array(tmp_word_pairs[key])[side_mask].flatten())
                 if len(pairs) > 0:
                     all_attr = [pos_to_attr_map[pos] for pos in pairs[side_mask][:, 1 if all_side == 'right' else 0]]
-                    word_pair[all_side + '_attribute'] = np.concatenate([word_pair[all_side + '_attribute'], all_attr])
+                    word_pair[all_side + '_attribute'].append(all_attr)
                     unp_attr = np.array(unpaired_words[unp_side + '_attribute'])[
                         pairs[side_mask][:, 1 if unp_side == 'right' else 0]]
-                    word_pair[unp_side + '_attribute'] = np.concatenate([word_pair[unp_side + '_attribute'], unp_attr])
-                    emb_pair = torch.cat([emb_pair.cpu(), tmp_emb[side_mask].cpu()])
+                    word_pair[unp_side + '_attribute'].append(unp_attr)
+                    pos_pair.append(WordPairGenerator.abs_pos(pairs[side_mask], left_pos, right_pos))
 
-                for key in word_pair.keys():  # TODO remove in production
-                    assert len(word_pair[key]) == len(
-                        word_pair['left_word']), f'{key} --> {len(word_pair[key])} != {len(word_pair["left_word"])}'
+            word_pair = {key: np.concatenate([[]] + pieces) for key, pieces in word_pair.items()}
+            for key in word_pair.keys():  # TODO remove in production
+                assert len(word_pair[key]) == len(
+                    word_pair['left_word']), f'{key} --> {len(word_pair[key])} != {len(word_pair["left_word"])}'
 
         else:
-            word_pair, emb_pair, pairs = self.generate_pairs(words1, words2, emb1, emb2, return_pairs=True)
+            word_pair, _, pairs = self.generate_pairs(words1, words2, return_pairs=True, sim_mat=sim_mat)
+            pos_pair = [pairs] if len(pairs) > 0 else []
             for side, word_dict in zip(['left', 'right'], [left_words_map, right_words_map]):
                 pos_to_attr_map = WordPairGenerator.get_attr_map(word_dict)
                 all_attr = [pos_to_attr_map[pos] for pos in pairs[:, 1 if side == 'right' else 0]]
                 word_pair[side + '_attribute'] = np.array(all_attr)
 
-        if self.sentence_embedding_dict is not None:
-            tmp_array = torch.reshape(torch.stack([sent_emb_1, sent_emb_2]), (1, 2, -1))
-            sent_emb_pair = torch.tile(tmp_array, (emb_pair.shape[0], 1, 1))
-            return word_pair, emb_pair, sent_emb_pair
-        else:
-            return word_pair, emb_pair
+        pos_pair = np.concatenate(pos_pair) if len(pos_pair) > 0 else np.zeros([0, 2], dtype=int)
+        emb_pair = pos_pair if return_pos else self.pos_to_emb(emb1, emb2, pos_pair)
+        return word_pair, emb_pair
+
+    @staticmethod
+    def get_id_label(df, default_label=0):
+        # column arrays taken once, the pairing loops must not build pandas objects per record
+        labels = df['label'].values if 'label' in df.columns else np.full(df.shape[0], default_label)
+        return df['id'].values, labels
 
     @staticmethod
     def map_word_to_attr(df: pd.DataFrame, cols: List[str], prefix: str = '', verbose: bool = False) -> List[dict]:
@@ -506,13 +670,14 @@ class WordPairGenerator(EMFeatures):
 
         if verbose:
             print('Mapping word to attr')
+        values = {col: df[prefix + col].values for col in cols}
+        notna = {col: df[prefix + col].notna().values for col in cols}
         to_cycle = tqdm(range(df.shape[0])) if verbose else range(df.shape[0])
         for i in to_cycle:
-            el = df.iloc[[i]]
             el_words = {}
             for col in cols:
-                if el[prefix + col].notna().values[0]:
-                    el_words[col] = str(el[prefix + col].values[0]).split()
+                if notna[col][i]:
+                    el_words[col] = str(values[col][i]).split()
                 else:
                     el_words[col] = []
             tmp_res.append(el_words.copy())
@@ -525,15 +690,14 @@ class WordPairGeneratorEdit(WordPairGenerator):
         super().__init__(*args, **kwargs)
 
     def get_word_pairs(self, df, data_dict):
-        word_dict_list = []
-        embedding_list = []
+        buffer = WordPairBuffer()
         if self.sentence_embedding_dict:
-            sentence_embedding_list = []
             sent_emb_l, sent_emb_r = data_dict['left_sentence_emb'], data_dict['right_sentence_emb']
         else:
             sent_emb_l, sent_emb_r = [None] * df.shape[0], [None] * df.shape[0]
         if 'id' not in df.columns:
             df['id'] = df.index
+        ids, labels = WordPairGenerator.get_id_label(df, default_label=1)
         if self.verbose:
             print('generating word_pairs')
             to_cycle = tqdm(range(df.shape[0]))
@@ -542,38 +706,27 @@ class WordPairGeneratorEdit(WordPairGenerator):
 
         gc.collect()
         torch.cuda.empty_cache()
-        for i, left_words_map, right_words_map in zip(
-                to_cycle,
+        for i, el_id, label, left_words_map, right_words_map in zip(
+                to_cycle, ids, labels,
                 data_dict['left_word_map'],
                 data_dict['right_word_map']):
             if i % 1000 == 0:
                 gc.collect()
                 torch.cuda.empty_cache()
-            el = df.iloc[[i]]
 
-            tmp_res = self.pairing_core_logic(el, left_words_map, right_words_map)
+            tmp_res = self.pairing_core_logic(left_words_map=left_words_map, right_words_map=right_words_map)
             if self.sentence_embedding_dict:
                 tmp_word, tmp_emb, tmp_sent_emb = tmp_res
-                sentence_embedding_list.append(tmp_sent_emb)
             else:
                 tmp_word = tmp_res
+            buffer.append(**tmp_word, label=label, id=el_id)
 
-            n_pairs = len(tmp_word['left_word'])
-            if 'label' in el.columns:
-                tmp_word['label'] = [el.label.values[0]] * n_pairs
-            else:
-                tmp_word['label'] = [1] * n_pairs
-            tmp_word['id'] = [el.id.values[0]] * n_pairs
-            word_dict_list.append(tmp_word)
-
-        keys = word_dict_list[0].keys()
-        ret_dict = {key: np.concatenate([x[key] for x in word_dict_list]) for key in keys}
-        return ret_dict
+        return buffer.get_all()
 
-    def pairing_core_logic(self, el, left_words_map=None, right_words_map=None):
+    def pairing_core_logic(self, left_id=None, right_id=None, left_words_map=None, right_words_map=None):
         if left_words_map is None and right_words_map is None:
-            left_words_map = self.words_divided['table_A'][el.left_id.values[0]]
-            right_words_map = self.words_divided['table_B'][el.right_id.values[0]]
+            left_words_map = self.words_divided['table_A'][left_id]
+            right_words_map = self.words_divided['table_B'][right_id]
         words1 = [word for phrase, attr in left_words_map.items() for word in phrase]
         words2 = [word for phrase, attr in right_words_map.items() for word in phrase]
         if self.use_schema:
@@ -731,21 +884,15 @@ class WordPairGeneratorEdit(WordPairGenerator):
             [rep1, -1])
 
     def process_df(self, df):
-        word_dict_list = []
+        buffer = WordPairBuffer()
+        ids, labels = df['id'].values, df['label'].values
+        left_ids, right_ids = df['left_id'].values, df['right_id'].values
         to_cycle = tqdm(range(df.shape[0])) if self.verbose == True else range(df.shape[0])
         for i in to_cycle:
             if i % 2000 == 0:
                 gc.collect()
                 torch.cuda.empty_cache()
-            el = df.iloc[[i]]
-            tmp_res = self.pairing_core_logic(el)
-            tmp_word = tmp_res
-            n_pairs = len(tmp_word['left_word'])
-            tmp_word['label'] = [el.label.values[0]] * n_pairs
-            tmp_word['id'] = [el.id.values[0]] * n_pairs
-            word_dict_list.append(tmp_word)
-
-        keys = word_dict_list[0].keys()
-        ret_dict = {key: np.concatenate([x[key] for x in word_dict_list]) for key in keys}
-
-        return ret_dict
+            tmp_res = self.pairing_core_logic(left_ids[i], right_ids[i])
+            buffer.append(**tmp_res, label=labels[i], id=ids[i])
+
+        return buffer.get_all()
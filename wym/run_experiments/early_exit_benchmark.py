@@ -0,0 +1,48 @@
+"""F1 and throughput of Wym with the encoder stopped after each depth.
+
+The dataset directory holds train_merged.csv, valid_merged.csv and test_merged.csv as in the quick start.
+usage: python early_exit_benchmark.py <dataset_path> [n_rows]
+"""
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+from sklearn.metrics import f1_score
+
+from wym.wym import Wym
+
+
+def early_exit_benchmark(dataset_path, n_rows=None, depths=(3, 6, 9, 11),
+                         exclude_attrs=('id', 'left_id', 'right_id', 'label')):
+    dfs = {name: pd.read_csv(os.path.join(dataset_path, name + '_merged.csv')) for name in ['train', 'valid', 'test']}
+    if n_rows is not None:
+        dfs = {name: df.iloc[:n_rows].copy() for name, df in dfs.items()}
+    res = []
+    for depth in depths:
+        torch.manual_seed(0)
+        np.random.seed(0)
+        wym = Wym(df=dfs['train'], exclude_attrs=list(exclude_attrs), reset_networks=True, embedding_depth=depth,
+                  verbose=False, model_files_path=os.path.join(dataset_path, f'wym_depth{depth}'))
+        X, y = dfs['train'][wym.columns_to_use], dfs['train']['label']
+        X_valid, y_valid = dfs['valid'][wym.columns_to_use], dfs['valid']['label']
+        X_test, y_test = dfs['test'][wym.columns_to_use], dfs['test']['label']
+        wym.fit(X, y, X_valid, y_valid)
+        a = time.perf_counter()
+        wym.get_processed_data(X_test)
+        embedding_time = time.perf_counter() - a
+        a = time.perf_counter()
+        match_score = wym.predict(X_test)
+        predict_time = time.perf_counter() - a
+        res.append({'depth': depth,
+                    'layers': wym.we.layers,
+                    'embedded_records_per_s': 2 * X_test.shape[0] / embedding_time,
+                    'predicted_pairs_per_s': X_test.shape[0] / predict_time,
+                    'f1': f1_score(y_test, match_score > .5)})
+    return pd.DataFrame(res)
+
+
+if __name__ == '__main__':
+    print(early_exit_benchmark(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else None).to_string())
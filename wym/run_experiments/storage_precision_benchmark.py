@@ -0,0 +1,48 @@
+"""Accuracy of Wym with the word embeddings kept in each storage dtype.
+
+The dataset directory holds train_merged.csv, valid_merged.csv and test_merged.csv as in the quick start.
+usage: python storage_precision_benchmark.py <dataset_path> [n_rows]
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import torch
+from sklearn.metrics import f1_score
+
+from wym.wym import Wym
+
+
+def storage_precision_benchmark(dataset_path, n_rows=None, storage_dtypes=('float32', 'float16', 'bfloat16', 'int8'),
+                                exclude_attrs=('id', 'left_id', 'right_id', 'label')):
+    dfs = {name: pd.read_csv(os.path.join(dataset_path, name + '_merged.csv')) for name in ['train', 'valid', 'test']}
+    if n_rows is not None:
+        dfs = {name: df.iloc[:n_rows].copy() for name, df in dfs.items()}
+    res, reference = [], None
+    for storage_dtype in storage_dtypes:
+        torch.manual_seed(0)
+        np.random.seed(0)
+        wym = Wym(df=dfs['train'], exclude_attrs=list(exclude_attrs), reset_networks=True, index_pairs=True,
+                  storage_dtype=storage_dtype, verbose=False,
+                  model_files_path=os.path.join(dataset_path, 'wym_' + storage_dtype))
+        X, y = dfs['train'][wym.columns_to_use], dfs['train']['label']
+        X_valid, y_valid = dfs['valid'][wym.columns_to_use], dfs['valid']['label']
+        X_test, y_test = dfs['test'][wym.columns_to_use], dfs['test']['label']
+        wym.fit(X, y, X_valid, y_valid)
+        match_score, data_dict, word_pairs, emb_pairs, _, _ = wym.predict(X_test, return_data=True)
+        pairs = word_pairs[['id', 'left_word', 'right_word']]
+        cos_sim = emb_pairs.cos_sim()
+        if reference is None:
+            reference = pairs, cos_sim
+        same_pairs = pairs.shape == reference[0].shape and (pairs.values == reference[0].values).all()
+        res.append({'storage_dtype': storage_dtype,
+                    'embedding_MB': sum(data_dict[side + '_emb'].nbytes for side in ['left', 'right']) / 2 ** 20,
+                    'f1': f1_score(y_test, match_score > .5),
+                    'same_word_pairs': same_pairs,
+                    'max_cos_sim_error': (cos_sim - reference[1]).abs().max().item() if same_pairs else np.nan})
+    return pd.DataFrame(res)
+
+
+if __name__ == '__main__':
+    print(storage_precision_benchmark(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else None).to_string())
@@ -0,0 +1,47 @@
+import os
+import pickle
+import tempfile
+from unittest import TestCase
+
+import torch
+from transformers import BertConfig, BertModel
+
+from wym.EmbeddingBackend import EmbeddingBackend, LayerMean
+
+
+class TestEmbeddingBackend(TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        config = BertConfig(vocab_size=50, hidden_size=32, num_hidden_layers=4, num_attention_heads=2,
+                            intermediate_size=64)
+        self.model = BertModel(config).eval()
+        # other shape than the traced batch, with and without padding
+        input_ids = torch.randint(50, [3, 11])
+        attention_mask = torch.ones_like(input_ids)
+        attention_mask[0, 4:] = 0
+        self.inputs = (input_ids, attention_mask, torch.zeros_like(input_ids))
+        with torch.no_grad():
+            self.expected = LayerMean(self.model, (1, 4))(*self.inputs)
+
+    def test_torchscript(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = EmbeddingBackend.export(self.model, os.path.join(tmp_dir, 'model.pt'), layers=(1, 4),
+                                           quantize=False)
+            backend = EmbeddingBackend('torchscript', path)
+            out = backend(*self.inputs)
+            # pickled as the path of the graph for the workers of the sharded embedding
+            unpickled_out = pickle.loads(pickle.dumps(backend))(*self.inputs)
+        self.assertEqual(out.shape, self.expected.shape)
+        self.assertTrue(torch.allclose(out, self.expected, atol=1e-5))
+        self.assertTrue(torch.equal(out, unpickled_out))
+
+    def test_torchscript_quantized(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = EmbeddingBackend.export(self.model, os.path.join(tmp_dir, 'model.pt'), layers=(1, 4))
+            out = EmbeddingBackend('torchscript', path)(*self.inputs)
+        self.assertEqual(out.shape, self.expected.shape)
+        self.assertLess((out - self.expected).abs().max().item(), 5e-2)
+
+    def test_kind(self):
+        with self.assertRaises(AssertionError):
+            EmbeddingBackend('tensorrt', 'model.plan')
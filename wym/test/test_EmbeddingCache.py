@@ -0,0 +1,23 @@
+from unittest import TestCase
+
+import torch
+
+from wym.EmbeddingCache import EmbeddingCache
+
+
+class TestEmbeddingCache(TestCase):
+
+    def test_lru(self):
+        cache = EmbeddingCache(max_bytes=3 * (4 * 8 + 3))
+        for word in ['abc', 'def', 'ghi']:
+            cache.put(word, (torch.zeros(2, 4), [word]))
+        self.assertIsNotNone(cache.get('ABC '))
+        cache.put('jkl', (torch.zeros(2, 4), ['jkl']))
+        self.assertIsNone(cache.get('def'))
+        self.assertEqual(cache.get('abc')[1], ['abc'])
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 1, 'records': 3, 'bytes': 3 * (4 * 8 + 3)})
+
+    def test_too_large(self):
+        cache = EmbeddingCache(max_bytes=10)
+        cache.put('abc', (torch.zeros(2, 4), ['abc']))
+        self.assertEqual(len(cache), 0)
@@ -0,0 +1,59 @@
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+
+import torch
+
+from wym.EmbeddingStore import EmbeddingStore
+
+
+class TestEmbeddingStore(TestCase):
+
+    def test_put_get(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = EmbeddingStore(tmp_dir, 'model', size=4)
+            reader = EmbeddingStore(tmp_dir, 'model', size=4)
+            records = {'pale ale': (torch.randn(2, 4), ['pale', 'ale'], torch.randn(4)),
+                       'bier': (torch.randn(1, 4), ['bier'], torch.randn(4)),
+                       'empty': (torch.zeros(0, 4), [], torch.randn(4))}
+            for sentence, record in records.items():
+                store.put(sentence, record)
+            self.assertIsNone(reader.get('bier'))
+            # a record whose index line is not complete yet is not visible
+            with open(store.index_path, 'ab') as file:
+                file.write(b'{"key": "abc", "row": 4')
+            reader.refresh()
+            self.assertEqual(len(reader), 3)
+            self.assertIsNone(EmbeddingStore(tmp_dir, 'other model', size=4).get('bier'))
+            for sentence, record in records.items():
+                stored = reader.get(sentence.upper())
+                self.assertEqual(stored[1], record[1])
+                self.assertTrue(torch.equal(stored[0], record[0]))
+                self.assertTrue(torch.equal(stored[2], record[2]))
+            self.assertEqual(len(os.listdir(tmp_dir)), 2)
+            store.put('ale', (torch.randn(1, 4), ['ale']))
+            reader.refresh()
+            self.assertEqual(reader.get('ale')[1], ['ale'])
+            self.assertEqual(len(EmbeddingStore(tmp_dir, 'model', size=4)), 4)
+
+    def test_concurrent_writers(self):
+        records = {f'record {i}': (torch.randn(i % 3 + 1, 4), ['record'] + [str(i)] * (i % 3), torch.randn(4))
+                   for i in range(40)}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # stores of their own, as in different processes, writing overlapping records
+            stores = [EmbeddingStore(tmp_dir, 'model', size=4) for _ in range(4)]
+            sentences = list(records)
+            tasks = [(store, sentences[k::2]) for k, store in enumerate(stores)]
+            with ThreadPoolExecutor(4) as pool:
+                list(pool.map(lambda task: [task[0].put(sentence, records[sentence]) for sentence in task[1]], tasks))
+            reader = EmbeddingStore(tmp_dir, 'model', size=4)
+            with open(reader.index_path) as file:
+                self.assertEqual(len(file.readlines()), len(records))
+            self.assertEqual(os.path.getsize(reader.data_path), 4 * 4 * sum(len(record[1]) + 1
+                                                                            for record in records.values()))
+            for sentence, record in records.items():
+                stored = reader.get(sentence)
+                self.assertEqual(stored[1], record[1])
+                self.assertTrue(torch.equal(stored[0], record[0]))
+                self.assertTrue(torch.equal(stored[2], record[2]))
@@ -0,0 +1,78 @@
+import pickle
+from unittest import TestCase
+
+import numpy as np
+import torch
+
+from wym.RaggedEmbeddings import RaggedEmbeddings
+
+
+class TestRaggedEmbeddings(TestCase):
+
+    def setUp(self):
+        self.emb_list = [torch.randn(2, 4), torch.tensor([0]), torch.randn(3, 4), torch.randn(1, 4), torch.randn(2, 4)]
+        self.ragged = RaggedEmbeddings.from_list(self.emb_list)
+
+    def assert_records(self, ragged, emb_list):
+        self.assertEqual(len(ragged), len(emb_list))
+        for x, y in zip(ragged, emb_list):
+            self.assertTrue(torch.equal(x, y.reshape([-1, 4])))
+
+    def test_from_list(self):
+        self.assertEqual(self.ragged.n_words.tolist(), [2, 0, 3, 1, 2])
+        self.assertEqual(self.ragged[1].shape, torch.Size([0, 4]))
+        self.assert_records(self.ragged, [x if x.dim() == 2 else torch.zeros(0, 4) for x in self.emb_list])
+
+    def test_getitem(self):
+        emb_list = list(self.ragged)
+        self.assertTrue(torch.equal(self.ragged[-1], emb_list[-1]))
+        part = self.ragged[1:4]
+        self.assertIs(part.data, self.ragged.data)
+        self.assert_records(part, emb_list[1:4])
+        self.assert_records(self.ragged[[4, 0, 1, 2]], [emb_list[i] for i in [4, 0, 1, 2]])
+        self.assert_records(self.ragged[np.array([False, True, True, False, True])], [emb_list[i] for i in [1, 2, 4]])
+        self.assert_records(self.ragged[::-2], emb_list[::-2])
+        self.assert_records(pickle.loads(pickle.dumps(part)), emb_list[1:4])
+        self.assertEqual(pickle.loads(pickle.dumps(part)).data.shape[0], 4)
+
+    def test_concatenate(self):
+        emb_list = list(self.ragged)
+        ragged = RaggedEmbeddings.concatenate([self.ragged[3:], self.ragged[:3]])
+        self.assert_records(ragged, emb_list[3:] + emb_list[:3])
+
+    def test_astype(self):
+        emb_list = list(self.ragged)
+        for storage_dtype, atol in [('float16', 1e-2), ('bfloat16', 5e-2), ('int8', 2e-2)]:
+            ragged = self.ragged.astype(storage_dtype)
+            self.assertEqual(ragged.data.dtype, RaggedEmbeddings.storage_dtypes[storage_dtype])
+            self.assertLess(ragged.nbytes, self.ragged.nbytes)
+            for part, expected in [(ragged, emb_list), (ragged[[3, 0]], [emb_list[3], emb_list[0]]),
+                                   (pickle.loads(pickle.dumps(ragged[2:])), emb_list[2:])]:
+                self.assertEqual(len(part), len(expected))
+                for x, y in zip(part, expected):
+                    self.assertEqual(x.dtype, torch.float32)
+                    largest = y.abs().max().item() if y.numel() > 0 else 0.
+                    self.assertTrue(torch.allclose(x, y, atol=atol * largest))
+
+    def test_take(self):
+        emb_list = list(self.ragged)
+        positions = np.array([2, 0, 2, 2, 4, 1, 0])
+        expected = [emb_list[i] for i in positions]
+        taken = self.ragged.take(positions)
+        self.assertIs(taken.data, self.ragged.data)
+        self.assert_records(taken, expected)
+        self.assertEqual(taken.n_words.tolist(), [3, 2, 3, 3, 2, 0, 2])
+        # the repeated records are views of the same rows
+        self.assertEqual(taken[0].data_ptr(), taken[2].data_ptr())
+        self.assertIs(taken[2:5].data, self.ragged.data)
+        self.assert_records(taken[2:5], expected[2:5])
+        self.assert_records(taken[[6, 0]], [expected[6], expected[0]])
+        self.assert_records(self.ragged[1:4].take(np.array([2, 2, 0])), [emb_list[3], emb_list[3], emb_list[1]])
+        self.assert_records(RaggedEmbeddings.concatenate([self.ragged[3:], taken, self.ragged[:1]]),
+                            emb_list[3:] + expected + emb_list[:1])
+        unpickled = pickle.loads(pickle.dumps(taken))
+        self.assertEqual(unpickled.data.shape[0], self.ragged.data.shape[0])
+        self.assert_records(unpickled, expected)
+        int8 = taken.astype('int8')
+        self.assertEqual(len(int8), len(expected))
+        self.assertTrue(torch.allclose(int8[0], expected[0], atol=2e-2 * expected[0].abs().max().item()))
@@ -0,0 +1,22 @@
+from unittest import TestCase
+
+import torch
+
+from wym.SimilarityEngine import SimilarityEngine
+
+
+class TestSimilarityEngine(TestCase):
+
+    def test_cos_sim(self):
+        emb1, emb2 = torch.randn(5, 16), torch.randn(7, 16)
+        expected = torch.nn.CosineSimilarity(eps=1e-6)(emb1.repeat_interleave(7, 0), emb2.repeat(5, 1)).reshape(5, 7)
+        self.assertTrue(torch.allclose(SimilarityEngine.cos_sim(emb1, emb2), expected, atol=1e-6))
+
+    def test_batch(self):
+        left = [torch.randn(3, 16), torch.tensor([0.])[:0], torch.randn(6, 16)]
+        right = [torch.randn(4, 16), torch.randn(2, 16), torch.randn(1, 16)]
+        engine = SimilarityEngine(left, right)
+        self.assertEqual(len(engine), 3)
+        self.assertEqual(engine[1].shape, (0, 2))
+        for i in [0, 2]:
+            self.assertTrue(torch.allclose(engine[i], SimilarityEngine.cos_sim(left[i], right[i]), atol=1e-6))
@@ -0,0 +1,37 @@
+from unittest import TestCase
+
+import numpy as np
+
+from wym.StableMarriage import gale_shapley, stable_matching, stable_matching_batch
+
+
+def dict_stable_matching(sim_mat):
+    a, b = np.arange(sim_mat.shape[0]), np.arange(sim_mat.shape[1])
+    a_pref = {el: pref for el, pref in zip(a, b[np.argsort(-sim_mat)])}
+    b_pref = {el: pref for el, pref in zip(b, a[np.argsort(-sim_mat.T)])}
+    if len(a) > len(b):
+        return np.array(gale_shapley(A=b, B=a, A_pref=b_pref, B_pref=a_pref))[:, [1, 0]]
+    return np.array(gale_shapley(A=a, B=b, A_pref=a_pref, B_pref=b_pref))
+
+
+class TestStableMarriage(TestCase):
+
+    @staticmethod
+    def sorted_pairs(pairs):
+        return sorted(map(tuple, np.asarray(pairs).tolist()))
+
+    def test_stable_matching(self):
+        rng = np.random.RandomState(0)
+        for n, m in [(1, 1), (3, 5), (6, 2), (8, 8)]:
+            sim_mat = rng.rand(n, m)
+            sim_mat[:, 0] = sim_mat[:, -1]  # ties
+            self.assertEqual(self.sorted_pairs(stable_matching(sim_mat)),
+                             self.sorted_pairs(dict_stable_matching(sim_mat)))
+
+    def test_stable_matching_batch(self):
+        rng = np.random.RandomState(1)
+        sim_mats = [rng.rand(*rng.randint(1, 7, 2)) for _ in range(30)] + [np.zeros([0, 3])]
+        res = stable_matching_batch(sim_mats)
+        self.assertEqual(len(res), len(sim_mats))
+        for sim_mat, pairs in zip(sim_mats, res):
+            self.assertEqual(self.sorted_pairs(pairs), self.sorted_pairs(stable_matching(sim_mat)))
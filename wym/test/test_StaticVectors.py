@@ -0,0 +1,73 @@
+import os
+import pickle
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+import torch
+
+from wym.StaticVectors import StaticVectors
+from wym.WordEmbeddingFastText import WordEmbeddingFastText
+
+
+class KeyedVectorsFake:
+    """gensim KeyedVectors look-alike, the vectors of the words out of the vocabulary come from their characters."""
+
+    def __init__(self, words, size=6):
+        self.key_to_index = {word: i for i, word in enumerate(words)}
+        self.vectors = np.random.RandomState(0).randn(len(words), size).astype(np.float32)
+        self.n_oov_calls = 0
+
+    def oov_vector(self, word):
+        return np.array([(ord(c) % 7) for c in word.ljust(6)[:6]], dtype=np.float32)
+
+    def __getitem__(self, words):
+        words = [words] if isinstance(words, str) else words
+        self.n_oov_calls += sum(word not in self.key_to_index for word in words)
+        return np.stack([self.vectors[self.key_to_index[word]] if word in self.key_to_index else
+                         self.oov_vector(word) for word in words])
+
+
+class TestStaticVectors(TestCase):
+    def setUp(self):
+        self.model = KeyedVectorsFake(['pale', 'ale', 'stout', 'brewery'])
+        self.words = ['ale', 'pilsner', 'pale', 'ale', 'lager', 'pilsner', 'brewery']
+
+    def test_lookup(self):
+        vectors = StaticVectors.from_keyed_vectors(self.model)
+        self.assertTrue(np.array_equal(vectors.lookup(self.words).numpy(), self.model[self.words]))
+        # the words out of the vocabulary are computed once
+        n_oov_calls = self.model.n_oov_calls
+        emb = vectors.lookup(['lager', 'pilsner', 'stout'])
+        self.assertEqual(self.model.n_oov_calls, n_oov_calls)
+        self.assertEqual(vectors.n_extra, 2)
+        self.assertTrue(np.array_equal(emb.numpy(), self.model[['lager', 'pilsner', 'stout']]))
+        with self.assertRaises(KeyError):
+            StaticVectors(self.model.vectors, self.model.key_to_index).lookup(['lager'])
+
+    def test_memory_map(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            StaticVectors.from_keyed_vectors(self.model).save(tmp_dir)
+            vectors = StaticVectors.load(tmp_dir, oov=self.model.__getitem__)
+            self.assertIsInstance(vectors.vectors, np.memmap)
+            expected = vectors.lookup(self.words)
+            self.assertTrue(np.array_equal(expected.numpy(), self.model[self.words]))
+            unpickled = pickle.loads(pickle.dumps(vectors))
+            self.assertIsInstance(unpickled.vectors, np.memmap)
+            self.assertTrue(torch.equal(unpickled.lookup(self.words), expected))
+            # without oov_path the copies keep computing the words out of the vocabulary
+            self.assertTrue(np.array_equal(unpickled.lookup(['porter']).numpy(), self.model[['porter']]))
+            we = pickle.loads(pickle.dumps(WordEmbeddingFastText(self.model, device='cpu', vectors_path=tmp_dir)))
+            self.assertTrue(np.array_equal(we.vectors.lookup(['bock']).numpy(), self.model[['bock']]))
+            # with oov_path the model is loaded again instead of being copied
+            vectors.oov_path = os.path.join(tmp_dir, 'fasttext.model')
+            self.assertIsNone(pickle.loads(pickle.dumps(vectors)).oov)
+            del vectors, unpickled, we
+
+    def test_word_embeddings(self):
+        we = WordEmbeddingFastText(self.model, device='cpu')
+        sentences = ['pale ale pilsner', 'brewery', 'ale lager ale']
+        word_embeddings, words = we.get_word_embeddings(sentences)
+        self.assertEqual(words, [sentence.split() for sentence in sentences])
+        for emb, sentence in zip(word_embeddings, sentences):
+            self.assertTrue(np.array_equal(emb.numpy(), self.model[sentence.split()]))
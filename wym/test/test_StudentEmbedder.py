@@ -0,0 +1,39 @@
+import tempfile
+from unittest import TestCase
+
+import torch
+
+from wym.EmbeddingBackend import EmbeddingBackend
+from wym.StudentEmbedder import StudentEmbedder
+from wym.WordEmbedding import WordEmbedding
+from wym.test.test_WordEmbedding import random_df, tiny_model
+
+
+def tiny_teacher(tmp_dir):
+    torch.manual_seed(0)
+    model_path = tiny_model(tmp_dir, hidden_size=32)
+    return WordEmbedding(device='cpu', model_path=model_path, tokenizer_path=model_path, layers=(1, 4))
+
+
+class TestStudentEmbedder(TestCase):
+    def test_distill(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            teacher = tiny_teacher(tmp_dir)
+            student = StudentEmbedder.distill(teacher, [random_df(seed=0), random_df(seed=1)], path=tmp_dir,
+                                              num_layers=1, hidden_size=16, epochs=20, batch_size=8, lr=1e-3,
+                                              verbose=False)
+            self.assertLess(student.losses[-1], student.losses[0])
+            backend = EmbeddingBackend('student', tmp_dir)
+            tokens = teacher.tokenizer([['pale', 'ale'], ['bierbrauerei']], is_split_into_words=True, padding=True,
+                                       return_tensors='pt')
+            with torch.no_grad():
+                expected = student(tokens['input_ids'], tokens['attention_mask'], tokens['token_type_ids'])
+            out = backend(*[tokens[name] for name in EmbeddingBackend.input_names])
+        self.assertEqual(out.shape, teacher.get_token_embeddings(tokens).shape)
+        self.assertTrue(torch.allclose(out, expected, atol=1e-6))
+
+        # the student takes the place of the layer mean of the teacher
+        teacher.backend = backend
+        emb, words, _ = teacher.embed_sentences(['pale ale', 'bierbrauerei cafer'])
+        self.assertEqual(words, [['pale', 'ale'], ['bierbrauerei', 'cafer']])
+        self.assertEqual(emb.data.shape, (4, 32))
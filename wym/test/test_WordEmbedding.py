@@ -0,0 +1,396 @@
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+import torch
+from transformers import BertConfig, BertModel, BertTokenizerFast
+
+from wym.EmbeddingCache import EmbeddingCache
+from wym.EmbeddingStore import EmbeddingStore
+from wym.RaggedEmbeddings import RaggedEmbeddings
+from wym.WordEmbedding import WordEmbedding, close_worker_pools
+
+
+VOCAB = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', 'bier', '##brau', '##erei', 'pale', 'ale', 'cafe', '##r', '-']
+
+
+def fake_tokenizer(tmp_dir):
+    vocab_file = os.path.join(tmp_dir, 'vocab.txt')
+    with open(vocab_file, 'w') as file:
+        file.write('\n'.join(VOCAB))
+    return BertTokenizerFast(vocab_file)
+
+
+def tiny_model(tmp_dir, hidden_size=8, num_layers=3):
+    """Directory under tmp_dir with the fake tokenizer and a random BERT model, for WordEmbedding(model_path=path,
+    tokenizer_path=path)."""
+    path = os.path.join(tmp_dir, 'model')
+    os.makedirs(path, exist_ok=True)
+    fake_tokenizer(path).save_pretrained(path)
+    config = BertConfig(vocab_size=len(VOCAB), hidden_size=hidden_size, num_hidden_layers=num_layers,
+                        num_attention_heads=2, intermediate_size=2 * hidden_size)
+    BertModel(config).save_pretrained(path)
+    return path
+
+
+class WordEmbeddingFake(WordEmbedding):
+    """WordEmbedding of a tiny model whose token embeddings only depend on the token id."""
+
+    def __init__(self, model_path, **kwargs):
+        super().__init__(device='cpu', model_path=model_path, tokenizer_path=model_path, **kwargs)
+        self.table = torch.randn(len(VOCAB), self.size)
+
+    def get_token_embeddings(self, token_list):
+        return self.table[token_list['input_ids']]
+
+
+def random_df(n_records=30, seed=0):
+    rng = np.random.RandomState(seed)
+    words = ['bierbrauerei', 'pale', 'ale', 'paler', 'café', 'pale-ale']
+    df = pd.DataFrame({'id': np.arange(n_records),
+                       'name': [' '.join(rng.choice(words, rng.randint(1, 8))) for _ in range(n_records)],
+                       'brand': [None] * 10 + list(rng.choice(words, n_records - 10))})
+    df.loc[[3, 7], 'name'] = None
+    return df
+
+
+class WordEmbeddingOOM(WordEmbeddingFake):
+    """WordEmbeddingFake running out of memory on batches of more than max_records records."""
+
+    def __init__(self, model_path, max_records=3):
+        super().__init__(model_path)
+        self.max_records = max_records
+        self.n_failures = 0
+
+    def get_token_embeddings(self, token_list):
+        if token_list['input_ids'].shape[0] > self.max_records:
+            self.n_failures += 1
+            raise torch.cuda.OutOfMemoryError('CUDA out of memory.')
+        return super().get_token_embeddings(token_list)
+
+
+class TokenizerSpy:
+    """Tokenizer counting the calls made while another thread is in it."""
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.n_running = 0
+        self.n_overlaps = 0
+
+    def __call__(self, *args, **kwargs):
+        self.n_running += 1
+        self.n_overlaps += self.n_running > 1
+        try:
+            time.sleep(0.01)
+            return self.tokenizer(*args, **kwargs)
+        finally:
+            self.n_running -= 1
+
+
+class TestWordEmbedding(TestCase):
+
+    def test_pool_words(self):
+        tokens = [['[CLS]', 'bier', '##brau', '##erei', 'pale', 'ale', '[SEP]', '[PAD]'],
+                  ['[CLS]', 'pale', '##r', 'ale', '[SEP]', '[PAD]', '[PAD]', '[PAD]']]
+        sentences = ['bierbrauerei pale ale', None]
+        token_emb = torch.randn(2, 8, 16)
+        word_token_maps, words_lists = zip(*[WordEmbedding.map_token_to_word(x, sentence) for x, sentence in
+                                             zip(tokens, sentences)])
+        word_embeddings = WordEmbedding.pool_words(token_emb, word_token_maps, words_lists)
+        for i, map in enumerate(word_token_maps):
+            expected = torch.stack([torch.mean(token_emb[i, map[word_pos]], 0) for word_pos in
+                                    range(len(words_lists[i]))])
+            self.assertEqual(word_embeddings[i].shape, expected.shape)
+            self.assertTrue(torch.allclose(word_embeddings[i], expected, atol=1e-6))
+
+    def test_map_word_ids(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer = fake_tokenizer(tmp_dir)
+        sentences = ['Bierbrauerei pale-ale', 'café paler ale']
+        words_lists = [sentence.lower().split() for sentence in sentences]
+        tokens = tokenizer(words_lists, is_split_into_words=True, padding=True)
+        word_token_maps = [WordEmbedding.map_word_ids(tokens.word_ids(i), len(words)) for i, words in
+                           enumerate(words_lists)]
+        self.assertEqual(word_token_maps[0], {0: [1, 2, 3], 1: [4, 5, 6], 2: [7]})
+        self.assertEqual(word_token_maps[1], {0: [1], 1: [2, 3], 2: [4], 3: [5]})
+
+    def test_zero_token_words(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            we = WordEmbeddingFake(tiny_model(tmp_dir))
+        unk = we.table[VOCAB.index('[UNK]')]
+        for window in [None, 4]:
+            we.window, we.window_overlap = window, 1 if window else None
+            word_embeddings, words_lists = we.get_word_embeddings(['pale \u200b ale', '\u00ad'])
+            self.assertEqual(words_lists, [['pale', '\u200b', 'ale', '[SEP]'], ['\u00ad', '[SEP]']])
+            for emb in word_embeddings:
+                self.assertFalse(torch.isnan(emb).any())
+            self.assertTrue(torch.allclose(word_embeddings[0][1], unk))
+            self.assertTrue(torch.allclose(word_embeddings[1][0], unk))
+        # a word without tokens pools to zeros
+        emb = WordEmbedding.pool_words(torch.randn(1, 3, 4), [{0: [1], 1: [], 2: [2]}], [['pale', 'ale']])[0]
+        self.assertTrue(torch.equal(emb[1], torch.zeros(4)))
+
+    def test_length_batches(self):
+        lengths = np.array([5, 2, 9, 2, 3, 30, 4])
+        batches = WordEmbedding.length_batches(lengths, token_budget=10)
+        np.testing.assert_array_equal(np.sort(np.concatenate(batches)), np.arange(len(lengths)))
+        for batch in batches:
+            self.assertTrue(len(batch) == 1 or len(batch) * lengths[batch].max() <= 10)
+
+    def test_generate_embedding_token_budget(self):
+        df = random_df()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            we = WordEmbeddingFake(tiny_model(tmp_dir))
+        emb, words_list = we.generate_embedding(df, chunk_size=7)
+        bucket_emb, bucket_words_list = we.generate_embedding(df, token_budget=24)
+        self.assertEqual(words_list, bucket_words_list)
+        for x, y in zip(emb, bucket_emb):
+            self.assertTrue(torch.allclose(x, y, atol=1e-6))
+
+    def test_unique_records(self):
+        df = random_df()[['name', 'brand']]
+        df = df.iloc[np.random.RandomState(0).randint(0, len(df), 60)].reset_index(drop=True)
+        unique_df, inverse = WordEmbedding.unique_records(df)
+        self.assertEqual(len(unique_df), len(df.drop_duplicates()))
+        pd.testing.assert_frame_equal(unique_df.iloc[inverse].reset_index(drop=True), df)
+        ids_df, ids_inverse = WordEmbedding.unique_records(df, ids=[0, 1] * 30)
+        self.assertEqual(len(ids_df), 2)
+        np.testing.assert_array_equal(ids_inverse, [0, 1] * 30)
+
+        # missing ids fall back to the content
+        np.testing.assert_array_equal(WordEmbedding.unique_records(df, ids=[0, None] * 30)[1], inverse)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            we = WordEmbeddingFake(tiny_model(tmp_dir), sentence_embedding=True)
+        emb, words_list, _ = we.generate_embedding(df, chunk_size=7)
+        unique_output = we.generate_embedding(unique_df, chunk_size=7)
+        unique_emb, unique_words_list, unique_sentence_emb = WordEmbedding.expand_records(inverse, *unique_output)
+        self.assertEqual(words_list, unique_words_list)
+        self.assertEqual(len(unique_emb), len(df))
+        for x, y in zip(emb, unique_emb):
+            self.assertTrue(torch.allclose(x, y, atol=1e-6))
+        self.assertTrue(torch.equal(torch.stack(unique_sentence_emb), unique_output[2][torch.from_numpy(inverse)]))
+        # the duplicates share the rows of the unique records
+        self.assertIs(unique_emb.data, unique_output[0].data)
+        first, duplicate = np.flatnonzero(inverse == inverse[np.flatnonzero(pd.Series(inverse).duplicated())[0]])[:2]
+        self.assertEqual(unique_emb[first].data_ptr(), unique_emb[duplicate].data_ptr())
+        self.assertEqual(unique_sentence_emb[first].data_ptr(), unique_sentence_emb[duplicate].data_ptr())
+        self.assertIs(unique_words_list[first], unique_words_list[duplicate])
+        # without duplicates the outputs are returned as they are
+        self.assertIs(WordEmbedding.expand_records(np.arange(len(df)), emb)[0], emb)
+
+    def test_window_words(self):
+        token_counts = [1, 2, 3, 1, 1, 2, 5, 1]
+        spans = WordEmbedding.window_words(token_counts, 4, 2)
+        self.assertEqual(spans[0][0], 0)
+        self.assertEqual(spans[-1][1], len(token_counts))
+        for (start, end), (next_start, next_end) in zip(spans[:-1], spans[1:]):
+            self.assertTrue(start < next_start <= end < next_end)
+            self.assertTrue(sum(token_counts[next_start:end]) <= 2)
+        # the word of 5 tokens has a window of its own
+        self.assertIn((6, 7), spans)
+        self.assertTrue(all(sum(token_counts[start:end]) <= 4 for start, end in spans if end - start > 1))
+        self.assertEqual(WordEmbedding.window_words([1, 1], 4, 2), [(0, 2)])
+        self.assertEqual(WordEmbedding.window_words([], 4, 2), [(0, 0)])
+
+    def test_generate_embedding_window(self):
+        df = random_df()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            we = WordEmbeddingFake(tiny_model(tmp_dir))
+        emb, words_list = we.generate_embedding(df, chunk_size=7)
+        we.window, we.window_overlap = 6, 2
+        word_token_maps, words_lists, tokens, windows = we.tokenize(df['name'].dropna().tolist())
+        self.assertLessEqual(tokens['input_ids'].shape[1], 6)
+        self.assertGreater(len(words_lists), len(windows))
+        # the fake token embeddings do not depend on the context, the stitched words match the whole records
+        window_emb, window_words_list = we.generate_embedding(df, chunk_size=7)
+        self.assertEqual(words_list, window_words_list)
+        self.assertTrue(np.array_equal(emb.offsets, window_emb.offsets))
+        self.assertTrue(torch.allclose(emb.data, window_emb.data, atol=1e-6))
+
+    def test_generate_embedding_memory_budget(self):
+        df = random_df()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            we = WordEmbeddingFake(tiny_model(tmp_dir))
+        lengths = we.token_lengths(df)
+        budget = we.activation_bytes(6, lengths.max())
+        batches = WordEmbedding.length_batches(lengths, budget, we.activation_bytes)
+        self.assertTrue(np.array_equal(np.sort(np.concatenate(batches)), np.arange(len(df))))
+        self.assertTrue(all(we.activation_bytes(len(batch), lengths[batch].max()) <= budget for batch in batches))
+        self.assertTrue(we.activation_bytes(2, 10) > 2 * we.activation_bytes(1, 5))
+        emb, words_list = we.generate_embedding(df, chunk_size=7)
+        budget_emb, budget_words_list = we.generate_embedding(df, memory_budget=budget)
+        self.assertEqual(words_list, budget_words_list)
+        self.assertTrue(torch.allclose(emb.data, budget_emb.data, atol=1e-6))
+
+    def test_generate_embedding_backoff(self):
+        df = random_df()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            we = WordEmbeddingOOM(tiny_model(tmp_dir))
+        emb, words_list = we.generate_embedding(df, chunk_size=3)
+        self.assertEqual(we.n_failures, 0)
+        we.tokenizer = TokenizerSpy(we.tokenizer)
+        for pipeline in [False, True]:
+            backoff_emb, backoff_words_list = we.generate_embedding(df, chunk_size=10, pipeline=pipeline)
+            self.assertEqual(words_list, backoff_words_list)
+            self.assertTrue(torch.allclose(emb.data, backoff_emb.data, atol=1e-6))
+        self.assertTrue(we.n_failures > 0)
+        # the retries in halves and the next batch of the pipeline are not tokenized at once
+        self.assertEqual(we.tokenizer.n_overlaps, 0)
+        we.max_records = 0
+        with self.assertRaises(torch.cuda.OutOfMemoryError):
+            we.generate_embedding(df, chunk_size=10)
+
+    def test_attribute_scope(self):
+        df = random_df()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            we = WordEmbeddingFake(tiny_model(tmp_dir), cache_bytes=2 ** 20, storage_dtype='int8',
+                                   sentence_embedding=True)
+        emb, words_list, sentence_emb = we.generate_embedding(df, chunk_size=7)
+        we.cache = EmbeddingCache(2 ** 20)
+        we.attribute_scope = True
+        for pipeline in [False, True]:
+            attribute_emb, attribute_words_list, attribute_sentence_emb = we.generate_embedding(df, chunk_size=7,
+                                                                                               pipeline=pipeline)
+            # same words per record, the fake token embeddings do not depend on the context
+            self.assertEqual(words_list, attribute_words_list)
+            self.assertTrue(np.array_equal(emb.offsets, attribute_emb.offsets))
+            self.assertTrue(torch.equal(emb.values, attribute_emb.values))
+            self.assertEqual(attribute_sentence_emb.shape, sentence_emb.shape)
+            # rows 3 and 7 have no values
+            self.assertEqual(attribute_sentence_emb[[3, 7]].abs().sum().item(), 0)
+        # the values repeat across the records
+        n_values = df[['brand', 'name']].notna().values.sum()
+        self.assertEqual(we.cache.hits + we.cache.misses, 2 * n_values)
+        self.assertGreater(we.cache.hits, n_values)
+
+    def test_generate_embedding_pipeline(self):
+        df = random_df()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            we = WordEmbeddingFake(tiny_model(tmp_dir), cache_bytes=2 ** 20, store_path=tmp_dir)
+            emb, words_list = we.generate_embedding(df, chunk_size=7)
+            for kwargs in [{'chunk_size': 4}, {'token_budget': 24}]:
+                we.cache.clear()
+                pipeline_emb, pipeline_words_list = we.generate_embedding(df, pipeline=True, **kwargs)
+                self.assertEqual(words_list, pipeline_words_list)
+                self.assertTrue(np.array_equal(emb.offsets, pipeline_emb.offsets))
+                self.assertTrue(torch.allclose(emb.data, pipeline_emb.data, atol=1e-6))
+            we = WordEmbeddingFake(tiny_model(tmp_dir))
+            emb, words_list = we.generate_embedding(df, chunk_size=5)
+            pipeline_emb, pipeline_words_list = we.generate_embedding(df, chunk_size=5, pipeline=True)
+        self.assertEqual(words_list, pipeline_words_list)
+        self.assertTrue(torch.equal(emb.data, pipeline_emb.data))
+
+    def test_generate_embedding_sharded(self):
+        df = random_df()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            we = WordEmbeddingFake(tiny_model(tmp_dir), storage_dtype='int8')
+        emb, words_list = we.generate_embedding(df, chunk_size=7)
+        try:
+            for kwargs in [{'chunk_size': 4}, {'token_budget': 24}]:
+                sharded_emb, sharded_words_list = we.generate_embedding(df, n_workers=2, n_threads=1, **kwargs)
+                self.assertEqual(words_list, sharded_words_list)
+                self.assertTrue(np.array_equal(emb.offsets, sharded_emb.offsets))
+                self.assertTrue(torch.equal(emb.data, sharded_emb.data))
+                self.assertTrue(torch.equal(emb.scale, sharded_emb.scale))
+        finally:
+            # the pools still open are closed at exit
+            close_worker_pools()
+        self.assertIsNone(we.worker_pool)
+
+    def test_get_token_embeddings(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            model_path = tiny_model(tmp_dir, hidden_size=16, num_layers=5)
+            we = WordEmbedding(device='cpu', model_path=model_path, tokenizer_path=model_path, layers=(2, 5))
+        tokens = we.tokenizer([['pale', 'ale'], ['bierbrauerei']], is_split_into_words=True, padding=True,
+                              return_tensors='pt')
+        with torch.no_grad():
+            hidden_states = we.model(**tokens, output_hidden_states=True)[2]
+        expected = torch.mean(torch.stack(hidden_states)[2:5], 0)
+        # early exit: the layers after hidden state 4 are not run
+        later_calls = []
+        we.model.encoder.layer[4].register_forward_hook(lambda *args: later_calls.append(1))
+        self.assertTrue(torch.allclose(we.get_token_embeddings(tokens), expected, atol=1e-6))
+        self.assertEqual(later_calls, [])
+        we.layers = (0, 3)
+        expected = torch.mean(torch.stack(hidden_states)[0:3], 0)
+        self.assertTrue(torch.allclose(we.get_token_embeddings(tokens), expected, atol=1e-6))
+
+    def test_generate_embedding_cache(self):
+        df = random_df(60)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            model_path = tiny_model(tmp_dir)
+            we, cached_we = WordEmbeddingFake(model_path), WordEmbeddingFake(model_path, cache_bytes=2 ** 20)
+        cached_we.table = we.table
+        emb, words_list = we.generate_embedding(df, chunk_size=7)
+        for _ in range(2):
+            cached_emb, cached_words_list = cached_we.generate_embedding(df, chunk_size=7)
+            self.assertEqual(words_list, cached_words_list)
+            for x, y in zip(emb, cached_emb):
+                self.assertTrue(torch.allclose(x, y, atol=1e-6))
+        self.assertEqual(cached_we.cache.stats()['misses'], len(cached_we.cache))
+        self.assertEqual(cached_we.cache.stats()['hits'] + cached_we.cache.stats()['misses'], 2 * 58)
+
+    def test_generate_embedding_store(self):
+        df = random_df(40)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            model_path = tiny_model(tmp_dir)
+            emb, words_list = WordEmbeddingFake(model_path, store_path=tmp_dir).generate_embedding(df, chunk_size=7)
+            # a new process with different weights gets the stored embeddings back
+            stored_emb, stored_words_list = WordEmbeddingFake(model_path, store_path=tmp_dir).generate_embedding(df)
+        self.assertEqual(words_list, stored_words_list)
+        for x, y in zip(emb, stored_emb):
+            self.assertTrue(torch.equal(x.float(), y.float()))
+
+    def test_store_storage_dtype(self):
+        df = random_df()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            model_path = tiny_model(tmp_dir)
+            we = WordEmbeddingFake(model_path, sentence_embedding=True)
+            int8_we = WordEmbeddingFake(model_path, store_path=tmp_dir, storage_dtype='int8', sentence_embedding=True)
+            stored_we = WordEmbeddingFake(model_path, store_path=tmp_dir, sentence_embedding=True)
+            int8_we.table = stored_we.table = we.table
+            emb, words_list, sentence_emb = we.generate_embedding(df, chunk_size=7)
+            int8_emb = int8_we.generate_embedding(df, chunk_size=7)[0]
+            self.assertEqual(int8_emb.data.dtype, torch.int8)
+            # the float32 run reads back the rows as computed, not the int8 ones
+            stored_we.table = torch.zeros_like(we.table)
+            stored_emb, stored_words_list, stored_sentence_emb = stored_we.generate_embedding(df, chunk_size=7)
+        self.assertEqual(words_list, stored_words_list)
+        self.assertTrue(torch.equal(emb.data, stored_emb.data))
+        self.assertTrue(torch.equal(sentence_emb, stored_sentence_emb))
+
+    def test_depth_model_id(self):
+        df = random_df()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            model_path = tiny_model(tmp_dir)
+            we = WordEmbeddingFake(model_path, store_path=tmp_dir)
+            early_we = WordEmbeddingFake(model_path, store_path=tmp_dir, depth=1)
+            self.assertEqual(early_we.layers, (1, 2))
+            self.assertNotEqual(we.model_id, early_we.model_id)
+            # the early exit embeddings are not read back as the full depth ones
+            early_we.generate_embedding(df)
+            we.store.refresh()
+            self.assertGreater(len(early_we.store), 0)
+            self.assertEqual(len(we.store), 0)
+            self.assertEqual(WordEmbeddingFake(model_path, depth=11).model_id, we.model_id)
+
+    def test_generate_embedding_storage_dtype(self):
+        df = random_df()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            model_path = tiny_model(tmp_dir)
+            we = WordEmbeddingFake(model_path)
+            int8_wes = {storage_dtype: WordEmbeddingFake(model_path, cache_bytes=2 ** 20, storage_dtype=storage_dtype)
+                        for storage_dtype in ['float16', 'int8']}
+        emb, words_list = we.generate_embedding(df, chunk_size=7)
+        for storage_dtype, int8_we in int8_wes.items():
+            int8_we.table = we.table
+            for _ in range(2):
+                int8_emb, int8_words_list = int8_we.generate_embedding(df, chunk_size=7)
+                self.assertEqual(int8_emb.data.dtype, RaggedEmbeddings.storage_dtypes[storage_dtype])
+                self.assertEqual(words_list, int8_words_list)
+                for x, y in zip(emb, int8_emb):
+                    self.assertTrue(torch.allclose(x, y, atol=2e-2))
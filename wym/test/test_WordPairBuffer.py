@@ -0,0 +1,40 @@
+from unittest import TestCase
+
+import numpy as np
+import torch
+
+from wym.WordPairBuffer import WordPairBuffer
+
+
+class TestWordPairBuffer(TestCase):
+
+    def test_append(self):
+        rng = np.random.RandomState(0)
+        buffer = WordPairBuffer(capacity=2)
+        records = []
+        for i in range(20):
+            n = rng.randint(0, 5)
+            records.append({'left_word': np.array([f'w{x}' for x in rng.randint(0, 100, n)]),
+                            'cos_sim': np.zeros(n, dtype=int) if i == 0 else rng.rand(n),
+                            'id': i, 'emb': torch.randn(n, 2, 4)})
+            buffer.append(**records[-1])
+        self.assertEqual(len(buffer), sum(len(x['left_word']) for x in records))
+        res = buffer.get_all()
+        self.assertEqual(list(res.keys()), ['left_word', 'cos_sim', 'id'])
+        np.testing.assert_array_equal(res['left_word'], np.concatenate([x['left_word'] for x in records]))
+        np.testing.assert_array_equal(res['cos_sim'], np.concatenate([x['cos_sim'] for x in records]))
+        np.testing.assert_array_equal(res['id'], np.concatenate([[x['id']] * len(x['left_word']) for x in records]))
+        self.assertTrue(torch.equal(buffer.get('emb'), torch.cat([x['emb'] for x in records])))
+
+    def test_empty(self):
+        buffer = WordPairBuffer()
+        buffer.append(left_word=np.array([]), id=0, emb=torch.tensor([]))
+        self.assertEqual(buffer.get('emb').shape[0], 0)
+        self.assertEqual(buffer.get('left_word').shape[0], 0)
+        # the columns of records without pairs are kept
+        buffer = WordPairBuffer()
+        buffer.append(left_word=np.array([]), id=0, emb=torch.zeros(0, 2, 4))
+        res = buffer.get_all()
+        self.assertEqual(list(res.keys()), ['left_word', 'id'])
+        self.assertEqual([len(x) for x in res.values()], [0, 0])
+        self.assertEqual(buffer.get('emb').shape, (0, 2, 4))
@@ -6,7 +6,8 @@ import numpy as np
 import pandas as pd
 import torch
 
-from WordPairGenerator import WordPairGenerator
+from wym.RaggedEmbeddings import RaggedEmbeddings
+from wym.WordPairGenerator import WordPairGenerator
 
 
 class WordEmbeddingFake():
@@ -20,8 +21,190 @@ class WordEmbeddingFake():
         return torch.tensor(word_embedding), words_list
 
 
+def random_data_dict(n_records, cols=('name', 'brand'), size=16, seed=0):
+    rng = np.random.RandomState(seed)
+    data_dict = {}
+    for side in ['left', 'right']:
+        words, word_maps, embs = [], [], []
+        for _ in range(n_records):
+            word_map = {col: [f'{col}{x}' for x in rng.randint(0, 4, rng.randint(0, 3))] for col in cols}
+            record_words = [x for col in cols for x in word_map[col]]
+            words.append(record_words)
+            word_maps.append(word_map)
+            emb = torch.tensor(rng.randn(len(record_words), size), dtype=torch.float32)
+            embs.append(emb if len(record_words) > 0 else torch.tensor([0.])[:0])
+        data_dict.update({side + '_words': words, side + '_word_map': word_maps, side + '_emb': embs})
+    df = pd.DataFrame({'id': np.arange(n_records), 'label': rng.randint(0, 2, n_records),
+                       **{prefix + col: [''] * n_records for prefix in ['left_', 'right_'] for col in cols}})
+    return df, data_dict
+
+
+# word vectors of the golden records, similar words share a direction
+GOLDEN_VECTORS = {
+    'pale': [1.0, 0.1, 0.0, 0.0], 'pal': [0.9, 0.2, 0.1, 0.0], 'ale': [0.0, 1.0, 0.1, 0.0],
+    'ales': [0.1, 0.9, 0.0, 0.1], 'stout': [0.0, 0.0, 1.0, 0.2], 'porter': [0.1, 0.0, 0.9, 0.4],
+    'guinness': [0.0, 0.1, 0.1, 1.0], 'brew': [0.5, 0.5, 0.0, 0.5], 'dog': [-1.0, 0.0, 0.3, 0.0],
+    'cat': [0.0, -1.0, 0.0, 0.3]}
+
+
+def golden_data_dict():
+    """Four records pairing words in and across attributes, with duplicates and unpaired words on either side."""
+    records = [({'name': ['pale', 'ale'], 'brand': ['guinness']}, {'name': ['pal', 'ales'], 'brand': ['guinness']}),
+               ({'name': ['stout', 'dog'], 'brand': ['brew']}, {'name': ['porter'], 'brand': ['stout', 'cat']}),
+               ({'name': ['pale'], 'brand': []}, {'name': [], 'brand': ['pal', 'guinness']}),
+               ({'name': ['ale', 'porter', 'guinness'], 'brand': ['pale']},
+                {'name': ['ales', 'pale', 'cat'], 'brand': ['dog']})]
+    data_dict = {}
+    for k, side in enumerate(['left', 'right']):
+        word_maps = [record[k] for record in records]
+        words = [word_map['name'] + word_map['brand'] for word_map in word_maps]
+        data_dict.update({side + '_word_map': word_maps, side + '_words': words,
+                          side + '_emb': [torch.tensor([GOLDEN_VECTORS[x] for x in record_words]) if record_words
+                                          else torch.zeros(0, 4) for record_words in words]})
+    df = pd.DataFrame({'id': [10, 11, 12, 13], 'label': [1, 0, 1, 0], 'left_name': '', 'left_brand': '',
+                       'right_name': '', 'right_brand': ''})
+    return df, data_dict
+
+
 class TestWordPairGenerator(TestCase):
 
+    def test_golden_pairs(self):
+        # pairs of the implementation before the matmul engine, index pairs and process pool
+        expected = {
+            'id': [10, 10, 10, 11, 11, 11, 11, 11, 12, 12, 13, 13, 13, 13, 13, 13],
+            'left_word': ['pale', 'ale', 'guinness', 'stout', 'stout', '[UNP]', 'dog', 'brew', 'pale', '[UNP]', 'ale',
+                          'pale', '[UNP]', '[UNP]', 'porter', 'guinness'],
+            'right_word': ['pal', 'ales', 'guinness', 'porter', 'stout', 'cat', '[UNP]', '[UNP]', 'pal', 'guinness',
+                           'ales', 'pale', 'dog', 'cat', '[UNP]', '[UNP]'],
+            'left_attribute': ['name', 'name', 'brand', 'name', 'name', '[UNP]', 'name', 'brand', 'name', '[UNP]',
+                               'name', 'brand', '[UNP]', '[UNP]', 'name', 'name'],
+            'right_attribute': ['name', 'name', 'brand', 'name', 'brand', 'brand', '[UNP]', '[UNP]', 'brand', 'brand',
+                                'name', 'name', 'brand', 'name', '[UNP]', '[UNP]']}
+        cos_sim = [0.9871, 0.983, 1.0, 0.9707, 1.0, 0.0, 0.0, 0.0, 0.9871, 0.0, 0.983, 1.0, 0.0, 0.0, 0.0, 0.0]
+        expected_emb = torch.tensor([[GOLDEN_VECTORS.get(left, [0.] * 4), GOLDEN_VECTORS.get(right, [0.] * 4)] for
+                                     left, right in zip(expected['left_word'], expected['right_word'])])
+        df, data_dict = golden_data_dict()
+        for kwargs in [{}, {'n_proc': 2, 'chunk_size': 3}, {'index_pairs': True}]:
+            word_pairs, emb_pairs = WordPairGenerator(df=df, device='cpu', size=4, **kwargs).get_word_pairs(
+                df, data_dict)
+            for key, value in expected.items():
+                self.assertEqual(list(word_pairs[key]), value)
+            np.testing.assert_allclose(word_pairs['cos_sim'].astype(float), cos_sim, atol=1e-4)
+            self.assertTrue(torch.equal(emb_pairs[:], expected_emb))
+
+    def test_get_word_pairs_parallel(self):
+        df, data_dict = random_data_dict(50)
+        serial = WordPairGenerator(df=df, device='cpu', size=16)
+        parallel = WordPairGenerator(df=df, device='cpu', size=16, n_proc=2, chunk_size=8)
+        word_pairs, emb_pairs = serial.get_word_pairs(df, data_dict)
+        par_word_pairs, par_emb_pairs = parallel.get_word_pairs(df, data_dict)
+        self.assertEqual(word_pairs.keys(), par_word_pairs.keys())
+        for key in word_pairs.keys():
+            np.testing.assert_array_equal(word_pairs[key], par_word_pairs[key])
+        self.assertTrue(torch.allclose(emb_pairs, par_emb_pairs))
+
+    def test_index_pairs(self):
+        df, data_dict = random_data_dict(50, seed=1)
+        word_pairs, emb_pairs = WordPairGenerator(df=df, device='cpu', size=16).get_word_pairs(df, data_dict)
+        for n_proc in [1, 2]:
+            wp = WordPairGenerator(df=df, device='cpu', size=16, index_pairs=True, n_proc=n_proc, chunk_size=8)
+            idx_word_pairs, idx_emb_pairs = wp.get_word_pairs(df, data_dict)
+            np.testing.assert_array_equal(word_pairs['left_word'], idx_word_pairs['left_word'])
+            self.assertEqual(idx_emb_pairs.shape, emb_pairs.shape)
+            self.assertTrue(torch.equal(idx_emb_pairs[:], emb_pairs))
+            self.assertTrue(torch.equal(idx_emb_pairs[[3, 1]], emb_pairs[[3, 1]]))
+
+    def test_sentence_embedding_pairs(self):
+        df, data_dict = random_data_dict(50, seed=2)
+        rng = np.random.RandomState(2)
+        for side in ['left', 'right']:
+            data_dict[side + '_sentence_emb'] = [torch.tensor(rng.randn(16), dtype=torch.float32) for _ in range(50)]
+        serial = WordPairGenerator(df=df, device='cpu', size=16, sentence_embedding_dict=True)
+        word_pairs, emb_pairs, sent_emb_pairs = serial.get_word_pairs(df, data_dict)
+        expected = torch.cat([torch.stack([data_dict['left_sentence_emb'][i], data_dict['right_sentence_emb'][i]])
+                              .unsqueeze(0).repeat(n, 1, 1) for i, n in
+                              zip(*np.unique(word_pairs['id'], return_counts=True))])
+        self.assertTrue(torch.equal(sent_emb_pairs[:], expected))
+        parallel = WordPairGenerator(df=df, device='cpu', size=16, sentence_embedding_dict=True, n_proc=2,
+                                     chunk_size=8)
+        self.assertTrue(torch.equal(parallel.get_word_pairs(df, data_dict)[2][:], expected))
+
+    def test_ragged_embeddings(self):
+        df, data_dict = random_data_dict(50, seed=3)
+        ragged_data_dict = {key: RaggedEmbeddings.from_list(value, 16) if key.endswith('_emb') else value for
+                            key, value in data_dict.items()}
+        for index_pairs in [False, True]:
+            word_pairs, emb_pairs = WordPairGenerator(df=df, device='cpu', size=16, index_pairs=index_pairs
+                                                      ).get_word_pairs(df, data_dict)
+            for n_proc in [1, 2]:
+                wp = WordPairGenerator(df=df, device='cpu', size=16, index_pairs=index_pairs, n_proc=n_proc,
+                                       chunk_size=8)
+                ragged_word_pairs, ragged_emb_pairs = wp.get_word_pairs(df, ragged_data_dict)
+                np.testing.assert_array_equal(word_pairs['right_word'], ragged_word_pairs['right_word'])
+                self.assertTrue(torch.equal(ragged_emb_pairs[:], emb_pairs[:]))
+
+    def test_shared_records(self):
+        df, data_dict = random_data_dict(50, seed=5)
+        # records repeated by take share their rows, the pairs are the ones of the gathered records
+        positions = np.random.RandomState(5).randint(0, 20, 50)
+        shared_emb = {}
+        for side in ['left', 'right']:
+            ragged = RaggedEmbeddings.from_list(data_dict[side + '_emb'], 16)
+            for key in ['_words', '_word_map']:
+                data_dict[side + key] = [data_dict[side + key][i] for i in positions]
+            data_dict[side + '_emb'] = ragged[positions]
+            shared_emb[side + '_emb'] = ragged.take(positions)
+        shared_data_dict = dict(data_dict, **shared_emb)
+        for index_pairs in [False, True]:
+            word_pairs, emb_pairs = WordPairGenerator(df=df, device='cpu', size=16, index_pairs=index_pairs
+                                                      ).get_word_pairs(df, data_dict)
+            for n_proc in [1, 2]:
+                wp = WordPairGenerator(df=df, device='cpu', size=16, index_pairs=index_pairs, n_proc=n_proc,
+                                       chunk_size=8)
+                shared_word_pairs, shared_emb_pairs = wp.get_word_pairs(df, shared_data_dict)
+                np.testing.assert_array_equal(word_pairs['left_word'], shared_word_pairs['left_word'])
+                self.assertTrue(torch.equal(shared_emb_pairs[:], emb_pairs[:]))
+
+    def test_no_pairs(self):
+        df, data_dict = random_data_dict(20, seed=6)
+        for side in ['left', 'right']:
+            data_dict.update({side + '_words': [[] for _ in range(20)], side + '_emb': [torch.zeros(0, 16)] * 20,
+                              side + '_word_map': [{'name': [], 'brand': []} for _ in range(20)]})
+        # a batch without pairs returns the empty columns
+        for index_pairs in [False, True]:
+            for n_proc in [1, 2]:
+                wp = WordPairGenerator(df=df, device='cpu', size=16, index_pairs=index_pairs, n_proc=n_proc,
+                                       chunk_size=8)
+                word_pairs, emb_pairs = wp.get_word_pairs(df, data_dict)
+                for key in list(WordPairGenerator.word_pair_empty.keys()) + ['label', 'id']:
+                    self.assertEqual(len(word_pairs[key]), 0)
+                self.assertEqual(tuple(emb_pairs[:].shape), (0, 2, 16))
+
+    def test_storage_dtype(self):
+        df, data_dict = random_data_dict(50, seed=4)
+        int8_data_dict = {key: RaggedEmbeddings.from_list(value, 16).astype('int8') if key.endswith('_emb') else
+                          value for key, value in data_dict.items()}
+        # the pairs reference the int8 tables and come back as the dequantized float32 embeddings
+        expected = {key: list(value) for key, value in int8_data_dict.items()}
+        word_pairs, emb_pairs = WordPairGenerator(df=df, device='cpu', size=16).get_word_pairs(df, expected)
+        for n_proc in [1, 2]:
+            wp = WordPairGenerator(df=df, device='cpu', size=16, index_pairs=True, n_proc=n_proc, chunk_size=8)
+            int8_word_pairs, int8_emb_pairs = wp.get_word_pairs(df, int8_data_dict)
+            self.assertEqual(int8_emb_pairs.left_emb.dtype, torch.int8)
+            np.testing.assert_array_equal(word_pairs['left_word'], int8_word_pairs['left_word'])
+            self.assertTrue(torch.allclose(int8_emb_pairs[:], emb_pairs))
+        # without index_pairs every pair keeps its own rows, in the storage dtype as well
+        for storage_dtype in ['float16', 'int8']:
+            ragged_data_dict = {key: RaggedEmbeddings.from_list(value, 16).astype(storage_dtype) if
+                                key.endswith('_emb') else value for key, value in data_dict.items()}
+            expected = {key: list(value) for key, value in ragged_data_dict.items()}
+            word_pairs, emb_pairs = WordPairGenerator(df=df, device='cpu', size=16).get_word_pairs(df, expected)
+            dense_word_pairs, dense_emb_pairs = WordPairGenerator(df=df, device='cpu', size=16).get_word_pairs(
+                df, ragged_data_dict)
+            self.assertEqual(dense_emb_pairs.left_emb.dtype, RaggedEmbeddings.storage_dtypes[storage_dtype])
+            self.assertEqual(dense_emb_pairs.shape, emb_pairs.shape)
+            self.assertTrue(torch.allclose(dense_emb_pairs[:], emb_pairs, atol=1e-6))
+
     def test_process_df(self):
         we = WordEmbeddingFake()
         words_pairs_dict, emb_pairs_dict = {}, {}
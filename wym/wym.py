@@ -37,7 +37,11 @@ class Wym:
     def __init__(self, df: pd.DataFrame, we_finetune_path='bert-base-uncased', device='auto',
                  exclude_attrs=['id', 'left_id', 'right_id', 'label'],
                  column_prefixes=['left_', 'right_'], reset_networks=False, model_files_path='wym',
-                 batch_size=256, verbose=True):
+                 batch_size=256, verbose=True, index_pairs=False, token_budget=None,
+                 embedding_cache_bytes=0, embedding_store_path=None, storage_dtype=None, embedding_backend='eager',
+                 embedding_backend_path=None, embedding_workers=None, embedding_threads=None,
+                 embedding_pipeline=False, embedding_memory_budget=None, embedding_window=None,
+                 embedding_depth=None, embedding_attribute_scope=False):
         self.columns_to_use = np.setdiff1d(df.columns, exclude_attrs)
         self.cols = pd.Series(self.columns_to_use.copy())
         self.cols = self.cols[self.cols.str.startswith(column_prefixes[0])].str.replace(column_prefixes[0], '')
@@ -51,10 +55,23 @@ class Wym:
         self.reset_networks = reset_networks
         self.batch_size = batch_size
         self.verbose = verbose
+        self.index_pairs = index_pairs
+        self.token_budget = token_budget
+        # processes and threads per process of the sharded CPU embedding, off by default
+        self.embedding_workers = embedding_workers
+        self.embedding_threads = embedding_threads
+        # tokenization and pooling on threads next to the model
+        self.embedding_pipeline = embedding_pipeline
+        # bytes of activations per embedding batch, batches are sized by record length instead of batch_size
+        self.embedding_memory_budget = embedding_memory_budget
         self.additive_only = False
 
         # simplified Word Embedding interface
-        self.we = WordEmbedding(device=self.device, verbose=True, model_path=we_finetune_path)
+        self.we = WordEmbedding(device=self.device, verbose=True, model_path=we_finetune_path,
+                                cache_bytes=embedding_cache_bytes, store_path=embedding_store_path,
+                                storage_dtype=storage_dtype, backend=embedding_backend,
+                                backend_path=embedding_backend_path, window=embedding_window,
+                                depth=embedding_depth, attribute_scope=embedding_attribute_scope)
         self.feature_extractor = FeatureExtractor()
 
     def split_x_y(self, df, label_column_name='label'):
@@ -71,14 +88,20 @@ class Wym:
             prefix = self.lp if side == 'left' else self.rp
             cols = [prefix + col for col in self.cols]
             tmp_df = df.loc[:, cols]
-            res[side + '_word_map'] = WordPairGenerator.map_word_to_attr(tmp_df, self.cols, prefix=prefix)
-            emb, words = we.generate_embedding(tmp_df, chunk_size=batch_size)
-
-            res[side + '_emb'] = emb
-            res[side + '_words'] = words
+            # a record in many candidate pairs is embedded once
+            tmp_df, inverse = WordEmbedding.unique_records(tmp_df, df[prefix + 'id'] if prefix + 'id' in df else None)
+            word_map = WordPairGenerator.map_word_to_attr(tmp_df, self.cols, prefix=prefix)
+            emb, words = we.generate_embedding(tmp_df, chunk_size=batch_size, token_budget=self.token_budget,
+                                               n_workers=self.embedding_workers, n_threads=self.embedding_threads,
+                                               pipeline=self.embedding_pipeline,
+                                               memory_budget=self.embedding_memory_budget)
+
+            res[side + '_word_map'], res[side + '_emb'], res[side + '_words'] = WordEmbedding.expand_records(
+                inverse, word_map, emb, words)
         return res
 
     def get_word_pairs(self, df, data_dict, use_schema=True, **kwargs):
+        kwargs.setdefault('index_pairs', self.index_pairs)
         wp = WordPairGenerator(df=df, use_schema=use_schema, device=self.device, verbose=self.verbose,
                                **kwargs)
         res = wp.get_word_pairs(df, data_dict)
@@ -119,9 +142,9 @@ class Wym:
             # optimizer = optim.SGD(net.parameters(), lr=0.0001, momentum=.9)
             # best_model, score_history, last_model = train_model(net,dataloaders_dict, criterion, optimizer,nn.MSELoss().to(device), num_epochs=150, device=device)
 
-            out = net(valid_dataset.X.to(device))
+            out = valid_dataset.predict(net, device)
             print(f'best_valid --> mean:{out.mean():.4f}  std: {out.std():.4f}')
-            out = last_model(valid_dataset.X.to(device))
+            out = valid_dataset.predict(last_model, device)
             print(f'last_model --> mean:{out.mean():.4f}  std: {out.std():.4f}')
             print('Save...')
             torch.save(best_model.state_dict(), tmp_path)
@@ -142,7 +165,7 @@ class Wym:
             raise FileNotFoundError("The dataloader was not found. You should call .fit() first")
         word_pair_corrected = data_loader.word_pairs_corrected
         with torch.no_grad():
-            word_pair_corrected['pred'] = self.word_pair_model(data_loader.X.to(self.device)).cpu().detach().numpy()
+            word_pair_corrected['pred'] = data_loader.predict(self.word_pair_model, self.device).numpy()
         return word_pair_corrected
 
     def extract_features(self, word_pair, **kwargs):